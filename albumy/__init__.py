@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import time
 
 import click
 from flask import Flask, render_template
@@ -12,7 +13,11 @@ from albumy.blueprints.auth import auth_bp
 from albumy.blueprints.main import main_bp
 from albumy.blueprints.user import user_bp
 from albumy.extensions import bootstrap, db, login_manager, mail, dropzone, moment, whooshee, avatars, csrf
-from albumy.models import Role, User, Photo, Tag, Follow, Notification, Comment, Collect, Permission
+from albumy.ingest import IngestRequest
+from albumy.models import Role, User, Photo, Tag, Follow, Notification, Comment, Collect, Permission, TimelineEntry, \
+	rebuild_counters
+from albumy.notifications import get_notification_pruner, prune_notifications
+from albumy.reaper import collect_garbage
 from albumy.settings import config
 from albumy.utils import logger
 
@@ -27,6 +32,8 @@ def create_app(config_name=None):
 		config_name = os.getenv('FLASK_CONFIG', 'development')
 
 	app = Flask('albumy')
+	# 上传文件直接写入临时文件，见ingest.py
+	app.request_class = IngestRequest
 	# 加载配置
 	app.config.from_object(config[config_name])
 
@@ -37,6 +44,7 @@ def create_app(config_name=None):
 	register_errorhandlers(app)
 	register_shell_context(app)
 	register_template_context(app)
+	register_schedulers(app)
 
 	return app
 
@@ -94,14 +102,25 @@ def register_template_context(app):
 	def make_template_context():
 		if current_user.is_authenticated:
 			# 如果用户已登录，则返回未读消息数量
-			# with_parent起到关联User类的作用
-			notification_count = Notification.query.with_parent(current_user).filter_by(is_read=False).count()
+			# 直接读取User的计数器，不需要查询消息表
+			notification_count = current_user.unread_count or 0
 		else:
 			notification_count = None
 		# 可在templates中全局使用
 		return dict(notification_count=notification_count)
 
 
+def register_schedulers(app):
+	"""
+	定时任务，收到第一个请求时启动，执行命令时不会启动
+	"""
+
+	@app.before_first_request
+	def start_schedulers():
+		if app.config['ALBUMY_NOTIFICATION_PRUNE_INTERVAL']:
+			get_notification_pruner().start()
+
+
 def register_errorhandlers(app):
 	"""
 	错误处理
@@ -210,4 +229,226 @@ def register_commands(app):
 		click.echo('Generating %d comments...' % comment)
 		# 虚拟评论
 		fake_comment(comment)
+		click.echo('Rebuilding timelines...')
+		# 虚拟图片没有经过上传，需要重建时间线
+		TimelineEntry.rebuild()
+		click.echo('Done.')
+
+	@app.cli.command()
+	def recount():
+		"""
+		使用flask recount重新计算图片、用户、标签的计数器
+		"""
+		click.echo('Rebuilding counters...')
+		rebuild_counters()
+		click.echo('Done.')
+
+	@app.cli.command()
+	@click.option('--failed', is_flag=True, help='Also retry failed thumbnails.')
+	def thumbnails(failed):
+		"""
+		使用flask thumbnails生成所有等待中的缩略图
+		"""
+		from albumy.thumbnails import process_pending
+
+		click.echo('Generating thumbnails...')
+		click.echo('Done, %d files processed.' % process_pending(failed))
+
+	@app.cli.group()
+	def timeline():
+		"""
+		主页时间线
+		"""
+
+	@timeline.command()
+	def rebuild():
+		"""
+		使用flask timeline rebuild根据关注关系重建所有用户的时间线
+		"""
+		click.echo('Rebuilding timelines...')
+		TimelineEntry.rebuild()
+		click.echo('Done.')
+
+	@timeline.command()
+	@click.option('--size', default=None, type=int, help='Entries to keep per user, default is ALBUMY_TIMELINE_SIZE.')
+	def trim(size):
+		"""
+		使用flask timeline trim删除时间线中过旧的数据
+		"""
+		for (user_id,) in db.session.query(User.id).all():
+			TimelineEntry.trim(user_id, size)
+		db.session.commit()
+		click.echo('Done.')
+
+	@app.cli.group()
+	def accounts():
+		"""
+		账号
+		"""
+
+	@accounts.command()
+	@click.option('--chunk', default=None, type=int, help='Rows deleted per batch, default is ALBUMY_ACCOUNT_DELETE_CHUNK.')
+	def purge(chunk):
+		"""
+		使用flask accounts purge在前台删除所有标记为删除的账号，并显示进度
+		"""
+		from albumy.accounts import delete_user_data
+
+		for user_id, username in db.session.query(User.id, User.username).filter_by(deleting=True).all():
+			click.echo('Deleting %s...' % username)
+			delete_user_data(user_id, chunk, lambda step, count: click.echo('  %s: %d' % (step, count)))
 		click.echo('Done.')
+
+	@app.cli.group()
+	def notifications():
+		"""
+		消息提醒
+		"""
+
+	@notifications.command()
+	@click.option('--days', default=None, type=int, help='Keep read notifications newer than this many days, '
+														 'default is ALBUMY_NOTIFICATION_RETENTION_DAYS.')
+	@click.option('--batch-size', default=None, type=int, help='Rows deleted per batch, '
+															   'default is ALBUMY_NOTIFICATION_PRUNE_BATCH_SIZE.')
+	@click.option('--pause', default=0.0, help='Seconds to sleep between batches.')
+	def prune(days, batch_size, pause):
+		"""
+		使用flask notifications prune分批删除超过保留天数的已读消息
+		"""
+		if days is None:
+			days = app.config['ALBUMY_NOTIFICATION_RETENTION_DAYS']
+		total = 0
+		for deleted in prune_notifications(days, batch_size or app.config['ALBUMY_NOTIFICATION_PRUNE_BATCH_SIZE']):
+			total += deleted
+			click.echo('%d notifications deleted.' % total)
+			time.sleep(pause)
+		click.echo('Done.')
+
+	@app.cli.group()
+	def media():
+		"""
+		上传文件
+		"""
+
+	@media.command()
+	@click.option('--batch-size', default=1000, help='Files moved per batch.')
+	@click.option('--pause', default=0.0, help='Seconds to sleep between batches.')
+	def migrate(batch_size, pause):
+		"""
+		使用flask media migrate把平铺的图片和头像移动到分层目录，中断后可以重新执行
+		"""
+		from albumy.storage import migrate_directory
+
+		for directory in (app.config['ALBUMY_UPLOAD_PATH'], app.config['AVATARS_SAVE_PATH']):
+			if not os.path.isdir(directory):
+				continue
+			click.echo('Migrating %s...' % directory)
+			total = 0
+			for moved in migrate_directory(directory, batch_size):
+				total += moved
+				click.echo('%d files moved.' % total)
+				time.sleep(pause)
+		click.echo('Done.')
+
+	@media.command()
+	@click.option('--grace', default=None, type=int, help='Keep files newer than this many seconds, '
+															'default is ALBUMY_GC_GRACE.')
+	@click.option('--dry-run', is_flag=True, help='Only list the files.')
+	def gc(grace, dry_run):
+		"""
+		使用flask media gc删除待删除的文件，以及没有引用的孤立文件、上传临时文件和变体
+		"""
+		if grace is None:
+			grace = app.config['ALBUMY_GC_GRACE']
+		result = collect_garbage(grace, dry_run)
+		click.echo('%d deferred files deleted.' % result.pop('deferred'))
+		for kind, names in sorted(result.items()):
+			click.echo('%s: %d %s.' % (kind, len(names), 'found' if dry_run else 'deleted'))
+			if dry_run:
+				for name in names:
+					click.echo('  ' + name)
+		click.echo('Done.')
+
+	@app.cli.group()
+	def bench():
+		"""
+		性能测试，使用独立的临时数据库
+		"""
+
+	@bench.command('timeline')
+	@click.option('--users', default=10000, help='Quantity of users, default is 10000.')
+	@click.option('--photos', default=1000000, help='Quantity of photos, default is 1000000.')
+	@click.option('--follows', default=20, help='Follows per user, default is 20.')
+	@click.option('--sample', default=200, help='Users to query, default is 200.')
+	@click.option('--size', default=1000, help='Timeline size, default is 1000.')
+	@click.option('--db', 'path', default=None, help='Database file, default is a temp file.')
+	def bench_timeline(users, photos, follows, sample, size, path):
+		"""
+		比较主页 Photo JOIN Follow 查询和时间线表查询的耗时
+		"""
+		from albumy.benchmarks import bench_timeline
+
+		bench_timeline(users, photos, follows, sample, size,
+					   app.config['ALBUMY_PHOTO_PER_PAGE'], path)
+
+	@bench.command('can')
+	@click.option('--number', default=10000, help='Iterations, default is 10000.')
+	def bench_can(number):
+		"""
+		比较User.can查询数据库和读取权限缓存的耗时
+		"""
+		from albumy.benchmarks import bench_permissions
+
+		bench_permissions(number)
+
+	@bench.command('tags')
+	@click.option('--photos', default=200000, help='Quantity of photos, default is 200000.')
+	@click.option('--tags', default=5000, help='Quantity of tags, default is 5000.')
+	@click.option('--taggings', default=1000000, help='Quantity of tagging rows, default is 1000000.')
+	@click.option('--number', default=20, help='Iterations, default is 20.')
+	@click.option('--db', 'path', default=None, help='SQLite database file, default is a temporary file.')
+	def bench_tags(photos, tags, taggings, number, path):
+		"""
+		比较热门标签 GROUP BY 查询和标签缓存的耗时
+		"""
+		from albumy.benchmarks import bench_tags
+
+		bench_tags(photos, tags, taggings, number, path)
+
+	@bench.command('explore')
+	@click.option('--photos', default=1000000, help='Quantity of photos, default is 1000000.')
+	@click.option('--number', default=20, help='Iterations, default is 20.')
+	@click.option('--db', 'path', default=None, help='SQLite database file, default is a temporary file.')
+	def bench_explore(photos, number, path):
+		"""
+		比较发现页面 ORDER BY RANDOM() 和随机抽样器的耗时
+		"""
+		from albumy.benchmarks import bench_explore
+
+		bench_explore(photos, number, path)
+
+	@bench.command('resize')
+	@click.option('--count', default=5, help='Quantity of images per format, default is 5.')
+	@click.option('--width', default=4000, help='Image width, default is 4000.')
+	@click.option('--height', default=3000, help='Image height, default is 3000.')
+	@click.option('--dir', 'path', default=None, help='Working directory, default is a temporary directory.')
+	def bench_resize(count, width, height, path):
+		"""
+		比较原来的resize_image和resize_images生成缩略图的耗时
+		"""
+		from albumy.benchmarks import bench_resize
+
+		bench_resize(count, width, height, app.config['ALBUMY_PHOTO_SUFFIX'], path)
+
+	@bench.command('encoders')
+	@click.option('--count', default=3, help='Quantity of generated images per kind, default is 3.')
+	@click.option('--width', default=2000, help='Generated image width, default is 2000.')
+	@click.option('--height', default=1500, help='Generated image height, default is 1500.')
+	@click.option('--dir', 'path', default=None, help='Directory of sample images, default is generated images.')
+	def bench_encoders(count, width, height, path):
+		"""
+		对比缩略图各种编码设置的文件大小和质量
+		"""
+		from albumy.benchmarks import bench_encoders
+
+		bench_encoders(app.config['ALBUMY_PHOTO_SUFFIX'].keys(), count, width, height, path)
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+后台删除账号
+删除账号时先把用户标记为deleting并禁止登录，然后在后台线程中按数据类型分批删除
+每一批使用按id集合执行的UPDATE和DELETE，同时修正其他用户、图片、标签的计数器，每一批单独提交
+DELETE的行数与选出的数量不一致时，这一批已经被其他进程删除，回滚后重新选择，计数器不会重复减少
+User.deleting为True的用户就是队列中的任务，程序异常退出后使用flask accounts purge删除，已经删除的部分不会重复处理
+"""
+import os
+import queue
+import threading
+
+from flask import current_app
+
+from albumy.caches import get_explore_sampler, get_tag_cache
+from albumy.extensions import db
+from albumy.models import User, Photo, Comment, Collect, Follow, Notification, TimelineEntry, Blob, Tag, tagging, \
+	FileDeletion, NotificationActor
+from albumy.settings import ALTERNATE_FORMATS
+from albumy.utils import logger
+
+
+class ConcurrentDeletion(Exception):
+	"""
+	同一批数据同时被其他进程删除
+	"""
+
+
+def _delete(statement, expected):
+	"""
+	执行DELETE，删除的行数与选出的数量不一致时抛出ConcurrentDeletion，回滚同一个事务中减少的计数器
+	:param expected: 选出的行数
+	"""
+	if db.session.execute(statement).rowcount != expected:
+		raise ConcurrentDeletion()
+
+
+def _decrease(column, counts):
+	"""
+	计数器减去对应的数量
+	:param column: 计数器字段，例如Photo.collect_count
+	:param counts: id与数量的列表
+	"""
+	if not counts:
+		return
+	table = column.class_.__table__
+	db.session.execute(
+		table.update().where(table.c.id == db.bindparam('_id')).values(
+			{column.key: db.func.coalesce(getattr(table.c, column.key), 0) - db.bindparam('_amount')}),
+		[{'_id': id_value, '_amount': amount} for id_value, amount in counts]
+	)
+
+
+def _delete_follows(user_id, chunk_size):
+	table = Follow.__table__
+	rows = db.session.query(Follow.follower_id, Follow.followed_id).filter(
+		db.or_(Follow.follower_id == user_id, Follow.followed_id == user_id)).limit(chunk_size).all()
+	if not rows:
+		return 0
+	# 关注自己的记录不计入计数器
+	_decrease(User.follower_count, [(followed_id, 1) for follower_id, followed_id in rows
+									if follower_id == user_id and followed_id != user_id])
+	_decrease(User.following_count, [(follower_id, 1) for follower_id, followed_id in rows
+									 if followed_id == user_id and follower_id != user_id])
+	followed = [followed_id for follower_id, followed_id in rows if follower_id == user_id]
+	followers = [follower_id for follower_id, followed_id in rows if follower_id != user_id]
+	if followed:
+		_delete(table.delete().where(db.and_(table.c.follower_id == user_id, table.c.followed_id.in_(followed))),
+				len(followed))
+	if followers:
+		_delete(table.delete().where(db.and_(table.c.followed_id == user_id, table.c.follower_id.in_(followers))),
+				len(followers))
+	return len(rows)
+
+
+def _delete_timeline(user_id, chunk_size):
+	table = TimelineEntry.__table__
+	photo_ids = [photo_id for (photo_id,) in db.session.query(TimelineEntry.photo_id).filter(
+		TimelineEntry.user_id == user_id).limit(chunk_size)]
+	if photo_ids:
+		db.session.execute(table.delete().where(db.and_(table.c.user_id == user_id, table.c.photo_id.in_(photo_ids))))
+	return len(photo_ids)
+
+
+def _comment_tree(comment_ids):
+	"""
+	评论以及所有的回复
+	"""
+	ids = set(comment_ids)
+	parents = list(comment_ids)
+	while parents:
+		parents = [comment_id for (comment_id,) in db.session.query(Comment.id).filter(
+			Comment.replied_id.in_(parents)) if comment_id not in ids]
+		ids.update(parents)
+	return list(ids)
+
+
+def _delete_comments(comment_ids, deleted_photos=()):
+	"""
+	删除评论以及所有的回复，修正图片的评论数
+	:param deleted_photos: 同时删除的图片id，不需要修正评论数；回复可能在其他图片下
+	"""
+	ids = _comment_tree(comment_ids)
+	_decrease(Photo.comment_count, [(photo_id, count) for photo_id, count in db.session.query(
+		Comment.photo_id, db.func.count(Comment.id)).filter(Comment.id.in_(ids)).group_by(Comment.photo_id)
+		if photo_id not in deleted_photos])
+	table = Comment.__table__
+	_delete(table.delete().where(table.c.id.in_(ids)), len(ids))
+	return len(ids)
+
+
+def _delete_photos(user_id, chunk_size):
+	rows = db.session.query(Photo.id, Photo.filename, Photo.filename_s, Photo.filename_m).filter(
+		Photo.author_id == user_id).order_by(Photo.id).limit(chunk_size).all()
+	if not rows:
+		return 0
+	photo_ids = [row.id for row in rows]
+
+	# 标签
+	counts = db.session.query(tagging.c.tag_id, db.func.count()).filter(
+		tagging.c.photo_id.in_(photo_ids)).group_by(tagging.c.tag_id).all()
+	_decrease(Tag.photo_count, counts)
+	_delete(tagging.delete().where(tagging.c.photo_id.in_(photo_ids)), sum(count for tag_id, count in counts))
+	# 收藏
+	counts = db.session.query(Collect.collector_id, db.func.count()).filter(
+		Collect.collected_id.in_(photo_ids)).group_by(Collect.collector_id).all()
+	_decrease(User.collection_count, counts)
+	_delete(Collect.__table__.delete().where(Collect.__table__.c.collected_id.in_(photo_ids)),
+			sum(count for collector_id, count in counts))
+	# 评论
+	comment_ids = [comment_id for (comment_id,) in db.session.query(Comment.id).filter(
+		Comment.photo_id.in_(photo_ids))]
+	if comment_ids:
+		_delete_comments(comment_ids, deleted_photos=set(photo_ids))
+	# 所有用户时间线中的图片
+	db.session.execute(TimelineEntry.__table__.delete().where(TimelineEntry.__table__.c.photo_id.in_(photo_ids)))
+
+	# 文件的引用数，没有其他图片使用的文件加入待删除列表
+	references = {}
+	for row in rows:
+		references[row.filename] = references.get(row.filename, 0) + 1
+	blobs = Blob.__table__
+	db.session.execute(
+		blobs.update().where(blobs.c.filename == db.bindparam('_filename')).values(
+			refcount=blobs.c.refcount - db.bindparam('_amount')),
+		[{'_filename': filename, '_amount': amount} for filename, amount in references.items()]
+	)
+	refcounts = dict(db.session.query(Blob.filename, Blob.refcount).filter(Blob.filename.in_(list(references))))
+	# 与监听器相同，没有Blob记录的旧图片直接删除文件
+	unused = set(filename for filename in references if (refcounts.get(filename) or 0) <= 0)
+	filenames = []
+	for row in rows:
+		if row.filename in unused:
+			filenames += [row.filename, row.filename_s, row.filename_m]
+			for name in (row.filename_s, row.filename_m):
+				filenames += [os.path.splitext(name)[0] + ext for mimetype, ext, fmt in ALTERNATE_FORMATS]
+	if unused:
+		db.session.execute(blobs.delete().where(blobs.c.filename.in_(list(unused))))
+	FileDeletion.defer(db.session(), db.session.connection(), 'uploads', filenames)
+
+	_delete(Photo.__table__.delete().where(Photo.__table__.c.id.in_(photo_ids)), len(photo_ids))
+	sampler = get_explore_sampler()
+	for photo_id in photo_ids:
+		sampler.remove(photo_id)
+	return len(rows)
+
+
+def _delete_collects(user_id, chunk_size):
+	photo_ids = [photo_id for (photo_id,) in db.session.query(Collect.collected_id).filter(
+		Collect.collector_id == user_id).limit(chunk_size)]
+	if not photo_ids:
+		return 0
+	_decrease(Photo.collect_count, [(photo_id, 1) for photo_id in photo_ids])
+	table = Collect.__table__
+	_delete(table.delete().where(db.and_(table.c.collector_id == user_id, table.c.collected_id.in_(photo_ids))),
+			len(photo_ids))
+	return len(photo_ids)
+
+
+def _delete_user_comments(user_id, chunk_size):
+	comment_ids = [comment_id for (comment_id,) in db.session.query(Comment.id).filter(
+		Comment.author_id == user_id).limit(chunk_size)]
+	if not comment_ids:
+		return 0
+	return _delete_comments(comment_ids)
+
+
+def _clear_actor(user_id, chunk_size):
+	"""
+	其他用户的消息中不再引用这个用户，显示为已注销的用户，合并的人数不变
+	"""
+	actors = NotificationActor.__table__
+	ids = [notification_id for (notification_id,) in db.session.query(NotificationActor.notification_id).filter(
+		NotificationActor.actor_id == user_id).limit(chunk_size)]
+	if ids:
+		db.session.execute(actors.delete().where(db.and_(actors.c.actor_id == user_id,
+														 actors.c.notification_id.in_(ids))))
+		return len(ids)
+	ids = [notification_id for (notification_id,) in db.session.query(Notification.id).filter(
+		Notification.actor_id == user_id).limit(chunk_size)]
+	if ids:
+		table = Notification.__table__
+		db.session.execute(table.update().where(table.c.id.in_(ids)).values(actor_id=None))
+	return len(ids)
+
+
+def _delete_notifications(user_id, chunk_size):
+	ids = [notification_id for (notification_id,) in db.session.query(Notification.id).filter(
+		Notification.receiver_id == user_id).limit(chunk_size)]
+	if ids:
+		actors = NotificationActor.__table__
+		db.session.execute(actors.delete().where(actors.c.notification_id.in_(ids)))
+		db.session.execute(Notification.__table__.delete().where(Notification.__table__.c.id.in_(ids)))
+	return len(ids)
+
+
+# 删除的顺序，先删除其他用户能看到的数据
+STEPS = (
+	('follows', _delete_follows),
+	('photos', _delete_photos),
+	('timeline', _delete_timeline),
+	('collects', _delete_collects),
+	('comments', _delete_user_comments),
+	('actors', _clear_actor),
+	('notifications', _delete_notifications),
+)
+
+
+def delete_user_data(user_id, chunk_size=None, progress=None):
+	"""
+	分批删除用户的所有数据，最后删除用户
+	:param user_id: 已经标记为deleting的用户id
+	:param chunk_size: 每一批的数量，默认为ALBUMY_ACCOUNT_DELETE_CHUNK
+	:param progress: progress(step, count)，每一批提交后调用，count为该类数据已经删除的数量
+	"""
+	chunk_size = chunk_size or current_app.config['ALBUMY_ACCOUNT_DELETE_CHUNK']
+	for step, delete in STEPS:
+		total = 0
+		while True:
+			try:
+				count = delete(user_id, chunk_size)
+			except ConcurrentDeletion:
+				# 其他进程正在删除同一个账号，放弃这一批，重新选择剩下的数据
+				db.session.rollback()
+				continue
+			if not count:
+				break
+			db.session.commit()
+			total += count
+			if progress is not None:
+				progress(step, total)
+	# 标签的图片数量直接在数据库中修改，重新加载
+	get_tag_cache().refresh()
+	# 关联的数据都已经删除，删除用户本身的对象，由监听器删除头像、更新搜索索引
+	user = User.query.get(user_id)
+	if user is not None:
+		db.session.delete(user)
+		db.session.commit()
+	if progress is not None:
+		progress('user', 1)
+
+
+class AccountDeleter(object):
+	"""
+	账号删除任务队列，一个后台线程依次处理
+	"""
+
+	def __init__(self, app):
+		self.app = app
+		self.queue = queue.Queue()
+		self.thread = None
+		self.pending = set()
+		self.lock = threading.Lock()
+
+	def submit(self, user_id):
+		"""
+		删除账号
+		:param user_id: 已经标记为deleting并提交的用户id
+		"""
+		if self.app.config['ALBUMY_ACCOUNT_DELETE_SYNC']:
+			delete_user_data(user_id, progress=log_progress(user_id))
+			return
+		self._start()
+		self._put(user_id)
+
+	def _put(self, user_id):
+		with self.lock:
+			if user_id in self.pending:
+				return
+			self.pending.add(user_id)
+		self.queue.put(user_id)
+
+	def _start(self):
+		"""
+		第一次提交任务时启动线程
+		不在这里恢复上次未完成的任务，多个进程会同时删除同一个账号，由flask accounts purge统一处理
+		"""
+		with self.lock:
+			if self.thread is not None:
+				return
+			self.thread = threading.Thread(target=self._work, daemon=True)
+			self.thread.start()
+
+	def _work(self):
+		while True:
+			user_id = self.queue.get()
+			with self.app.app_context():
+				try:
+					delete_user_data(user_id, progress=log_progress(user_id))
+				except Exception:
+					logger.exception('删除账号失败，user_id = {}'.format(user_id))
+				finally:
+					db.session.remove()
+			with self.lock:
+				self.pending.discard(user_id)
+
+
+def log_progress(user_id):
+	"""
+	把删除进度写入日志
+	"""
+	def progress(step, count):
+		logger.info('删除账号，user_id = {}，{}: {}'.format(user_id, step, count))
+	return progress
+
+
+def get_account_deleter():
+	"""
+	当前程序的账号删除队列
+	"""
+	deleter = current_app.extensions.get('albumy_accounts')
+	if deleter is None:
+		deleter = current_app.extensions['albumy_accounts'] = AccountDeleter(current_app._get_current_object())
+	return deleter
@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+"""
+性能测试
+所有测试都在独立的临时SQLite数据库中进行，不会影响程序本身的数据
+使用flask bench xxx运行
+"""
+import io
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+from array import array
+from collections import Counter
+from datetime import datetime, timedelta
+
+import PIL
+import click
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+from albumy.extensions import db
+from albumy.models import User, Photo, Follow, TimelineEntry, Role, Permission, Tag, tagging, exclude_deleting
+from albumy.pagination import keyset_paginate, encode_cursor
+from albumy.utils import resize_images, has_alpha, encoder_available
+
+# 每次批量插入的行数
+CHUNK_SIZE = 50000
+
+
+def bench_session(path=None):
+	"""
+	创建独立的数据库以及会话
+	:param path: 数据库文件路径，默认在临时目录下创建
+	:return: (session, path)
+	"""
+	if path is None:
+		fd, path = tempfile.mkstemp(prefix='albumy-bench-', suffix='.db')
+		os.close(fd)
+	engine = create_engine('sqlite:///' + path)
+	db.metadata.create_all(engine)
+	return sessionmaker(bind=engine)(), path
+
+
+def timeit(func, number=1):
+	"""
+	多次执行func
+	:return: 每次执行的耗时，单位毫秒
+	"""
+	timings = []
+	for i in range(number):
+		start = time.perf_counter()
+		func()
+		timings.append((time.perf_counter() - start) * 1000)
+	return timings
+
+
+def report(label, timings):
+	"""
+	输出耗时统计
+	"""
+	timings = sorted(timings)
+	mean = sum(timings) / len(timings)
+	p50 = timings[len(timings) // 2]
+	p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+	click.echo('%-40s n=%-6d mean=%9.3fms  p50=%9.3fms  p95=%9.3fms' % (label, len(timings), mean, p50, p95))
+
+
+def insert_chunked(session, table, rows):
+	"""
+	分批executemany插入
+	:param rows: 字典的迭代器
+	"""
+	chunk = []
+	for row in rows:
+		chunk.append(row)
+		if len(chunk) >= CHUNK_SIZE:
+			session.execute(table.insert(), chunk)
+			chunk = []
+	if chunk:
+		session.execute(table.insert(), chunk)
+	session.commit()
+
+
+def populate(session, users, photos, follows=0):
+	"""
+	生成虚拟数据，直接使用executemany插入，不经过ORM
+	:param users: 用户数量
+	:param photos: 图片数量
+	:param follows: 每个用户关注的用户数量
+	"""
+	now = datetime.utcnow()
+	click.echo('Generating %d users...' % users)
+	insert_chunked(session, User.__table__, (
+		dict(id=i, username='user%d' % i, email='user%d@example.com' % i, name='user%d' % i,
+			 confirmed=True, active=True, locked=False, member_since=now)
+		for i in range(1, users + 1)
+	))
+	click.echo('Generating %d photos...' % photos)
+	insert_chunked(session, Photo.__table__, (
+		dict(id=i, filename='%d.jpg' % i, filename_s='%d_s.jpg' % i, filename_m='%d_m.jpg' % i,
+			 author_id=random.randint(1, users), flag=0, can_comment=True,
+			 timestamp=now - timedelta(seconds=random.randint(0, 365 * 24 * 3600)))
+		for i in range(1, photos + 1)
+	))
+	if follows:
+		click.echo('Generating %d follows per user...' % follows)
+
+		def follow_rows():
+			for i in range(1, users + 1):
+				# 每个用户都关注自己
+				followed = {i} | set(random.sample(range(1, users + 1), min(follows, users)))
+				for j in followed:
+					yield dict(follower_id=i, followed_id=j, timestamp=now)
+
+		insert_chunked(session, Follow.__table__, follow_rows())
+
+
+def bench_timeline(users, photos, follows, sample, size, per_page, path=None):
+	"""
+	比较主页的两种查询方式：原来的Photo JOIN Follow分页（OFFSET加COUNT）和 main.index使用的时间线表游标分页
+	只为抽样的用户生成时间线，时间线表按(user_id, timestamp)索引，读取耗时与表的总行数基本无关
+	"""
+	temporary = path is None
+	session, path = bench_session(path)
+	click.echo('Database: %s' % path)
+	populate(session, users, photos, follows)
+
+	user_ids = random.sample(range(1, users + 1), min(sample, users))
+	click.echo('Materializing timelines for %d users...' % len(user_ids))
+	for user_id in user_ids:
+		followed_ids = [f for (f,) in session.query(Follow.followed_id).filter(Follow.follower_id == user_id)]
+		rows = (
+			session.query(Photo.id, Photo.timestamp)
+				.filter(Photo.author_id.in_(followed_ids))
+				.order_by(Photo.timestamp.desc())
+				.limit(size)
+		)
+		insert_chunked(session, TimelineEntry.__table__, (
+			dict(user_id=user_id, photo_id=photo_id, timestamp=timestamp) for photo_id, timestamp in rows
+		))
+
+	def join_query(user_id):
+		return session.query(Photo).join(Follow, Follow.followed_id == Photo.author_id) \
+			.filter(Follow.follower_id == user_id)
+
+	def timeline_query(user_id):
+		# 与main.index相同的查询
+		entries = session.query(TimelineEntry).filter_by(user_id=user_id).join(
+			Photo, Photo.id == TimelineEntry.photo_id)
+		return exclude_deleting(entries, Photo.author_id)
+
+	def paginate(query, order_by, page):
+		# 原来的paginate：一次分页查询加一次COUNT
+		query.order_by(order_by).limit(per_page).offset((page - 1) * per_page).all()
+		query.order_by(None).count()
+
+	columns = (TimelineEntry.timestamp, TimelineEntry.photo_id)
+
+	def cursor_of(user_id, page):
+		"""
+		翻到第page页时的游标，即上一页最后一条数据的排序键，不计入耗时
+		"""
+		if page == 1:
+			return None
+		keys = session.query(*columns).filter(TimelineEntry.user_id == user_id) \
+			.order_by(TimelineEntry.timestamp.desc(), TimelineEntry.photo_id.desc()) \
+			.offset((page - 1) * per_page - 1).first()
+		return encode_cursor(keys, 'next') if keys is not None else None
+
+	def keyset(user_id, cursor):
+		# 图片在同一次查询中加载
+		keyset_paginate(timeline_query(user_id), columns, cursor, per_page)
+
+	deep_page = max(1, size // per_page // 2)
+	for page in (1, deep_page):
+		join_timings = []
+		timeline_timings = []
+		for user_id in user_ids:
+			cursor = cursor_of(user_id, page)
+			join_timings += timeit(lambda: paginate(join_query(user_id), Photo.timestamp.desc(), page))
+			timeline_timings += timeit(lambda: keyset(user_id, cursor))
+		report('join     page=%d' % page, join_timings)
+		report('timeline page=%d' % page, timeline_timings)
+	session.close()
+	if temporary:
+		os.remove(path)
+
+
+def bench_permissions(number):
+	"""
+	比较User.can的两种实现：每次查询Permission和role.permissions，以及进程内的权限缓存
+	使用内存数据库
+	"""
+	from albumy import create_app
+
+	app = create_app('testing')
+	with app.app_context():
+		db.create_all()
+		Role.init_role()
+		role = Role.query.filter_by(name='Moderator').first()
+		db.session.execute(User.__table__.insert(), [dict(id=1, username='bench', role_id=role.id)])
+		db.session.commit()
+		user = User.query.get(1)
+		names = ['FOLLOW', 'UPLOAD', 'MODERATE', 'ADMINISTER']
+
+		def query_can(name):
+			# 原来的实现，每个请求都会重新加载role.permissions
+			db.session.expire(user.role, ['permissions'])
+			permission = Permission.query.filter_by(name=name).first()
+			return permission is not None and permission in user.role.permissions
+
+		for name in names:
+			assert query_can(name) == user.can(name)
+
+		query_timings = timeit(lambda: [query_can(name) for name in names], number)
+		cached_timings = timeit(lambda: [user.can(name) for name in names], number)
+		report('query  can() x%d' % len(names), query_timings)
+		report('cached can() x%d' % len(names), cached_timings)
+		db.drop_all()
+
+
+def bench_tags(photos, tags, taggings, number, path=None):
+	"""
+	比较侧边栏热门标签的两种读取方式：每次GROUP BY扫描tagging表 和 进程内标签缓存
+	同时给出缓存过期后重新加载，以及添加标签时增量更新的耗时
+	"""
+	from albumy.caches import TagCache
+
+	temporary = path is None
+	session, path = bench_session(path)
+	click.echo('Database: %s' % path)
+	populate(session, 1000, photos)
+	click.echo('Generating %d tags...' % tags)
+	insert_chunked(session, Tag.__table__, (dict(id=i, name='tag%d' % i) for i in range(1, tags + 1)))
+	click.echo('Generating %d tagging rows...' % taggings)
+	# 热度按幂律分布，少数标签占大部分图片
+	pairs = set()
+	while len(pairs) < min(taggings, photos * tags):
+		pairs.add((random.randint(1, photos), min(tags, int(random.paretovariate(1.0)))))
+	insert_chunked(session, tagging, (dict(photo_id=photo_id, tag_id=tag_id) for photo_id, tag_id in pairs))
+	session.execute(Tag.__table__.update().values(photo_count=db.select([func.count()]).where(
+		tagging.c.tag_id == Tag.id
+	).as_scalar()))
+	session.commit()
+
+	def group_by_top():
+		return session.query(Tag.id, Tag.name, func.count(tagging.c.photo_id)) \
+			.join(tagging, tagging.c.tag_id == Tag.id) \
+			.group_by(Tag.id) \
+			.order_by(func.count(tagging.c.photo_id).desc()) \
+			.limit(10).all()
+
+	cache = TagCache(ttl=300, session=session)
+	cache.refresh()
+	# 数量相同的标签顺序可能不同，只比较数量
+	assert [tag.photo_count for tag in cache.top(10)] == [count for tag_id, name, count in group_by_top()]
+
+	tag = session.query(Tag).get(1)
+	report('group by top(10)', timeit(group_by_top, number))
+	report('cache refresh (ttl expired)', timeit(cache.refresh, number))
+	report('cache top(10)', timeit(lambda: cache.top(10), number * 100))
+	report('cache add()', timeit(lambda: cache.add(tag), number * 100))
+	session.close()
+	if temporary:
+		os.remove(path)
+
+
+def bench_explore(photos, number, path=None):
+	"""
+	比较发现页面的两种随机抽样方式：ORDER BY RANDOM() 和 内存中的图片id数组
+	同时统计均匀抽样时每张图片被抽中次数的离散程度
+	"""
+	from albumy.caches import ExploreSampler
+
+	temporary = path is None
+	session, path = bench_session(path)
+	click.echo('Database: %s' % path)
+	populate(session, 1000, photos)
+
+	def order_by_random():
+		return session.query(Photo).order_by(func.random()).limit(12).all()
+
+	sampler = ExploreSampler(ttl=600, session=session)
+
+	def sampled(bias=None):
+		ids = sampler.sample(15, bias)
+		found = {photo.id: photo for photo in session.query(Photo).filter(Photo.id.in_(ids))}
+		return [found[photo_id] for photo_id in ids if photo_id in found][:12]
+
+	report('sampler refresh', timeit(sampler.refresh))
+	report('order by random()', timeit(order_by_random, number))
+	for bias in (None, 'recent', 'popular'):
+		report('sampler bias=%s' % bias, timeit(lambda: sampled(bias), number))
+
+	# 在前1000张图片中抽样，理想情况下每张图片被抽中的次数相同
+	small = ExploreSampler(ttl=600)
+	small.ids = array('q', range(1, 1001))
+	small.loaded_at = time.time()
+	hits = Counter()
+	for i in range(20000):
+		hits.update(small.sample(12))
+	mean = sum(hits.values()) / 1000.0
+	deviation = (sum((hits[i] - mean) ** 2 for i in range(1, 1001)) / 1000.0) ** 0.5
+	click.echo('uniformity over 1000 ids: mean=%.1f stddev=%.1f min=%d max=%d' % (
+		mean, deviation, min(hits[i] for i in range(1, 1001)), max(hits.values())))
+	session.close()
+	if temporary:
+		os.remove(path)
+
+
+def generate_corpus(path, count, width, height):
+	"""
+	生成测试用的图片，JPEG为噪点叠加渐变的照片，PNG为同样的图片，另外生成色块组成的截图
+	:return: 格式与文件名列表的字典
+	"""
+	click.echo('Generating %d JPEG and %d PNG files of %dx%d...' % (count, count * 2, width, height))
+	corpus = {'JPEG': [], 'PNG': []}
+	for i in range(count):
+		# 噪点叠加渐变，压缩后的大小接近真实照片
+		noise = Image.merge('RGB', [Image.effect_noise((width, height), 40) for band in range(3)])
+		gradient = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+		img = Image.blend(noise, gradient, 0.5)
+		for fmt, ext in (('JPEG', '.jpg'), ('PNG', '.png')):
+			filename = 'source%d%s' % (i, ext)
+			img.save(os.path.join(path, filename), fmt, quality=95)
+			corpus[fmt].append(filename)
+		# 截图：大面积纯色和细线
+		screenshot = Image.new('RGB', (width, height), (250, 250, 250))
+		draw = ImageDraw.Draw(screenshot)
+		for j in range(200):
+			x, y = random.randint(0, width), random.randint(0, height)
+			color = tuple(random.randint(0, 255) for band in range(3))
+			if j % 2:
+				draw.rectangle([x, y, x + random.randint(20, 400), y + random.randint(10, 100)], fill=color)
+			else:
+				draw.line([x, y, random.randint(0, width), y], fill=color, width=2)
+		filename = 'screenshot%d.png' % i
+		screenshot.save(os.path.join(path, filename))
+		corpus['PNG'].append(filename)
+	return corpus
+
+
+def remove_corpus(path):
+	"""
+	删除临时目录以及其中的文件，缩略图保存在分层子目录中
+	"""
+	shutil.rmtree(path)
+
+
+def legacy_resize_image(upload_path, filename, base_width, suffix):
+	"""
+	原来的utils.resize_image，每个尺寸都重新打开并完整解码原图
+	"""
+	name, ext = os.path.splitext(filename)
+	img = Image.open(os.path.join(upload_path, filename))
+	if img.size[0] <= base_width:
+		return filename
+	w_percent = (base_width / float(img.size[0]))
+	h_size = int((float(img.size[1]) * float(w_percent)))
+	img = img.resize((base_width, h_size), PIL.Image.ANTIALIAS)
+	filename = name + suffix + ext
+	img.save(os.path.join(upload_path, filename), optimize=True, quality=85)
+	return filename
+
+
+def bench_resize(count, width, height, sizes, path=None):
+	"""
+	比较原来逐个尺寸解码原图的缩放方式和resize_images
+	在临时目录中生成JPEG和PNG两种大图，各count张
+	:param sizes: 基准宽度与后缀的字典
+	"""
+	temporary = path is None
+	if temporary:
+		path = tempfile.mkdtemp(prefix='albumy-bench-')
+	click.echo('Directory: %s' % path)
+	corpus = generate_corpus(path, count, width, height)
+	for fmt, filenames in corpus.items():
+		legacy_timings = []
+		single_timings = []
+		for filename in filenames:
+			legacy_timings += timeit(lambda: [legacy_resize_image(path, filename, base_width, suffix)
+											  for base_width, suffix in sizes.items()])
+			single_timings += timeit(lambda: resize_images(path, filename, sizes))
+		report('%s legacy resize_image x%d' % (fmt, len(sizes)), legacy_timings)
+		report('%s resize_images' % fmt, single_timings)
+	if temporary:
+		remove_corpus(path)
+
+
+# 编码设置对比：(名称, Pillow格式名, 保存参数)
+ENCODER_SETTINGS = (
+	('jpeg q85 baseline', 'JPEG', dict(quality=85, optimize=True)),
+	('jpeg q80 progressive', 'JPEG', dict(quality=80, optimize=True, progressive=True)),
+	('jpeg q85 progressive', 'JPEG', dict(quality=85, optimize=True, progressive=True)),
+	('webp q75', 'WEBP', dict(quality=75)),
+	('webp q85', 'WEBP', dict(quality=85)),
+	('avif q60', 'AVIF', dict(quality=60)),
+	('png optimize', 'PNG', dict(optimize=True)),
+)
+
+
+def psnr(reference, img):
+	"""
+	峰值信噪比，越大越接近原图，完全相同时为无穷大
+	"""
+	stat = ImageStat.Stat(ImageChops.difference(reference, img))
+	mse = sum(stat.sum2) / float(sum(stat.count))
+	if mse == 0:
+		return float('inf')
+	return 10 * math.log10(255 ** 2 / mse)
+
+
+def bench_encoders(widths, count, width, height, path=None):
+	"""
+	对比缩略图各种编码设置的文件大小和质量
+	:param widths: 缩略图宽度
+	:param path: 图片目录，默认生成临时图片
+	"""
+	temporary = path is None
+	if temporary:
+		path = tempfile.mkdtemp(prefix='albumy-bench-')
+		corpus = generate_corpus(path, count, width, height)
+		filenames = corpus['JPEG'] + corpus['PNG']
+	else:
+		filenames = sorted(f for f in os.listdir(path) if os.path.splitext(f)[1].lower() in
+						   ('.jpg', '.jpeg', '.png', '.webp'))
+	click.echo('Directory: %s, %d images' % (path, len(filenames)))
+
+	for kind in ('JPEG', 'PNG'):
+		sources = [f for f in filenames if (Image.open(os.path.join(path, f)).format == 'JPEG') == (kind == 'JPEG')]
+		if not sources:
+			continue
+		for base_width in sorted(widths):
+			results = {label: ([], []) for label, fmt, params in ENCODER_SETTINGS}
+			for filename in sources:
+				img = Image.open(os.path.join(path, filename))
+				img = img.resize((base_width, int(img.size[1] * base_width / float(img.size[0]))), Image.ANTIALIAS)
+				reference = img.convert('RGBA' if has_alpha(img) else 'RGB')
+				for label, fmt, params in ENCODER_SETTINGS:
+					if not encoder_available(fmt) or (fmt == 'JPEG' and reference.mode == 'RGBA'):
+						continue
+					buf = io.BytesIO()
+					reference.save(buf, fmt, **params)
+					decoded = Image.open(io.BytesIO(buf.getvalue())).convert(reference.mode)
+					results[label][0].append(buf.tell())
+					results[label][1].append(psnr(reference, decoded))
+			click.echo('%s sources, width=%d' % (kind, base_width))
+			for label, (sizes, scores) in results.items():
+				if sizes:
+					click.echo('  %-24s %9.1fKB  psnr=%6.2fdB' % (
+						label, sum(sizes) / len(sizes) / 1024.0, sum(scores) / len(scores)))
+	if temporary:
+		remove_corpus(path)
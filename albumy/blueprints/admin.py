@@ -5,10 +5,12 @@
 from flask import render_template, flash, Blueprint, request, current_app
 from flask_login import login_required
 
+from albumy.caches import get_tag_cache
 from albumy.decorators import admin_required, permission_required
 from albumy.extensions import db
 from albumy.forms.admin import EditProfileAdminForm
 from albumy.models import Role, User, Tag, Photo, Comment
+from albumy.pagination import keyset_paginate
 from albumy.utils import redirect_back, logger
 
 admin_bp = Blueprint("admin", __name__)
@@ -66,6 +68,7 @@ def edit_profile_admin(user_id):
 	if form.validate_on_submit():
 		user.name = form.name.data
 		role = Role.query.get(form.role.data)
+		role_changed = role.id != user.role_id
 		if role.name == "Locked":
 			user.lock()
 		user.role = role
@@ -77,6 +80,9 @@ def edit_profile_admin(user_id):
 		user.username = form.username.data
 		user.email = form.email.data
 		db.session.commit()
+		# 修改了角色，清空权限缓存
+		if role_changed:
+			Role.invalidate_permissions()
 		flash("Profile updated.", "success")
 		return redirect_back()
 	# 否则获取用户数据到form中在网页中显示
@@ -165,6 +171,7 @@ def delete_tag(tag_id):
 	tag = Tag.query.get_or_404(tag_id)
 	db.session.delete(tag)
 	db.session.commit()
+	get_tag_cache().delete(tag_id)
 	flash("Tag deleted.", "info")
 	return redirect_back()
 
@@ -181,7 +188,7 @@ def manage_user():
 	filter_rule = request.args.get(
 		"filter", "all"
 	)  # 'all', 'locked', 'blocked', 'administrator', 'moderator'
-	page = request.args.get("page", 1, type=int)
+	cursor = request.args.get("page")
 	per_page = current_app.config["ALBUMY_MANAGE_USER_PER_PAGE"]
 	administrator = Role.query.filter_by(name="Administrator").first()
 	moderator = Role.query.filter_by(name="Moderator").first()
@@ -199,8 +206,10 @@ def manage_user():
 		# 得到所有用户数据
 		filtered_users = User.query
 
-	pagination = filtered_users.order_by(User.member_since.desc()).paginate(
-		page, per_page
+	# 正在删除的账号不再显示
+	filtered_users = filtered_users.filter_by(deleting=False)
+	pagination = keyset_paginate(
+		filtered_users, (User.member_since, User.id), cursor, per_page
 	)
 	users = pagination.items
 	return render_template("admin/manage_user.html", pagination=pagination, users=users)
@@ -216,19 +225,19 @@ def manage_photo(order):
 	:param order: 排序规则
 	"""
 	logger.info('url = ' + str(request.url))
-	page = request.args.get("page", 1, type=int)
+	cursor = request.args.get("page")
 	per_page = current_app.config["ALBUMY_MANAGE_PHOTO_PER_PAGE"]
 	# 默认是根据举报次数排序
 	order_rule = "flag"
 	if order == "by_time":
 		# 根据时间降序排序
-		pagination = Photo.query.order_by(Photo.timestamp.desc()).paginate(
-			page, per_page
+		pagination = keyset_paginate(
+			Photo.query, (Photo.timestamp, Photo.id), cursor, per_page
 		)
 		order_rule = "time"
 	else:
 		# 时间举报次数的降序排序
-		pagination = Photo.query.order_by(Photo.flag.desc()).paginate(page, per_page)
+		pagination = keyset_paginate(Photo.query, (Photo.flag, Photo.id), cursor, per_page)
 	photos = pagination.items
 	return render_template(
 		"admin/manage_photo.html",
@@ -246,10 +255,10 @@ def manage_tag():
 	管理标签
 	"""
 	logger.info('url = ' + str(request.url))
-	page = request.args.get("page", 1, type=int)
+	cursor = request.args.get("page")
 	per_page = current_app.config["ALBUMY_MANAGE_TAG_PER_PAGE"]
 	# 根据标签id排序
-	pagination = Tag.query.order_by(Tag.id.desc()).paginate(page, per_page)
+	pagination = keyset_paginate(Tag.query, (Tag.id,), cursor, per_page)
 	tags = pagination.items
 	return render_template("admin/manage_tag.html", pagination=pagination, tags=tags)
 
@@ -265,19 +274,19 @@ def manage_comment(order):
 	:param order: 排序规则
 	"""
 	logger.info('url = ' + str(request.url))
-	page = request.args.get("page", 1, type=int)
+	cursor = request.args.get("page")
 	per_page = current_app.config["ALBUMY_MANAGE_COMMENT_PER_PAGE"]
 	order_rule = "flag"
 	if order == "by_time":
 		# 根据时间排序
-		pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-			page, per_page
+		pagination = keyset_paginate(
+			Comment.query, (Comment.timestamp, Comment.id), cursor, per_page
 		)
 		order_rule = "time"
 	else:
 		# 根据举报次数排序
-		pagination = Comment.query.order_by(Comment.flag.desc()).paginate(
-			page, per_page
+		pagination = keyset_paginate(
+			Comment.query, (Comment.flag, Comment.id), cursor, per_page
 		)
 	comments = pagination.items
 	return render_template(
@@ -2,12 +2,17 @@
 """
 ajax功能模块
 """
-from flask import render_template, jsonify, Blueprint,request
+from functools import partial
+
+from flask import render_template, jsonify, Blueprint,request, Response
 from flask_login import current_user
 
-from albumy.models import User, Photo, Notification
+from albumy.events import get_event_broker, stream_events, unread_event
+from albumy.extensions import db
+from albumy.models import User, Photo
 from albumy.notifications import push_collect_notification, push_follow_notification
 from albumy.utils import logger
+from albumy.viewer import load_users
 
 ajax_bp = Blueprint('ajax', __name__)
 
@@ -21,9 +26,30 @@ def notifications_count():
 	logger.info('url = ' + str(request.url))
 	if not current_user.is_authenticated:
 		return jsonify(message='Login required.'), 403
-	# 使用with_parent与user关联
-	count = Notification.query.with_parent(current_user).filter_by(is_read=False).count()
-	return jsonify(count=count)
+	# 读取User的计数器
+	return jsonify(count=current_user.unread_count or 0)
+
+
+@ajax_bp.route('/notifications/stream')
+def notifications_stream():
+	"""
+	未读消息数量的SSE连接，数量变化时推送，代替定时请求notifications_count
+	:return: text/event-stream，连接数超过上限时返回503，客户端改为轮询
+	"""
+	if not current_user.is_authenticated:
+		return jsonify(message='Login required.'), 403
+	broker = get_event_broker()
+	subscription = broker.subscribe(current_user.id)
+	if subscription is None:
+		return jsonify(message='Too many connections.'), 503
+	# 订阅之后重新读取数量，登录用户加载之后的变化不会遗漏
+	count = db.session.query(User.unread_count).filter_by(id=current_user.id).scalar()
+	response = Response(stream_events(broker, subscription, unread_event(count)), mimetype='text/event-stream')
+	response.call_on_close(partial(broker.unsubscribe, subscription))
+	response.headers['Cache-Control'] = 'no-cache'
+	# nginx不缓冲响应
+	response.headers['X-Accel-Buffering'] = 'no'
+	return response
 
 
 @ajax_bp.route('/profile/<int:user_id>')
@@ -33,7 +59,9 @@ def get_profile(user_id):
 	:param user_id: 用户id
 	"""
 	logger.info('url = ' + str(request.url))
-	user = User.query.get_or_404(user_id)
+	user = User.query.filter_by(id=user_id, deleting=False).first_or_404()
+	# 弹出框中多次判断关注关系，一次查询出来
+	load_users([user])
 	return render_template('main/profile_popup.html', user=user)
 
 
@@ -45,7 +73,7 @@ def followers_count(user_id):
 	"""
 	logger.info('url = ' + str(request.url))
 	user = User.query.get_or_404(user_id)
-	count = user.followers.count() - 1
+	count = user.follower_count
 	return jsonify(count=count)
 
 
@@ -57,7 +85,7 @@ def collectors_count(photo_id):
 	"""
 	logger.info('url = ' + str(request.url))
 	photo = Photo.query.get_or_404(photo_id)
-	count = len(photo.collectors)
+	count = photo.collect_count
 	return jsonify(count=count)
 
 
@@ -130,7 +158,7 @@ def follow(username):
 		return jsonify(message='No permission.'), 403
 
 	# 获取被关注的User实例对象
-	user = User.query.filter_by(username=username).first_or_404()
+	user = User.query.filter_by(username=username, deleting=False).first_or_404()
 	if current_user.is_following(user):
 		return jsonify(message='Already followed.'), 400
 
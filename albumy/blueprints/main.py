@@ -2,7 +2,7 @@
 """
 主要功能模块
 """
-import os
+from datetime import datetime
 
 from flask import (
 	render_template,
@@ -10,20 +10,29 @@ from flask import (
 	redirect,
 	url_for,
 	current_app,
-	send_from_directory,
 	request,
 	abort,
 	Blueprint,
+	jsonify,
 )
 from flask_login import login_required, current_user
-from sqlalchemy.sql.expression import func
 
+from albumy.caches import get_tag_cache, get_explore_sampler, ExploreSampler
 from albumy.decorators import confirm_required, permission_required
+from albumy.events import publish_unread
 from albumy.extensions import db
 from albumy.forms.main import DescriptionForm, TagForm, CommentForm
-from albumy.models import User, Photo, Tag, Follow, Collect, Comment, Notification
-from albumy.notifications import push_comment_notification, push_collect_notification
-from albumy.utils import rename_image, resize_image, redirect_back, flash_errors, logger
+from albumy.models import User, Photo, Tag, Collect, Comment, Notification, TimelineEntry, Blob, exclude_deleting
+from albumy.ingest import batch_upload
+from albumy.media import send_stored, send_negotiated
+from albumy.notifications import push_comment_notification, push_collect_notification, render_messages
+from albumy.pagination import keyset_paginate
+from albumy.settings import ThumbnailStatus
+from albumy.storage import media_path, get_storage
+from albumy.thumbnails import get_thumbnail_queue
+from albumy.utils import rename_image, redirect_back, flash_errors, logger
+from albumy.variants import send_variant
+from albumy.viewer import load_photos, load_users
 
 main_bp = Blueprint("main", __name__)
 
@@ -39,29 +48,29 @@ def index():
 	# 如果登录了，就会按时间顺序显示自己和关注的用户的发布的图片
 	# 而如果没有登录，则显示主页图片以及注册功能
 	if current_user.is_authenticated:
-		# 页码
-		page = request.args.get("page", 1, type=int)
+		# 游标
+		cursor = request.args.get("page")
 		# 每一页的图片多少
 		per_page = current_app.config["ALBUMY_PHOTO_PER_PAGE"]
-		pagination = (
-			# 关联Follow表，关联条件是Follow的followed_id和Photo的authid_id一致
-			Photo.query.join(Follow, Follow.followed_id == Photo.author_id)
-				# 过滤出自己关注的对象
-				.filter(Follow.follower_id == current_user.id)
-				# 按时间顺序排序
-				.order_by(Photo.timestamp.desc()).paginate(page, per_page)
+		# 从时间线表中读取，上传图片时已经写入了关注者的时间线，按时间顺序排序
+		# 正在注销的用户的图片还没有从时间线中删除时也不显示
+		entries = TimelineEntry.query.filter_by(user_id=current_user.id).join(
+			Photo, Photo.id == TimelineEntry.photo_id)
+		pagination = keyset_paginate(
+			exclude_deleting(entries, Photo.author_id),
+			(TimelineEntry.timestamp, TimelineEntry.photo_id),
+			cursor,
+			per_page,
 		)
 		# 得到photo集合
-		photos = pagination.items
+		photos = [entry.photo for entry in pagination.items]
+		# 一次查询这一页图片的收藏状态
+		load_photos(photos)
 	else:
 		pagination = None
 		photos = None
-	tags = (
-		Tag.query.join(Tag.photos)
-			.group_by(Tag.id)
-			.order_by(func.count(Photo.id).desc())
-			.limit(10)
-	)
+	# 热门标签从进程内缓存中读取，不再每次扫描tagging表
+	tags = get_tag_cache().top(10) if current_user.is_authenticated else None
 	return render_template(
 		"main/index.html",
 		pagination=pagination,
@@ -77,7 +86,15 @@ def explore():
 	发现，随机给出12张图片
 	"""
 	logger.info('url = ' + str(request.url))
-	photos = Photo.query.order_by(func.random()).limit(12)
+	# 偏向，recent为新上传的图片，popular为收藏多的图片，默认均匀抽样
+	bias = request.args.get("bias", current_app.config["ALBUMY_EXPLORE_BIAS"])
+	if bias not in ExploreSampler.BIASES:
+		bias = None
+	# 多抽取几张，其他进程中删除的图片查询不到
+	ids = get_explore_sampler().sample(15, bias)
+	photos = {photo.id: photo for photo in exclude_deleting(
+		Photo.query.filter(Photo.id.in_(ids)), Photo.author_id)} if ids else {}
+	photos = [photos[photo_id] for photo_id in ids if photo_id in photos][:12]
 	return render_template("main/explore.html", photos=photos)
 
 
@@ -104,14 +121,16 @@ def search():
 	# 使用whooshee_search，会搜索在model中定义的属性
 	# 例如，就会在User中搜索name和username
 	if category == "user":
-		pagination = User.query.whooshee_search(q).paginate(page, per_page)
+		pagination = User.query.whooshee_search(q).filter_by(deleting=False).paginate(page, per_page)
 	# 搜索标签
 	elif category == "tag":
 		pagination = Tag.query.whooshee_search(q).paginate(page, per_page)
 	# 搜索图片
 	else:
-		pagination = Photo.query.whooshee_search(q).paginate(page, per_page)
+		pagination = exclude_deleting(Photo.query.whooshee_search(q), Photo.author_id).paginate(page, per_page)
 	results = pagination.items
+	if category == "user":
+		load_users(results)
 	return render_template(
 		"main/search.html",
 		q=q,
@@ -128,7 +147,7 @@ def show_notifications():
 	显示消息
 	"""
 	logger.info('url = ' + str(request.url))
-	page = request.args.get("page", 1, type=int)
+	cursor = request.args.get("page")
 	per_page = current_app.config["ALBUMY_NOTIFICATION_PER_PAGE"]
 	notifications = Notification.query.with_parent(current_user)
 	# None
@@ -139,12 +158,14 @@ def show_notifications():
 		notifications = notifications.filter_by(is_read=False)
 
 	# 时间排序
-	pagination = notifications.order_by(Notification.timestamp.desc()).paginate(
-		page, per_page
+	pagination = keyset_paginate(
+		notifications, (Notification.timestamp, Notification.id), cursor, per_page
 	)
 	notifications = pagination.items
+	# 消息内容在显示时生成
+	messages = render_messages(notifications)
 	return render_template(
-		"main/notifications.html", pagination=pagination, notifications=notifications
+		"main/notifications.html", pagination=pagination, notifications=notifications, messages=messages
 	)
 
 
@@ -161,9 +182,13 @@ def read_notification(notification_id):
 	# 如果登录用户和消息接收者不一致，就抛出403错误
 	if current_user != notification.receiver:
 		abort(403)
-	# 已读消息
-	notification.is_read = True
-	db.session.commit()
+	# 已读消息，只有这次UPDATE修改了消息时才减少未读数量，重复或者同时提交时不会多减
+	updated = Notification.query.filter_by(id=notification.id, is_read=False).update(
+		{Notification.is_read: True}, synchronize_session=False)
+	if updated:
+		current_user.unread_count = db.func.coalesce(User.unread_count, updated) - updated
+		db.session.commit()
+		publish_unread([current_user.id])
 	flash("提醒消息已读！", "success")
 	return redirect(url_for(".show_notifications"))
 
@@ -175,11 +200,13 @@ def read_all_notification():
 	一键已读所有消息
 	"""
 	logger.info('url = ' + str(request.url))
-	# 遍历登录用户的所有消息
-	for notification in current_user.notifications:
-		# 设置为True
-		notification.is_read = True
+	# 一条UPDATE修改所有未读消息，不加载消息对象
+	# 未读数量减去这次修改的数量，UPDATE之后写入的新消息仍然计为未读
+	updated = Notification.query.with_parent(current_user).filter_by(is_read=False).update(
+		{Notification.is_read: True}, synchronize_session=False)
+	current_user.unread_count = db.func.coalesce(User.unread_count, updated) - updated
 	db.session.commit()
+	publish_unread([current_user.id])
 	flash("所有消息已读！", "success")
 	return redirect(url_for(".show_notifications"))
 
@@ -191,9 +218,13 @@ def get_image(filename):
 	:param filename: 图片名字
 	:return: 返回图片的url
 	"""
-	logger.info('url = ' + str(request.url))
-	logger.info('获取图片的名称，filename = ' + str(filename))
-	return send_from_directory(current_app.config["ALBUMY_UPLOAD_PATH"], filename)
+	# 带有w或fmt参数时，返回按需生成的变体，例如?w=200&fmt=webp
+	width = request.args.get("w", type=int)
+	fmt = request.args.get("fmt")
+	if width is not None or fmt is not None:
+		return send_variant(filename, width, fmt)
+	# 缩略图根据Accept返回webp、avif等格式
+	return send_negotiated(get_storage("uploads"), filename, "uploads")
 
 
 @main_bp.route("/avatars/<path:filename>")
@@ -202,8 +233,7 @@ def get_avatar(filename):
 	获取头像
 	:param filename: 头像名字
 	"""
-	logger.info('获取头像的名称，filename = ' + str(filename))
-	return send_from_directory(current_app.config["AVATARS_SAVE_PATH"], filename)
+	return send_stored(get_storage("avatars"), filename, "avatars")
 
 
 @main_bp.route("/upload", methods=["GET", "POST"])
@@ -218,33 +248,168 @@ def upload():
 	if request.method == "POST" and "file" in request.files:
 		# 文件对象
 		f = request.files.get("file")
-		# 文件名
-		filename = rename_image(f.filename)
-		# 保存
-		f.save(os.path.join(current_app.config["ALBUMY_UPLOAD_PATH"], filename))
-		# 小图
-		# 在resize_image函数中，会保存图片
-		filename_s = resize_image(
-			f, filename, current_app.config["ALBUMY_PHOTO_SIZE"]["small"]
-		)
-		# 中图
-		filename_m = resize_image(
-			f, filename, current_app.config["ALBUMY_PHOTO_SIZE"]["medium"]
-		)
-		# 保存图片对象
+		# 接收上传文件时已经写入临时文件，并计算了哈希值，见ingest.py
+		if f.stream.kind is None:
+			abort(415)
+		digest = f.stream.hexdigest()
+		blob = Blob.query.get(digest)
+		created = False
+		if blob is None:
+			# 新的图片，把临时文件重命名为原图，缩略图生成之前先使用原图
+			# 使用对象存储时这里是暂存目录，生成缩略图之后一起上传
+			filename = rename_image(f.filename)
+			path = media_path(get_storage("uploads").directory, filename, create=True)
+			f.stream.save(path)
+			# 先写入Blob，新增Photo时监听器才能增加引用数；相同的图片同时上传时使用另一个请求保存的文件
+			blob, created = Blob.add(digest, filename, path)
+		# 重复上传的图片，直接使用已经保存的文件和缩略图
+		same = None if created else Photo.query.filter_by(filename=blob.filename).first()
+		if same is not None:
+			filename_s, filename_m, status = same.filename_s, same.filename_m, same.thumbnail_status
+		else:
+			# 新的图片，或者使用这个文件的图片刚刚被删除，缩略图生成之前先使用原图
+			filename_s = filename_m = blob.filename
+			status = ThumbnailStatus.PENDING
 		photo = Photo(
-			filename=filename,
+			filename=blob.filename,
 			filename_s=filename_s,
 			filename_m=filename_m,
+			thumbnail_status=status,
 			author=current_user._get_current_object(),
 		)
-		logger.info('上传文件，{},{},{}'.format(filename, filename_m, filename_s))
+		logger.info('上传文件，{}'.format(photo.filename))
 		# 提交
 		db.session.add(photo)
 		db.session.commit()
+		# 在后台生成小图和中图，重复的图片如果还在生成中，也重新提交，避免错过更新
+		if photo.thumbnail_status == ThumbnailStatus.PENDING:
+			get_thumbnail_queue().submit(photo)
+		# 写入关注者的时间线
+		TimelineEntry.push(photo)
+		# 加入发现页面的随机抽样
+		get_explore_sampler().add(photo.id)
 	return render_template("main/upload.html")
 
 
+@main_bp.route("/upload/batch", methods=["POST"])
+@batch_upload
+@login_required
+@confirm_required
+@permission_required("UPLOAD")
+def upload_batch():
+	"""
+	批量上传图片，一个请求中的所有图片在一个事务中写入
+	:return: 每个文件的上传结果，失败的文件由upload.html中的回调标记为错误；全部失败时返回400
+	"""
+	logger.info('url = ' + str(request.url))
+	# 使用uploadMultiple时dropzone的字段名为file[0]、file[1]...
+	files = [f for key in request.files for f in request.files.getlist(key)]
+	upload_path = get_storage("uploads").directory
+	max_files = current_app.config["DROPZONE_MAX_FILES"]
+	author_id = current_user.id
+	# 同一批图片使用相同的上传时间
+	now = datetime.utcnow()
+
+	results = []
+	valid = []
+	for index, f in enumerate(files):
+		result = {"filename": f.filename, "ok": False}
+		results.append(result)
+		if index >= max_files:
+			result["error"] = "一次最多上传{}张图片。".format(max_files)
+		elif f.stream.error is not None:
+			result["error"] = f.stream.error
+		elif f.stream.kind is None:
+			result["error"] = "只能上传图片。"
+		else:
+			valid.append((f, result, f.stream.hexdigest()))
+
+	# 一次查询所有已经保存过的文件
+	digests = set(digest for f, result, digest in valid)
+	blobs = {blob.hash: blob for blob in Blob.query.filter(Blob.hash.in_(digests))} if digests else {}
+	existing = {}
+	if blobs:
+		for photo in Photo.query.filter(Photo.filename.in_([blob.filename for blob in blobs.values()])):
+			existing.setdefault(photo.filename, photo)
+
+	photos = []
+	# 每个文件名新增的引用数
+	references = {}
+	for f, result, digest in valid:
+		blob = blobs.get(digest)
+		if blob is None:
+			# 新的图片，把临时文件重命名为原图，与upload相同，另一个请求同时写入了相同的图片时使用它保存的文件
+			filename = rename_image(f.filename)
+			path = media_path(upload_path, filename, create=True)
+			f.stream.save(path)
+			blob, created = Blob.add(digest, filename, path)
+			blobs[digest] = blob
+			if not created:
+				same = Photo.query.filter_by(filename=blob.filename).first()
+				if same is not None:
+					existing[blob.filename] = same
+		if blob.filename in existing:
+			# 重复上传的图片，直接使用已经保存的文件和缩略图
+			same = existing[blob.filename]
+			filename_s, filename_m, status = same.filename_s, same.filename_m, same.thumbnail_status
+		else:
+			# 新的图片或者同一批中重复的图片，缩略图生成之前先使用原图
+			filename_s = filename_m = blob.filename
+			status = ThumbnailStatus.PENDING
+		photos.append(Photo(
+			filename=blob.filename,
+			filename_s=filename_s,
+			filename_m=filename_m,
+			thumbnail_status=status,
+			timestamp=now,
+			author_id=author_id,
+		))
+		references[blob.filename] = references.get(blob.filename, 0) + 1
+		result["ok"] = True
+
+	if photos:
+		# 一条executemany批量插入，不会触发监听器，引用数和图片数量在这里更新
+		db.session.bulk_save_objects(photos)
+		table = Blob.__table__
+		db.session.execute(
+			table.update().where(table.c.filename == db.bindparam("_filename"))
+				.values(refcount=table.c.refcount + db.bindparam("_amount")),
+			[{"_filename": filename, "_amount": amount} for filename, amount in references.items()]
+		)
+		User.query.filter_by(id=author_id).update(
+			{User.photo_count: db.func.coalesce(User.photo_count, 0) + len(photos)}, synchronize_session=False)
+		# 一次查询取回这一批图片的id，按(作者, 文件名)对应，同一批中重复的文件按插入顺序对应
+		ids = {}
+		for photo_id, filename in db.session.query(Photo.id, Photo.filename).filter(
+				Photo.author_id == author_id, Photo.timestamp == now,
+				Photo.filename.in_(list(references))).order_by(Photo.id):
+			ids.setdefault(filename, []).append(photo_id)
+		for photo in photos:
+			photo.id = ids[photo.filename].pop(0)
+		db.session.commit()
+		logger.info('批量上传文件，{}'.format(len(photos)))
+
+		# 图片与成功的结果顺序相同
+		results_ok = [result for result in results if result["ok"]]
+		for photo, result in zip(photos, results_ok):
+			result["id"] = photo.id
+			result["url"] = url_for(".show_photo", photo_id=photo.id)
+		# 后台进程池并行生成缩略图，相同的原图只生成一次
+		thumbnails = get_thumbnail_queue()
+		for photo in photos:
+			if photo.thumbnail_status == ThumbnailStatus.PENDING:
+				thumbnails.submit(photo)
+		# 一次写入关注者的时间线
+		TimelineEntry.push_many(author_id, photos)
+		sampler = get_explore_sampler()
+		for photo in photos:
+			sampler.add(photo.id)
+	if not photos:
+		# dropzone把所有文件显示为上传失败，并显示error
+		return jsonify(results=results, error="没有可以上传的图片。"), 400
+	return jsonify(results=results)
+
+
 @main_bp.route("/photo/<int:photo_id>")
 def show_photo(photo_id):
 	"""
@@ -253,15 +418,22 @@ def show_photo(photo_id):
 	"""
 	logger.info('url = ' + str(request.url))
 	photo = Photo.query.get_or_404(photo_id)
+	# 作者正在注销时图片和账号一起隐藏
+	if photo.author.deleting:
+		abort(404)
 	page = request.args.get("page", 1, type=int)
 	per_page = current_app.config["ALBUMY_COMMENT_PER_PAGE"]
+	# 按楼层显示时只分页顶层评论，回复全部显示在下面
+	threaded = request.args.get("view") == "thread"
+	query = Comment.query.with_parent(photo).options(*Comment.eager_options())
+	if threaded:
+		query = query.filter(Comment.replied_id.is_(None))
 	# 获取该图片下的所有评论
-	pagination = (
-		Comment.query.with_parent(photo)
-			.order_by(Comment.timestamp.asc())
-			.paginate(page, per_page)
-	)
-	comments = pagination.items
+	pagination = query.order_by(Comment.timestamp.asc(), Comment.id.asc()).paginate(page, per_page)
+	if threaded:
+		comments = Comment.load_threads(pagination.items)
+	else:
+		comments = [(comment, 0) for comment in pagination.items]
 
 	comment_form = CommentForm()
 	# 描述
@@ -278,6 +450,7 @@ def show_photo(photo_id):
 		tag_form=tag_form,
 		pagination=pagination,
 		comments=comments,
+		threaded=threaded,
 	)
 
 
@@ -417,14 +590,17 @@ def show_collectors(photo_id):
 	"""
 	logger.info('url = ' + str(request.url))
 	photo = Photo.query.get_or_404(photo_id)
-	page = request.args.get("page", 1, type=int)
+	cursor = request.args.get("page")
 	per_page = current_app.config["ALBUMY_USER_PER_PAGE"]
-	pagination = (
-		Collect.query.with_parent(photo)
-			.order_by(Collect.timestamp.asc())
-			.paginate(page, per_page)
+	pagination = keyset_paginate(
+		exclude_deleting(Collect.query.with_parent(photo), Collect.collector_id),
+		(Collect.timestamp, Collect.collector_id),
+		cursor,
+		per_page,
+		descending=False,
 	)
 	collects = pagination.items
+	load_users([collect.collector for collect in collects])
 	return render_template(
 		"main/collectors.html", collects=collects, photo=photo, pagination=pagination
 	)
@@ -474,16 +650,15 @@ def new_comment(photo_id):
 		replied_id = request.args.get("reply")
 		if replied_id:
 			comment.replied = Comment.query.get_or_404(replied_id)
-			if comment.replied.author.receive_comment_notification:
-				push_comment_notification(
-					photo_id=photo.id, receiver=comment.replied.author
-				)
 		db.session.add(comment)
 		db.session.commit()
 		flash("评论成功！", "success")
 
+		# 评论提交后再发送消息，消息由后台线程写入
+		if comment.replied and comment.replied.author.receive_comment_notification:
+			push_comment_notification(photo_id=photo.id, receiver=comment.replied.author, author=author)
 		if current_user != photo.author and photo.author.receive_comment_notification:
-			push_comment_notification(photo_id, receiver=photo.author, page=page)
+			push_comment_notification(photo_id, receiver=photo.author, author=author)
 
 	flash_errors(form)
 	return redirect(url_for(".show_photo", photo_id=photo_id, page=page))
@@ -517,6 +692,7 @@ def new_tag(photo_id):
 			if tag not in photo.tags:
 				photo.tags.append(tag)
 				db.session.commit()
+				get_tag_cache().add(tag)
 		flash("标签添加成功！", "success")
 
 	flash_errors(form)
@@ -580,8 +756,13 @@ def delete_photo(photo_id):
 	if current_user != photo.author and not current_user.can("MODERATE"):
 		abort(403)
 
+	tags = list(photo.tags)
 	db.session.delete(photo)
 	db.session.commit()
+	get_explore_sampler().remove(photo_id)
+	tag_cache = get_tag_cache()
+	for tag in tags:
+		tag_cache.remove(tag)
 	flash("图片已删除！", "info")
 
 	# 下一张图片
@@ -642,21 +823,19 @@ def show_tag(tag_id, order):
 	logger.info('url = ' + str(request.url))
 	# 标签
 	tag = Tag.query.get_or_404(tag_id)
-	page = request.args.get("page", 1, type=int)
+	cursor = request.args.get("page")
 	per_page = current_app.config["ALBUMY_PHOTO_PER_PAGE"]
 	# 规则
 	order_rule = "time"
 	# 所有图片
-	pagination = (
-		Photo.query.with_parent(tag)
-			.order_by(Photo.timestamp.desc())
-			.paginate(page, per_page)
+	pagination = keyset_paginate(
+		exclude_deleting(Photo.query.with_parent(tag), Photo.author_id), (Photo.timestamp, Photo.id), cursor, per_page
 	)
 	photos = pagination.items
 
 	# 根据收藏人数排序
 	if order == "by_collects":
-		photos.sort(key=lambda x: len(x.collectors), reverse=True)
+		photos.sort(key=lambda x: x.collect_count, reverse=True)
 		order_rule = "collects"
 	return render_template(
 		"main/tag.html",
@@ -683,12 +862,14 @@ def delete_tag(photo_id, tag_id):
 	# 从图片中移除标签
 	photo.tags.remove(tag)
 	db.session.commit()
+	get_tag_cache().remove(tag)
 
 	# 如果该标签下没有图片了，删除标签
-	if not tag.photos:
+	if not tag.photo_count:
 		db.session.delete(tag)
 		logger.info('用户:{}删除了标签:{}'.format(current_user.username, tag.name))
 		db.session.commit()
+		get_tag_cache().delete(tag_id)
 
 	flash("标签已删除！", "info")
 	return redirect(url_for(".show_photo", photo_id=photo_id))
@@ -2,18 +2,24 @@
 """
 用户模块
 """
-from flask import render_template, flash, redirect, url_for, current_app, request, Blueprint
+import os
+
+from flask import render_template, flash, redirect, url_for, current_app, request, Blueprint, abort
 from flask_login import login_required, current_user, fresh_login_required, logout_user
 
+from albumy.accounts import get_account_deleter
 from albumy.decorators import confirm_required, permission_required
 from albumy.emails import send_confirm_email
 from albumy.extensions import db, avatars
 from albumy.forms.user import EditProfileForm, UploadAvatarForm, CropAvatarForm, ChangeEmailForm, \
 	ChangePasswordForm, NotificationSettingForm, PrivacySettingForm, DeleteAccountForm
-from albumy.models import User, Photo, Collect
+from albumy.models import User, Photo, Collect, Follow, exclude_deleting
 from albumy.notifications import push_follow_notification
+from albumy.pagination import keyset_paginate
 from albumy.settings import Operations
+from albumy.storage import get_storage
 from albumy.utils import generate_token, validate_token, redirect_back, flash_errors, logger
+from albumy.viewer import load_users
 
 user_bp = Blueprint('user', __name__)
 
@@ -25,7 +31,7 @@ def index(username):
 	:param username: 用户名
 	"""
 	logger.info('url = ' + str(request.url))
-	user = User.query.filter_by(username=username).first_or_404()
+	user = User.query.filter_by(username=username, deleting=False).first_or_404()
 	if user == current_user and user.locked:
 		flash('抱歉，您的账号已被禁用该功能！', 'danger')
 
@@ -33,10 +39,10 @@ def index(username):
 	if user == current_user and not user.active:
 		logout_user()
 
-	page = request.args.get('page', 1, type=int)
+	cursor = request.args.get('page')
 	per_page = current_app.config['ALBUMY_PHOTO_PER_PAGE']
 	# 获取用户上传的图片
-	pagination = Photo.query.with_parent(user).order_by(Photo.timestamp.desc()).paginate(page, per_page)
+	pagination = keyset_paginate(Photo.query.with_parent(user), (Photo.timestamp, Photo.id), cursor, per_page)
 	photos = pagination.items
 	return render_template('user/index.html', user=user, pagination=pagination, photos=photos)
 
@@ -48,11 +54,13 @@ def show_collections(username):
 	:param username: 用户名
 	"""
 	logger.info('url = ' + str(request.url))
-	user = User.query.filter_by(username=username).first_or_404()
-	page = request.args.get('page', 1, type=int)
+	user = User.query.filter_by(username=username, deleting=False).first_or_404()
+	cursor = request.args.get('page')
 	per_page = current_app.config['ALBUMY_PHOTO_PER_PAGE']
-	# 所有收藏的数据
-	pagination = Collect.query.with_parent(user).order_by(Collect.timestamp.desc()).paginate(page, per_page)
+	# 所有收藏的数据，不包括正在注销的用户的图片
+	collects = exclude_deleting(Collect.query.with_parent(user).join(Photo, Photo.id == Collect.collected_id),
+								Photo.author_id)
+	pagination = keyset_paginate(collects, (Collect.timestamp, Collect.collected_id), cursor, per_page)
 	collects = pagination.items
 	return render_template('user/collections.html', user=user, pagination=pagination, collects=collects)
 
@@ -68,7 +76,7 @@ def follow(username):
 	"""
 	logger.info('url = ' + str(request.url))
 	# 被关注者的实例对象
-	user = User.query.filter_by(username=username).first_or_404()
+	user = User.query.filter_by(username=username, deleting=False).first_or_404()
 	# 如果已经关注了，则返回
 	if current_user.is_following(user):
 		flash('已经关注该用户！', 'info')
@@ -109,12 +117,14 @@ def show_followers(username):
 	"""
 	logger.info('url = ' + str(request.url))
 	# 根据用户名获取User实例对象
-	user = User.query.filter_by(username=username).first_or_404()
-	page = request.args.get('page', 1, type=int)
+	user = User.query.filter_by(username=username, deleting=False).first_or_404()
+	cursor = request.args.get('page')
 	per_page = current_app.config['ALBUMY_USER_PER_PAGE']
-	pagination = user.followers.paginate(page, per_page)
+	pagination = keyset_paginate(exclude_deleting(user.followers, Follow.follower_id),
+								 (Follow.timestamp, Follow.follower_id), cursor, per_page)
 	# 得到所有的关注者User
 	follows = pagination.items
+	load_users([follow.follower for follow in follows])
 	return render_template('user/followers.html', user=user, pagination=pagination, follows=follows)
 
 
@@ -125,11 +135,13 @@ def show_following(username):
 	:param username: 用户名
 	"""
 	logger.info('url = ' + str(request.url))
-	user = User.query.filter_by(username=username).first_or_404()
-	page = request.args.get('page', 1, type=int)
+	user = User.query.filter_by(username=username, deleting=False).first_or_404()
+	cursor = request.args.get('page')
 	per_page = current_app.config['ALBUMY_USER_PER_PAGE']
-	pagination = user.following.paginate(page, per_page)
+	pagination = keyset_paginate(exclude_deleting(user.following, Follow.followed_id),
+								 (Follow.timestamp, Follow.followed_id), cursor, per_page)
 	follows = pagination.items
+	load_users([follow.followed for follow in follows])
 	return render_template('user/following.html', user=user, pagination=pagination, follows=follows)
 
 
@@ -183,6 +195,9 @@ def upload_avatar():
 	if form.validate_on_submit():
 		image = form.image.data
 		filename = avatars.save_avatar(image)
+		# flask-avatars保存在头像目录的根目录中，移动到存储中
+		storage = get_storage('avatars')
+		storage.put(filename, os.path.join(storage.directory, filename))
 		# 更新头像
 		current_user.avatar_raw = filename
 		db.session.commit()
@@ -205,8 +220,13 @@ def crop_avatar():
 		y = form.y.data
 		w = form.w.data
 		h = form.h.data
-		# 头像裁剪
-		filenames = avatars.crop_avatar(current_user.avatar_raw, x, y, w, h)
+		# 头像裁剪，flask-avatars使用相对于头像目录的路径读取原图，对象存储中的原图先下载到临时文件，裁剪后删除
+		storage = get_storage('avatars')
+		with storage.local_copy(current_user.avatar_raw) as raw:
+			if raw is None:
+				abort(404)
+			filenames = avatars.crop_avatar(os.path.relpath(raw, storage.directory), x, y, w, h)
+		storage.put_many([(filename, os.path.join(storage.directory, filename)) for filename in filenames])
 		# 更新头像
 		current_user.avatar_s = filenames[0]
 		current_user.avatar_m = filenames[1]
@@ -314,9 +334,13 @@ def delete_account():
 	logger.info('url = ' + str(request.url))
 	form = DeleteAccountForm()
 	if form.validate_on_submit():
-		# 删除当前账号
-		db.session.delete(current_user._get_current_object())
+		# 立即禁止登录并从列表中隐藏，数据在后台分批删除
+		user = current_user._get_current_object()
+		user.active = False
+		user.deleting = True
 		db.session.commit()
+		logout_user()
+		get_account_deleter().submit(user.id)
 		flash('账号已删除，如想再次加入，请重新注册！', 'success')
 		return redirect(url_for('main.index'))
 	return render_template('user/settings/delete_account.html', form=form)
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+进程内缓存
+"""
+import heapq
+import random
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+from flask import current_app
+
+from albumy.extensions import db
+from albumy.models import Tag, Photo
+
+# 侧边栏中显示的标签，与Tag对象的属性一致
+TagStat = namedtuple('TagStat', ['id', 'name', 'photo_count'])
+
+
+class TagCache(object):
+	"""
+	标签热度缓存
+	添加、删除标签时增量更新，超过ttl秒后从Tag.photo_count重新加载，修正多进程之间的偏差
+	"""
+
+	def __init__(self, ttl, session=None):
+		self.ttl = ttl
+		self.session = session
+		self.counts = {}
+		self.names = {}
+		self.loaded_at = None
+		self.lock = threading.Lock()
+
+	def refresh(self):
+		"""
+		从数据库重新加载所有标签的图片数量
+		"""
+		session = self.session or db.session
+		counts = {}
+		names = {}
+		for tag_id, name, photo_count in session.query(Tag.id, Tag.name, Tag.photo_count).filter(Tag.photo_count > 0):
+			counts[tag_id] = photo_count
+			names[tag_id] = name
+		with self.lock:
+			self.counts = counts
+			self.names = names
+			self.loaded_at = time.time()
+
+	def top(self, n=10):
+		"""
+		图片数量最多的n个标签
+		:return: TagStat列表
+		"""
+		if self.loaded_at is None or time.time() - self.loaded_at > self.ttl:
+			self.refresh()
+		with self.lock:
+			top = heapq.nlargest(n, self.counts.items(), key=lambda item: item[1])
+			return [TagStat(tag_id, self.names[tag_id], count) for tag_id, count in top]
+
+	def add(self, tag):
+		"""
+		给图片添加了标签
+		"""
+		with self.lock:
+			self.counts[tag.id] = self.counts.get(tag.id, 0) + 1
+			self.names[tag.id] = tag.name
+
+	def remove(self, tag):
+		"""
+		从图片中移除了标签
+		"""
+		with self.lock:
+			count = self.counts.get(tag.id, 0) - 1
+			if count > 0:
+				self.counts[tag.id] = count
+			else:
+				self.counts.pop(tag.id, None)
+				self.names.pop(tag.id, None)
+
+	def delete(self, tag_id):
+		"""
+		删除了标签
+		"""
+		with self.lock:
+			self.counts.pop(tag_id, None)
+			self.names.pop(tag_id, None)
+
+
+def get_tag_cache():
+	"""
+	当前程序的标签缓存
+	"""
+	cache = current_app.extensions.get('albumy_tag_cache')
+	if cache is None:
+		cache = current_app.extensions['albumy_tag_cache'] = TagCache(current_app.config['ALBUMY_TAG_CACHE_TTL'])
+	return cache
+
+
+class ExploreSampler(object):
+	"""
+	发现页面的随机抽样
+	在内存中保存按id升序排列的图片id数组，随机取下标即可，不需要ORDER BY RANDOM()对整张表排序
+	上传图片时按id插入数组，删除图片时记录在removed中，抽样时跳过，重新加载时清除
+	超过ttl秒后在后台线程中重新加载，期间继续使用旧的数据
+	"""
+
+	# 支持的偏向
+	BIASES = ('recent', 'popular')
+
+	def __init__(self, ttl, session=None):
+		self.ttl = ttl
+		self.session = session
+		self.ids = array('q')
+		# 按收藏数加权的累积权重，与ids一一对应
+		self.weights = array('d')
+		# 已删除的图片id，只记录数组中存在的id，len(removed)就是需要跳过的数量
+		self.removed = set()
+		self.loaded_at = None
+		self.refreshing = False
+		self.lock = threading.Lock()
+
+	def refresh(self):
+		"""
+		从数据库重新加载所有图片id以及收藏数
+		"""
+		session = self.session or db.session
+		ids = array('q')
+		weights = array('d')
+		total = 0.0
+		# 直接执行SQL，不经过ORM，减少加载大量图片时的耗时
+		rows = session.execute(db.select([Photo.id, Photo.collect_count]).order_by(Photo.id))
+		for photo_id, collect_count in rows:
+			ids.append(photo_id)
+			total += (collect_count or 0) + 1
+			weights.append(total)
+		with self.lock:
+			self.ids = ids
+			self.weights = weights
+			self.removed = set()
+			self.loaded_at = time.time()
+			self.refreshing = False
+
+	def _refresh_async(self):
+		"""
+		在后台线程中重新加载
+		"""
+		with self.lock:
+			if self.refreshing:
+				return
+			self.refreshing = True
+		app = current_app._get_current_object()
+
+		def run():
+			with app.app_context():
+				try:
+					self.refresh()
+				finally:
+					self.refreshing = False
+					db.session.remove()
+
+		threading.Thread(target=run, daemon=True).start()
+
+	def sample(self, k, bias=None):
+		"""
+		随机抽取k个不重复的图片id
+		:param k: 数量
+		:param bias: None为均匀抽样，recent偏向新上传的图片，popular按收藏数加权
+		:return: 图片id列表，图片不足k张时返回全部
+		"""
+		if self.loaded_at is None:
+			self.refresh()
+		elif time.time() - self.loaded_at > self.ttl:
+			self._refresh_async()
+
+		with self.lock:
+			ids = self.ids
+			weights = self.weights
+			removed = self.removed
+		n = len(ids)
+		available = n - len(removed)
+		if available <= 0:
+			return []
+		k = min(k, available)
+		result = []
+		seen = set()
+		# 抽到已删除或者重复的图片时重新抽取，最多尝试的次数
+		attempts = k * 10
+		while len(result) < k and attempts > 0:
+			attempts -= 1
+			if bias == 'recent':
+				# 下标集中在数组末尾，即id较大的新图片
+				index = n - 1 - int(n * random.random() ** 2)
+			elif bias == 'popular' and len(weights) == n:
+				index = bisect_right(weights, random.random() * weights[-1])
+			else:
+				index = random.randrange(n)
+			photo_id = ids[min(index, n - 1)]
+			if photo_id in removed or photo_id in seen:
+				continue
+			seen.add(photo_id)
+			result.append(photo_id)
+		return result
+
+	def _contains(self, photo_id):
+		index = bisect_left(self.ids, photo_id)
+		return index < len(self.ids) and self.ids[index] == photo_id
+
+	def add(self, photo_id):
+		"""
+		上传了新图片
+		其他进程上传的图片id可能小于数组中最大的id，按顺序插入，不等到重新加载
+		"""
+		with self.lock:
+			if self.loaded_at is None:
+				return
+			if self._contains(photo_id):
+				self.removed.discard(photo_id)
+				return
+			if not self.ids or photo_id > self.ids[-1]:
+				self.ids.append(photo_id)
+				self.weights.append((self.weights[-1] if self.weights else 0.0) + 1)
+				return
+			# 插入到中间时后面的累积权重都要加1，生成新的数组，不影响正在抽样的请求
+			index = bisect_left(self.ids, photo_id)
+			ids = self.ids[:index]
+			ids.append(photo_id)
+			ids.extend(self.ids[index:])
+			weights = self.weights[:index]
+			weights.append((weights[-1] if weights else 0.0) + 1)
+			weights.extend(weight + 1 for weight in self.weights[index:])
+			self.ids = ids
+			self.weights = weights
+
+	def remove(self, photo_id):
+		"""
+		删除了图片
+		"""
+		with self.lock:
+			if self.loaded_at is not None and self._contains(photo_id):
+				self.removed.add(photo_id)
+
+
+def get_explore_sampler():
+	"""
+	当前程序的发现页面抽样器
+	"""
+	sampler = current_app.extensions.get('albumy_explore_sampler')
+	if sampler is None:
+		sampler = current_app.extensions['albumy_explore_sampler'] = \
+			ExploreSampler(current_app.config['ALBUMY_EXPLORE_SAMPLER_TTL'])
+	return sampler
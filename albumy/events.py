@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+实时消息
+进程内的发布订阅：每个SSE连接订阅当前用户，未读消息数量变化时发布新的数量
+连接总数、每个用户的连接数以及每个连接的待发送事件都有上限，超过时拒绝连接，客户端改为轮询
+事件只在当前进程中发布，需要使用单个协程worker运行，例如gunicorn -k eventlet -w 1
+"""
+import json
+import queue
+import threading
+import time
+
+from flask import current_app
+
+from albumy.extensions import db
+from albumy.models import User
+
+
+class Subscription(object):
+	"""
+	一个SSE连接
+	"""
+
+	def __init__(self, user_id, size):
+		self.user_id = user_id
+		self.queue = queue.Queue(size)
+
+	def put(self, event):
+		"""
+		放入事件，队列满时丢弃最早的事件，事件中是最新的数量，只需要最后一个
+		"""
+		while True:
+			try:
+				self.queue.put_nowait(event)
+				return
+			except queue.Full:
+				try:
+					self.queue.get_nowait()
+				except queue.Empty:
+					pass
+
+	def get(self, timeout):
+		"""
+		等待下一个事件，超时返回None
+		"""
+		try:
+			return self.queue.get(timeout=timeout)
+		except queue.Empty:
+			return None
+
+
+class EventBroker(object):
+	"""
+	用户id与连接的对应关系
+	"""
+
+	def __init__(self, app):
+		self.app = app
+		self.subscriptions = {}
+		self.count = 0
+		self.lock = threading.Lock()
+
+	def subscribe(self, user_id):
+		"""
+		:return: Subscription，连接数超过上限时返回None
+		"""
+		with self.lock:
+			subscriptions = self.subscriptions.setdefault(user_id, set())
+			if self.count >= self.app.config['ALBUMY_STREAM_MAX_CONNECTIONS'] or \
+					len(subscriptions) >= self.app.config['ALBUMY_STREAM_MAX_PER_USER']:
+				if not subscriptions:
+					del self.subscriptions[user_id]
+				return None
+			subscription = Subscription(user_id, self.app.config['ALBUMY_STREAM_QUEUE_SIZE'])
+			subscriptions.add(subscription)
+			self.count += 1
+			return subscription
+
+	def unsubscribe(self, subscription):
+		with self.lock:
+			subscriptions = self.subscriptions.get(subscription.user_id)
+			if subscriptions is None or subscription not in subscriptions:
+				return
+			subscriptions.discard(subscription)
+			self.count -= 1
+			if not subscriptions:
+				del self.subscriptions[subscription.user_id]
+
+	def subscribed(self, user_ids):
+		"""
+		有连接的用户id
+		"""
+		with self.lock:
+			return [user_id for user_id in user_ids if user_id in self.subscriptions]
+
+	def publish(self, user_id, event):
+		"""
+		发送事件给用户的所有连接
+		:param event: format_event生成的字符串
+		"""
+		with self.lock:
+			subscriptions = list(self.subscriptions.get(user_id, ()))
+		for subscription in subscriptions:
+			subscription.put(event)
+
+
+def get_event_broker():
+	"""
+	当前程序的事件发布
+	"""
+	broker = current_app.extensions.get('albumy_events')
+	if broker is None:
+		broker = current_app.extensions['albumy_events'] = EventBroker(current_app._get_current_object())
+	return broker
+
+
+def format_event(name, data):
+	"""
+	SSE格式的事件
+	"""
+	return 'event: %s\ndata: %s\n\n' % (name, json.dumps(data))
+
+
+def unread_event(count):
+	return format_event('notification', {'count': count or 0})
+
+
+def publish_unread(user_ids):
+	"""
+	未读消息数量变化后，在事务提交之后调用，只查询有连接的用户
+	:param user_ids: 用户id列表
+	"""
+	broker = get_event_broker()
+	user_ids = broker.subscribed(set(user_ids))
+	if not user_ids:
+		return
+	for user_id, count in db.session.query(User.id, User.unread_count).filter(User.id.in_(user_ids)):
+		broker.publish(user_id, unread_event(count))
+
+
+def stream_events(broker, subscription, first_event):
+	"""
+	SSE响应的内容，没有事件时定时发送注释保持连接
+	超过ALBUMY_STREAM_TIMEOUT秒后结束，由浏览器重新连接，清理已经断开但没有检测到的连接
+	不使用数据库和请求上下文，连接不会占用数据库连接；连接关闭时由视图取消订阅
+	"""
+	config = broker.app.config
+	deadline = time.monotonic() + config['ALBUMY_STREAM_TIMEOUT']
+	# 浏览器断开后重新连接的等待时间
+	yield 'retry: %d\n\n' % (config['ALBUMY_STREAM_RETRY'] * 1000)
+	yield first_event
+	while time.monotonic() < deadline:
+		event = subscription.get(config['ALBUMY_STREAM_HEARTBEAT'])
+		yield ': heartbeat\n\n' if event is None else event
@@ -1,14 +1,13 @@
 # -*- coding: utf-8 -*-
-import os
 import random
 
 from PIL import Image
 from faker import Faker
-from flask import current_app
 from sqlalchemy.exc import IntegrityError
 
 from albumy.extensions import db
 from albumy.models import User, Photo, Tag, Comment, Notification
+from albumy.storage import media_path, get_storage
 
 fake = Faker()
 
@@ -90,8 +89,8 @@ def fake_photo(count=30):
 	"""
 	照片
 	"""
-	# 上传路径，从配置文件中读取
-	upload_path = current_app.config["ALBUMY_UPLOAD_PATH"]
+	# 先保存在本地目录，再放入存储
+	storage = get_storage("uploads")
 	for i in range(count):
 		print(i)
 
@@ -101,7 +100,9 @@ def fake_photo(count=30):
 		# 根据颜色得到图片对象
 		img = Image.new(mode="RGB", size=(800, 800), color=(r(), r(), r()))
 		# 保存图片
-		img.save(os.path.join(upload_path, filename))
+		path = media_path(storage.directory, filename, create=True)
+		img.save(path)
+		storage.put(filename, path)
 
 		# 创建Photo对象，并保存到数据库
 		photo = Photo(
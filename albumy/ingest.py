@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+上传文件的流式接收
+解析multipart时直接把每一块数据写入上传目录下的临时文件，同时计算哈希值并检查文件头
+不是图片的文件在读取完请求之前就会被拒绝，保存时只需要把临时文件重命名
+批量上传时，无效的文件只标记错误，不会中断整个请求
+"""
+import hashlib
+import os
+import tempfile
+
+from flask import Request, current_app
+from werkzeug.exceptions import UnsupportedMediaType, RequestEntityTooLarge
+
+# 文件头与图片格式
+SIGNATURES = (
+	(b'\xff\xd8\xff', 'jpeg'),
+	(b'\x89PNG\r\n\x1a\n', 'png'),
+	(b'GIF87a', 'gif'),
+	(b'GIF89a', 'gif'),
+	(b'BM', 'bmp'),
+)
+# 判断格式需要的字节数
+HEADER_SIZE = 12
+
+
+def sniff_image(header):
+	"""
+	根据文件头判断图片格式
+	:param header: 文件开头的字节
+	:return: 格式名称，不是图片时返回None
+	"""
+	for signature, kind in SIGNATURES:
+		if header.startswith(signature):
+			return kind
+	if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+		return 'webp'
+	return None
+
+
+class IngestFile(object):
+	"""
+	上传文件的临时文件，写入时计算SHA-256并检查文件头
+	没有保存的临时文件在请求结束时删除
+	"""
+
+	def __init__(self, directory, max_size, strict=True):
+		"""
+		:param directory: 临时文件所在目录
+		:param max_size: 单个文件的大小上限
+		:param strict: 文件无效时是否直接拒绝请求，否则记录在error中
+		"""
+		os.makedirs(directory, exist_ok=True)
+		# 临时文件与上传目录在同一个文件系统中，保存时重命名是原子操作
+		fd, self.path = tempfile.mkstemp(prefix='.upload-', suffix='.part', dir=directory)
+		self.file = os.fdopen(fd, 'w+b')
+		self.max_size = max_size
+		self.strict = strict
+		self.size = 0
+		self.sha256 = hashlib.sha256()
+		self.header = b''
+		# 图片格式
+		self.kind = None
+		# 错误信息，有错误时不再写入
+		self.error = None
+		self.saved = False
+
+	def write(self, data):
+		if self.error is not None:
+			return len(data)
+		if self.kind is None:
+			self.header += data[:HEADER_SIZE]
+			if len(self.header) >= HEADER_SIZE:
+				self.kind = sniff_image(self.header)
+				if self.kind is None:
+					return self._reject(UnsupportedMediaType('只能上传图片。'), data)
+		self.size += len(data)
+		if self.size > self.max_size:
+			return self._reject(RequestEntityTooLarge('文件太大。'), data)
+		self.sha256.update(data)
+		return self.file.write(data)
+
+	def _reject(self, error, data):
+		"""
+		文件无效，删除临时文件
+		"""
+		self.close()
+		if self.strict:
+			raise error
+		self.error = error.description
+		return len(data)
+
+	def hexdigest(self):
+		"""
+		文件内容的SHA-256
+		"""
+		return self.sha256.hexdigest()
+
+	def save(self, path):
+		"""
+		把临时文件重命名为path
+		"""
+		self.file.flush()
+		self.file.close()
+		os.replace(self.path, path)
+		self.saved = True
+
+	def close(self):
+		if not self.file.closed:
+			self.file.close()
+		if not self.saved and os.path.exists(self.path):
+			os.remove(self.path)
+
+	# FileStorage和PIL需要的其他文件方法
+	def read(self, *args):
+		return self.file.read(*args)
+
+	def readline(self, *args):
+		return self.file.readline(*args)
+
+	def seek(self, *args):
+		# 解析完一个文件后会调用seek(0)，被拒绝的文件已经关闭
+		if self.error is not None:
+			return 0
+		return self.file.seek(*args)
+
+	def tell(self):
+		return self.file.tell()
+
+	def flush(self):
+		return self.file.flush()
+
+	@property
+	def closed(self):
+		return self.file.closed
+
+
+def batch_upload(f):
+	"""
+	批量上传的视图函数使用，放在route下面：请求大小上限为ALBUMY_BATCH_MAX_CONTENT_LENGTH，
+	单个文件无效时只记录在IngestFile.error中
+	"""
+	f.batch_upload = True
+	return f
+
+
+class IngestRequest(Request):
+	"""
+	上传的文件使用IngestFile接收
+	"""
+
+	@property
+	def batch_upload(self):
+		"""
+		是否是批量上传的请求
+		"""
+		view = current_app.view_functions.get(self.endpoint)
+		return getattr(view, 'batch_upload', False)
+
+	@property
+	def max_content_length(self):
+		if current_app and self.batch_upload:
+			return current_app.config['ALBUMY_BATCH_MAX_CONTENT_LENGTH']
+		return super(IngestRequest, self).max_content_length
+
+	def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+		stream = IngestFile(current_app.config['ALBUMY_UPLOAD_PATH'], current_app.config['ALBUMY_UPLOAD_MAX_FILE_SIZE'],
+							strict=not self.batch_upload)
+		# 解析中途出错时，文件不会出现在request.files中，在这里记录下来，请求结束时删除
+		self.__dict__.setdefault('ingest_files', []).append(stream)
+		return stream
+
+	def close(self):
+		super(IngestRequest, self).close()
+		for stream in self.__dict__.get('ingest_files', ()):
+			stream.close()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+图片和头像文件的发送
+文件名是随机生成的，同一个文件名的内容永远不会改变，所以可以让浏览器和CDN永久缓存
+ETag只由文件名计算，带有If-None-Match的请求直接返回304，不需要访问磁盘
+文件保存在分层目录或者对象存储中，URL中只有文件名，见storage.py
+"""
+import hashlib
+import mimetypes
+import os
+
+from flask import current_app, request, send_file, Response, abort, safe_join, redirect
+
+from albumy.settings import ALTERNATE_FORMATS
+from albumy.storage import locate_media
+
+# 旧版本的Python不认识这些后缀
+for mimetype, ext, fmt in ALTERNATE_FORMATS:
+	mimetypes.add_type(mimetype, ext)
+
+
+def media_etag(filename):
+	"""
+	由文件名计算强ETag
+	"""
+	return hashlib.sha1(filename.encode('utf-8')).hexdigest()
+
+
+def cache_headers(response, etag):
+	"""
+	设置永久缓存的响应头
+	"""
+	response.set_etag(etag)
+	response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % current_app.config['ALBUMY_MEDIA_MAX_AGE']
+	return response
+
+
+def send_media(directory, filename, location, etag=None):
+	"""
+	发送图片文件
+	:param directory: 文件所在目录
+	:param filename: 文件名，可以包含子目录
+	:param location: X-Accel-Redirect模式下，文件在nginx内部location中的目录，例如uploads
+	:param etag: 默认由文件名计算
+	"""
+	if etag is None:
+		etag = media_etag(filename)
+	# 文件内容不会改变，ETag匹配就说明浏览器缓存的就是最新的文件
+	if etag in request.if_none_match:
+		return cache_headers(Response(status=304), etag)
+
+	# 文件名跳出目录时safe_join会返回404
+	safe_join(directory, filename)
+	path = locate_media(directory, filename)
+	if path is None:
+		abort(404)
+
+	offload = current_app.config['ALBUMY_MEDIA_OFFLOAD']
+	if offload is not None:
+		# 只返回响应头，由前端服务器发送文件，Range等也由前端服务器处理
+		response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+		if offload == 'x-accel-redirect':
+			# nginx，需要配置internal的location
+			response.headers['X-Accel-Redirect'] = '%s%s/%s' % (
+				current_app.config['ALBUMY_MEDIA_ACCEL_PREFIX'], location,
+				os.path.relpath(path, directory).replace(os.sep, '/'))
+		else:
+			# Apache(mod_xsendfile)或lighttpd
+			response.headers['X-Sendfile'] = path
+		return cache_headers(response, etag)
+
+	response = send_file(path, add_etags=False, conditional=False)
+	cache_headers(response, etag)
+	# 支持Range请求，大图可以断点续传，make_conditional只在206响应中设置Accept-Ranges
+	response.headers['Accept-Ranges'] = 'bytes'
+	return response.make_conditional(request, accept_ranges=True, complete_length=os.path.getsize(path))
+
+
+def send_stored(storage, filename, location, etag=None):
+	"""
+	发送存储中的文件
+	本地文件由send_media发送，对象存储中的文件重定向到预签名的地址，或者由程序转发
+	:param storage: storage.get_storage返回的存储
+	"""
+	if etag is None:
+		etag = media_etag(filename)
+	if etag in request.if_none_match:
+		return cache_headers(Response(status=304), etag)
+	safe_join(storage.directory, filename)
+	if storage.path(filename) is not None:
+		return send_media(storage.directory, filename, location, etag)
+
+	if current_app.config['ALBUMY_STORAGE_REDIRECT']:
+		url = storage.url(filename, current_app.config['ALBUMY_STORAGE_URL_EXPIRES'])
+		if url is not None:
+			response = redirect(url)
+			# 预签名地址会过期，重定向只能缓存一段时间
+			response.headers['Cache-Control'] = 'private, max-age=%d' % (
+				current_app.config['ALBUMY_STORAGE_URL_EXPIRES'] // 2)
+			return response
+	# 不存在时由GET请求返回404，不需要先发送HEAD请求
+	try:
+		size, chunks = storage.stream(filename)
+	except FileNotFoundError:
+		abort(404)
+	response = Response(chunks, direct_passthrough=True,
+						mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+	response.content_length = size
+	return cache_headers(response, etag)
+
+
+def send_negotiated(storage, filename, location):
+	"""
+	发送缩略图，根据Accept从客户端支持的格式中选择文件最小的一个
+	缩略图生成时会按编码策略另外保存webp、avif等格式，见utils.save_image
+	对象存储的文件大小缓存在进程内，见storage.SizeCache
+	不是缩略图时与send_stored相同
+	"""
+	name, ext = os.path.splitext(filename)
+	if not name.endswith(tuple(current_app.config['ALBUMY_PHOTO_SUFFIX'].values())):
+		return send_stored(storage, filename, location)
+
+	# 只接受明确列出的格式，*/*不算
+	accepted = set(value for value, quality in request.accept_mimetypes if quality > 0)
+	candidates = [name + alt_ext for mimetype, alt_ext, fmt in ALTERNATE_FORMATS if mimetype in accepted]
+	candidates.append(filename)
+	# 浏览器缓存了任何一个候选文件都可以直接使用
+	for candidate in candidates:
+		etag = media_etag(candidate)
+		if etag in request.if_none_match:
+			response = cache_headers(Response(status=304), etag)
+			break
+	else:
+		sizes = []
+		for candidate in candidates:
+			size = storage.size(candidate)
+			if size is not None:
+				sizes.append((size, candidate))
+		response = send_stored(storage, min(sizes)[1] if sizes else filename, location)
+	response.vary.add('Accept')
+	return response
@@ -1,13 +1,17 @@
 # -*- coding: utf-8 -*-
 import os
+import random
 from datetime import datetime
 
-from flask import current_app
+from flask import current_app, request, has_request_context
 from flask_avatars import Identicon
 from flask_login import UserMixin
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from albumy.extensions import db, whooshee
+from albumy.settings import ThumbnailStatus, ALTERNATE_FORMATS
+from albumy.storage import get_storage
 
 # 关联表，关联Role和Permission
 roles_permissions = db.Table(
@@ -82,6 +86,33 @@ class Role(db.Model):
 				# 追加到Role对象下
 				role.permissions.append(permission)
 		db.session.commit()
+		Role.invalidate_permissions()
+
+	@staticmethod
+	def permissions_of(role_id):
+		"""
+		角色拥有的权限名称
+		角色和权限的对应关系在每个进程中只查询一次，保存在current_app.extensions中
+		:param role_id: 角色id
+		:return: frozenset
+		"""
+		permission_map = current_app.extensions.get("albumy_permissions")
+		if permission_map is None:
+			permission_map = {}
+			for rid, name in db.session.query(roles_permissions.c.role_id, Permission.name).join(
+					Permission, Permission.id == roles_permissions.c.permission_id
+			):
+				permission_map.setdefault(rid, set()).add(name)
+			permission_map = dict((rid, frozenset(names)) for rid, names in permission_map.items())
+			current_app.extensions["albumy_permissions"] = permission_map
+		return permission_map.get(role_id, frozenset())
+
+	@staticmethod
+	def invalidate_permissions():
+		"""
+		角色的权限修改后，清空缓存
+		"""
+		current_app.extensions.pop("albumy_permissions", None)
 
 
 class Follow(db.Model):
@@ -147,6 +178,8 @@ class User(db.Model, UserMixin):
 	locked = db.Column(db.Boolean, default=False)
 	# 是否允许登录，禁止登录
 	active = db.Column(db.Boolean, default=True)
+	# 账号正在后台删除，不再显示，见accounts.py
+	deleting = db.Column(db.Boolean, default=False, index=True)
 	# 关注
 	public_collections = db.Column(db.Boolean, default=True)
 	# 是否接收评论提醒
@@ -155,6 +188,17 @@ class User(db.Model, UserMixin):
 	receive_follow_notification = db.Column(db.Boolean, default=True)
 	# 是否接收收藏提醒
 	receive_collect_notification = db.Column(db.Boolean, default=True)
+	# 计数器，由监听器维护，可以使用flask recount重建
+	# 上传图片数量
+	photo_count = db.Column(db.Integer, default=0)
+	# 收藏图片数量
+	collection_count = db.Column(db.Integer, default=0)
+	# 粉丝数量，不包括自己
+	follower_count = db.Column(db.Integer, default=0)
+	# 关注数量，不包括自己
+	following_count = db.Column(db.Integer, default=0)
+	# 未读消息数量
+	unread_count = db.Column(db.Integer, default=0)
 
 	role_id = db.Column(db.Integer, db.ForeignKey("role.id"))
 
@@ -162,7 +206,7 @@ class User(db.Model, UserMixin):
 	photos = db.relationship("Photo", back_populates="author", cascade="all")
 	comments = db.relationship("Comment", back_populates="author", cascade="all")
 	notifications = db.relationship(
-		"Notification", back_populates="receiver", cascade="all"
+		"Notification", foreign_keys="Notification.receiver_id", back_populates="receiver", cascade="all"
 	)
 	collections = db.relationship("Collect", back_populates="collector", cascade="all")
 	following = db.relationship(
@@ -221,6 +265,11 @@ class User(db.Model, UserMixin):
 			follow = Follow(follower=self, followed=user)
 			db.session.add(follow)
 			db.session.commit()
+			# 回填被关注者的图片到自己的时间线
+			TimelineEntry.backfill(self.id, user.id)
+			state = _viewer_state(self.id)
+			if state is not None:
+				state.set_following(user.id, True)
 
 	def unfollow(self, user):
 		"""
@@ -230,6 +279,11 @@ class User(db.Model, UserMixin):
 		if follow:
 			db.session.delete(follow)
 			db.session.commit()
+			# 从时间线中移除被关注者的图片
+			TimelineEntry.remove(self.id, user.id)
+			state = _viewer_state(self.id)
+			if state is not None:
+				state.set_following(user.id, False)
 
 	def is_following(self, user):
 		"""
@@ -237,10 +291,29 @@ class User(db.Model, UserMixin):
 		"""
 		if user.id is None:
 			return False
+		# 先从本次请求批量查询的结果中读取
+		state = _viewer_state(self.id)
+		known = state.is_following(user.id) if state is not None else None
+		if known is None:
+			state = _viewer_state(user.id)
+			known = state.is_followed_by(self.id) if state is not None else None
+		if known is not None:
+			return known
 		return self.following.filter_by(followed_id=user.id).first() is not None
 
 	def is_followed_by(self, user):
-		# TODO
+		"""
+		判断是否被user关注
+		"""
+		if user.id is None:
+			return False
+		state = _viewer_state(self.id)
+		known = state.is_followed_by(user.id) if state is not None else None
+		if known is None:
+			state = _viewer_state(user.id)
+			known = state.is_following(self.id) if state is not None else None
+		if known is not None:
+			return known
 		return self.followers.filter_by(follower_id=user.id).first() is not None
 
 	@property
@@ -258,6 +331,9 @@ class User(db.Model, UserMixin):
 			collect = Collect(collector=self, collected=photo)
 			db.session.add(collect)
 			db.session.commit()
+			state = _viewer_state(self.id)
+			if state is not None:
+				state.set_collecting(photo.id, True)
 
 	def uncollect(self, photo):
 		"""
@@ -269,11 +345,19 @@ class User(db.Model, UserMixin):
 		if collect:
 			db.session.delete(collect)
 			db.session.commit()
+			state = _viewer_state(self.id)
+			if state is not None:
+				state.set_collecting(photo.id, False)
 
 	def is_collecting(self, photo):
 		"""
 		判断是否收藏
 		"""
+		# 先从本次请求批量查询的结果中读取
+		state = _viewer_state(self.id)
+		known = state.is_collecting(photo.id) if state is not None else None
+		if known is not None:
+			return known
 		return (
 				Collect.query.with_parent(self).filter_by(collected_id=photo.id).first()
 				is not None
@@ -306,6 +390,9 @@ class User(db.Model, UserMixin):
 	def generate_avatar(self):
 		avatar = Identicon()
 		filenames = avatar.generate(text=self.username)
+		# flask-avatars保存在头像目录的根目录中，移动到存储中
+		storage = get_storage("avatars")
+		storage.put_many([(filename, os.path.join(storage.directory, filename)) for filename in filenames])
 		self.avatar_s = filenames[0]
 		self.avatar_m = filenames[1]
 		self.avatar_l = filenames[2]
@@ -330,13 +417,33 @@ class User(db.Model, UserMixin):
 	def can(self, permission_name):
 		"""
 		判断权限问题，是否有权限做某事
+		权限从进程内的缓存中读取，不需要查询数据库
 		"""
-		permission = Permission.query.filter_by(name=permission_name).first()
-		return (
-				permission is not None
-				and self.role is not None
-				and permission in self.role.permissions
-		)
+		role_id = self.role_id
+		if role_id is None and self.role is not None:
+			role_id = self.role.id
+		return role_id is not None and permission_name in Role.permissions_of(role_id)
+
+
+def _viewer_state(user_id):
+	"""
+	本次请求中user_id对应的ViewerState（见albumy.viewer），没有则返回None
+	"""
+	if not has_request_context():
+		return None
+	state = getattr(request, "viewer_state", None)
+	if state is not None and state.user_id == user_id:
+		return state
+	return None
+
+
+def exclude_deleting(query, user_id):
+	"""
+	过滤掉正在注销的用户以及他们的数据，账号在后台删除完成之前就不再显示
+	:param query: 查询
+	:param user_id: 查询中对应用户id的列，例如Photo.author_id、Follow.follower_id
+	"""
+	return query.join(User, User.id == user_id).filter_by(deleting=False)
 
 
 tagging = db.Table(
@@ -357,12 +464,18 @@ class Photo(db.Model):
 	filename_s = db.Column(db.String(64))
 	# 中图
 	filename_m = db.Column(db.String(64))
+	# 缩略图状态，生成之前filename_s和filename_m都是原图的文件名
+	thumbnail_status = db.Column(db.String(10), default=ThumbnailStatus.READY, index=True)
 	# 时间
 	timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 	# 是否可评论
 	can_comment = db.Column(db.Boolean, default=True)
 	# 被举报次数
 	flag = db.Column(db.Integer, default=0)
+	# 被收藏次数
+	collect_count = db.Column(db.Integer, default=0)
+	# 评论数量
+	comment_count = db.Column(db.Integer, default=0)
 	# 用户
 	author_id = db.Column(db.Integer, db.ForeignKey("user.id"))
 
@@ -374,6 +487,67 @@ class Photo(db.Model):
 	tags = db.relationship("Tag", secondary=tagging, back_populates="photos")
 
 
+class Blob(db.Model):
+	"""
+	按内容哈希保存的原图文件，相同的图片只保存一份，多个Photo共用同一个filename
+	"""
+	# 文件内容的SHA-256
+	hash = db.Column(db.String(64), primary_key=True)
+	# 原图文件名
+	filename = db.Column(db.String(64), unique=True)
+	# 引用该文件的图片数量，由Photo的监听器维护
+	refcount = db.Column(db.Integer, default=0)
+
+	@staticmethod
+	def add(digest, filename, path):
+		"""
+		写入新保存的原图，在保存点中插入，冲突时不影响同一个事务中的其他数据
+		相同的图片同时上传时另一个请求已经写入了Blob，删除刚刚保存的文件，使用已有的Blob
+		:param digest: 文件内容的SHA-256
+		:param filename: 原图文件名
+		:param path: 刚刚保存的原图路径
+		:return: (Blob, 是否新写入)
+		"""
+		blob = Blob(hash=digest, filename=filename, refcount=0)
+		try:
+			with db.session.begin_nested():
+				db.session.add(blob)
+		except IntegrityError:
+			os.remove(path)
+			return Blob.query.get(digest), False
+		return blob, True
+
+
+class FileDeletion(db.Model):
+	"""
+	待删除文件的发件箱
+	删除图片或用户时在同一个事务中写入，提交后由reaper.py在后台分批删除文件，事务回滚时文件保留
+	"""
+	__tablename__ = "file_deletion"
+	id = db.Column(db.Integer, primary_key=True)
+	# 存储区域，uploads或avatars，见storage.get_storage
+	area = db.Column(db.String(16))
+	# 文件名
+	name = db.Column(db.String(255))
+	timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+	# 删除失败的次数
+	attempts = db.Column(db.Integer, default=0)
+
+	@staticmethod
+	def defer(session, connection, area, names):
+		"""
+		记录需要删除的文件，提交后唤醒reaper
+		:param session: 执行删除的会话
+		:param connection: 当前事务的连接
+		"""
+		names = sorted(set(name for name in names if name is not None))
+		if not names:
+			return
+		connection.execute(FileDeletion.__table__.insert(), [{"area": area, "name": name} for name in names])
+		if session is not None:
+			session.info["albumy_file_deletions"] = True
+
+
 @whooshee.register_model("name")
 class Tag(db.Model):
 	"""
@@ -382,6 +556,8 @@ class Tag(db.Model):
 	id = db.Column(db.Integer, primary_key=True)
 	# 标签名称
 	name = db.Column(db.String(64), index=True, unique=True)
+	# 标签下的图片数量
+	photo_count = db.Column(db.Integer, default=0)
 
 	photos = db.relationship("Photo", secondary=tagging, back_populates="tags")
 
@@ -408,54 +584,500 @@ class Comment(db.Model):
 	replies = db.relationship("Comment", back_populates="replied", cascade="all")
 	replied = db.relationship("Comment", back_populates="replies", remote_side=[id])
 
+	@staticmethod
+	def eager_options():
+		"""
+		显示评论时需要的作者、被回复的评论及其作者，和评论一起查询
+		"""
+		return (
+			db.joinedload(Comment.author),
+			db.joinedload(Comment.replied).joinedload(Comment.author),
+		)
+
+	@staticmethod
+	def load_threads(roots):
+		"""
+		使用一个递归CTE查询评论下的所有回复，按楼层展开
+		:param roots: 顶层评论列表
+		:return: (评论, 层级)的列表，回复紧跟在被回复的评论后面
+		"""
+		root_ids = [comment.id for comment in roots]
+		if not root_ids:
+			return []
+		tree = db.session.query(Comment.id).filter(Comment.replied_id.in_(root_ids)).cte("comment_tree", recursive=True)
+		reply = db.aliased(Comment)
+		tree = tree.union_all(db.session.query(reply.id).filter(reply.replied_id == tree.c.id))
+		# 被回复的评论都在同一次查询中，Comment.replied直接从会话中取得
+		replies = (
+			Comment.query.join(tree, Comment.id == tree.c.id)
+				.options(db.joinedload(Comment.author))
+				.order_by(Comment.timestamp.asc(), Comment.id.asc())
+				.all()
+		)
+		children = {}
+		for comment in replies:
+			children.setdefault(comment.replied_id, []).append(comment)
+
+		threads = []
+		stack = [(comment, 0) for comment in reversed(roots)]
+		while stack:
+			comment, depth = stack.pop()
+			threads.append((comment, depth))
+			stack.extend((child, depth + 1) for child in reversed(children.get(comment.id, ())))
+		return threads
+
 
 class Notification(db.Model):
 	"""
 	消息提醒
+	关注、收藏、评论的消息只保存类型、用户和对象，显示时再生成内容，见notifications.render_messages
+	一段时间内同一个对象的同类事件合并为一条消息，记录合并的数量
 	"""
 	id = db.Column(db.Integer, primary_key=True)
-	# 消息内容
-	message = db.Column(db.Text, nullable=False)
+	# 消息内容，只有系统消息和旧的消息使用
+	message = db.Column(db.Text)
+	# 类型，follow、collect或comment
+	kind = db.Column(db.String(16))
+	# 最后一个触发消息的用户
+	actor_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+	# 对象id，关注时为被关注的用户，收藏和评论时为图片
+	object_id = db.Column(db.Integer)
+	# 合并的不同用户的数量
+	actor_count = db.Column(db.Integer, default=1)
 	# 是否已阅读
 	is_read = db.Column(db.Boolean, default=False)
-	# 时间
+	# 最后一个事件的时间
 	timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+	# 第一个事件的时间，超过合并时间后产生新的消息
+	first_timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 	# 接收者的id
 	receiver_id = db.Column(db.Integer, db.ForeignKey("user.id"))
 
-	receiver = db.relationship("User", back_populates="notifications")
+	receiver = db.relationship("User", foreign_keys=[receiver_id], back_populates="notifications")
+	actors = db.relationship("NotificationActor", cascade="all, delete-orphan")
+
+	# 消息页面和一键已读按接收者和是否已读查询，按时间排序
+	__table_args__ = (db.Index("ix_notification_receiver_read_timestamp", "receiver_id", "is_read", "timestamp"),)
+
+
+class NotificationActor(db.Model):
+	"""
+	合并了多个用户的消息中的所有用户，同一个用户只计算一次
+	只有一个用户的消息不写入，这个用户就是Notification.actor_id
+	"""
+	__tablename__ = "notification_actor"
+	notification_id = db.Column(db.Integer, db.ForeignKey("notification.id"), primary_key=True)
+	actor_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+
+
+class TimelineEntry(db.Model):
+	"""
+	主页时间线（写扩散）
+	上传图片时把图片写入作者所有关注者的时间线，主页只需按user_id读取，不再需要Photo JOIN Follow
+	"""
+	__tablename__ = "timeline"
+	# 时间线所属用户
+	user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+	# 图片id
+	photo_id = db.Column(db.Integer, db.ForeignKey("photo.id"), primary_key=True)
+	# 冗余图片的上传时间，用于排序
+	timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+	photo = db.relationship("Photo", lazy="joined")
+
+	__table_args__ = (db.Index("ix_timeline_user_timestamp", "user_id", "timestamp"),)
+
+	@staticmethod
+	def push(photo):
+		"""
+		把新上传的图片写入作者所有关注者（包括作者自己）的时间线
+		:param photo: 已提交的Photo对象
+		"""
+		followers = db.select(
+			[Follow.follower_id, db.literal(photo.id), db.literal(photo.timestamp)]
+		).where(Follow.followed_id == photo.author_id)
+
+		def write():
+			TimelineEntry._insert_new(followers)
+			TimelineEntry._trim_receivers(
+				db.select([Follow.follower_id]).where(Follow.followed_id == photo.author_id))
+
+		TimelineEntry._write(write)
+
+	@staticmethod
+	def push_many(author_id, photos):
+		"""
+		把同一个作者批量上传的图片写入关注者的时间线，只查询一次关注者
+		:param author_id: 作者id
+		:param photos: 已提交的Photo对象列表
+		"""
+		followers = [follower_id for (follower_id,) in db.session.query(Follow.follower_id)
+					 .filter(Follow.followed_id == author_id)]
+		entries = [{"_user_id": follower_id, "_photo_id": photo.id, "_timestamp": photo.timestamp}
+				   for follower_id in followers for photo in photos]
+		if not entries:
+			return
+		# 一次executemany，每一行都跳过已经存在的数据
+		row = db.select([
+			db.bindparam("_user_id", type_=db.Integer),
+			db.bindparam("_photo_id", type_=db.Integer),
+			db.bindparam("_timestamp", type_=db.DateTime),
+		])
+
+		def write():
+			TimelineEntry._insert_new(row, entries)
+			TimelineEntry._trim_receivers(followers)
+
+		TimelineEntry._write(write)
+
+	@staticmethod
+	def _insert_new(select, params=None):
+		"""
+		INSERT ... SELECT，跳过时间线中已经存在的数据
+		:param select: 依次选出user_id、photo_id、timestamp的查询
+		:param params: executemany的参数列表
+		"""
+		table = TimelineEntry.__table__
+		source = select.alias("source")
+		user_id, photo_id, timestamp = source.c
+		exists = db.exists().where(db.and_(table.c.user_id == user_id, table.c.photo_id == photo_id))
+		db.session.execute(
+			table.insert().from_select(
+				["user_id", "photo_id", "timestamp"], db.select([user_id, photo_id, timestamp]).where(~exists)
+			),
+			params,
+		)
+
+	@staticmethod
+	def _write(write):
+		"""
+		写入时间线并提交
+		关注时回填和上传图片可能同时写入同一条数据，插入时跳过已经存在的数据，仍然冲突时回滚重试一次
+		:param write: 执行写入的函数
+		"""
+		try:
+			write()
+			db.session.commit()
+		except IntegrityError:
+			db.session.rollback()
+			write()
+			db.session.commit()
+
+	@staticmethod
+	def _trim_receivers(user_ids):
+		"""
+		写入时间线之后整理接收者的时间线，平均每ALBUMY_TIMELINE_TRIM_EVERY次写入执行一次
+		两次整理之间多出来的数据在下次整理时删除
+		:param user_ids: 接收者id列表或者子查询
+		"""
+		every = current_app.config["ALBUMY_TIMELINE_TRIM_EVERY"]
+		if every and random.randrange(every) == 0:
+			TimelineEntry.trim_many(user_ids)
+
+	@staticmethod
+	def backfill(user_id, followed_id):
+		"""
+		关注用户后，把被关注者最新的图片回填到关注者的时间线
+		:param user_id: 关注者id
+		:param followed_id: 被关注者id
+		"""
+		def write():
+			TimelineEntry._insert_photos_of(user_id, followed_id)
+			TimelineEntry.trim(user_id)
+
+		TimelineEntry._write(write)
+
+	@staticmethod
+	def _insert_photos_of(user_id, followed_id):
+		"""
+		INSERT ... SELECT，把followed_id最新的图片写入user_id的时间线
+		"""
+		photos = (
+			db.select([db.literal(user_id), Photo.id, Photo.timestamp])
+				.where(Photo.author_id == followed_id)
+				.order_by(Photo.timestamp.desc(), Photo.id.desc())
+				.limit(current_app.config["ALBUMY_TIMELINE_SIZE"])
+		)
+		TimelineEntry._insert_new(photos)
+
+	@staticmethod
+	def remove(user_id, followed_id):
+		"""
+		取消关注后，从时间线中移除被关注者的图片
+		:param user_id: 关注者id
+		:param followed_id: 被关注者id
+		"""
+		photo_ids = db.select([Photo.id]).where(Photo.author_id == followed_id)
+		db.session.execute(
+			TimelineEntry.__table__.delete().where(
+				db.and_(
+					TimelineEntry.user_id == user_id,
+					TimelineEntry.photo_id.in_(photo_ids),
+				)
+			)
+		)
+		db.session.commit()
+
+	@staticmethod
+	def trim(user_id, size=None):
+		"""
+		只保留时间线中最新的size条数据
+		:param user_id: 用户id
+		:param size: 保留数量，默认为ALBUMY_TIMELINE_SIZE
+		"""
+		if size is None:
+			size = current_app.config["ALBUMY_TIMELINE_SIZE"]
+		# 第size条数据，与主页的游标分页使用相同的排序键(timestamp, photo_id)，同一时间上传的图片也能删除
+		# 先单独查询出来，DELETE中不引用时间线表本身的子查询，MySQL不支持
+		oldest = (
+			db.session.query(TimelineEntry.timestamp, TimelineEntry.photo_id)
+				.filter(TimelineEntry.user_id == user_id)
+				.order_by(TimelineEntry.timestamp.desc(), TimelineEntry.photo_id.desc())
+				.offset(size - 1)
+				.first()
+		)
+		if oldest is None:
+			return
+		timestamp, photo_id = oldest
+		db.session.execute(
+			TimelineEntry.__table__.delete().where(
+				db.and_(
+					TimelineEntry.user_id == user_id,
+					db.or_(
+						TimelineEntry.timestamp < timestamp,
+						db.and_(TimelineEntry.timestamp == timestamp, TimelineEntry.photo_id < photo_id),
+					),
+				)
+			)
+		)
+
+	@staticmethod
+	def trim_many(user_ids, size=None):
+		"""
+		整理多个用户的时间线，一次查询出超过size条数据的用户，再逐个整理
+		:param user_ids: 用户id列表或者子查询
+		:param size: 保留数量，默认为ALBUMY_TIMELINE_SIZE
+		"""
+		if size is None:
+			size = current_app.config["ALBUMY_TIMELINE_SIZE"]
+		users = (
+			db.session.query(TimelineEntry.user_id)
+				.filter(TimelineEntry.user_id.in_(user_ids))
+				.group_by(TimelineEntry.user_id)
+				.having(db.func.count() > size)
+				.all()
+		)
+		for (user_id,) in users:
+			TimelineEntry.trim(user_id, size)
+
+	@staticmethod
+	def rebuild():
+		"""
+		根据Follow表重建所有用户的时间线
+		"""
+		db.session.execute(TimelineEntry.__table__.delete())
+		for follower_id, followed_id in db.session.query(
+				Follow.follower_id, Follow.followed_id
+		).all():
+			TimelineEntry._insert_photos_of(follower_id, followed_id)
+		for (user_id,) in db.session.query(User.id).all():
+			TimelineEntry.trim(user_id)
+		db.session.commit()
 
 
 # 监听器，监听删除用户对象这个动作
-# 删除用户后，用户数据全部消息，同时从文件夹中删除用户头像
+# 删除用户后，用户数据全部消息，事务提交后删除用户头像
 @db.event.listens_for(User, "after_delete", named=True)
 def delete_avatars(**kwargs):
 	"""
 	删除头像
 	"""
 	target = kwargs["target"]
-	for filename in [
+	# avatar_raw(自定义头像)有可能为空，事务提交后才删除文件
+	FileDeletion.defer(db.object_session(target), kwargs["connection"], "avatars", [
 		target.avatar_s,
 		target.avatar_m,
 		target.avatar_l,
 		target.avatar_raw,
-	]:
-		# 需要加上判断，因为avatar_raw(自定义头像)有可能为空
-		if filename is not None:
-			# 头像路径
-			path = os.path.join(current_app.config["AVATARS_SAVE_PATH"], filename)
-			# 判断是否存在
-			if os.path.exists(path):
-				# 删除
-				os.remove(path)
+	])
+
+
+# 监听器，新增Photo对象时增加对应文件的引用数
+@db.event.listens_for(Photo, "after_insert", named=True)
+def increase_blob_refcount(**kwargs):
+	target = kwargs["target"]
+	table = Blob.__table__
+	kwargs["connection"].execute(
+		table.update().where(table.c.filename == target.filename).values(refcount=table.c.refcount + 1)
+	)
 
 
 # 监听器，监听删除Photo对象这个操作
 @db.event.listens_for(Photo, "after_delete", named=True)
 def delete_photos(**kwargs):
 	target = kwargs["target"]
-	# 删除文件夹中所有的图片
-	for filename in [target.filename, target.filename_s, target.filename_m]:
-		path = os.path.join(current_app.config["ALBUMY_UPLOAD_PATH"], filename)
-		if os.path.exists(path):  # not every filename map a unique file
-			os.remove(path)
+	connection = kwargs["connection"]
+	table = Blob.__table__
+	connection.execute(
+		table.update().where(table.c.filename == target.filename).values(refcount=table.c.refcount - 1)
+	)
+	refcount = connection.execute(
+		db.select([table.c.refcount]).where(table.c.filename == target.filename)
+	).scalar()
+	# 还有其他图片使用同一个文件，保留文件
+	if refcount is not None and refcount > 0:
+		return
+	connection.execute(table.delete().where(table.c.filename == target.filename))
+	# 删除所有的图片，包括缩略图另外保存的其他格式，事务提交后才删除文件
+	filenames = [target.filename, target.filename_s, target.filename_m]
+	for filename in [target.filename_s, target.filename_m]:
+		filenames += [os.path.splitext(filename)[0] + ext for mimetype, ext, fmt in ALTERNATE_FORMATS]
+	FileDeletion.defer(db.object_session(target), connection, "uploads", filenames)
+
+
+# 监听器，删除图片或用户后，同时删除相关的时间线数据
+@db.event.listens_for(Photo, "after_delete", named=True)
+def delete_photo_timeline(**kwargs):
+	target = kwargs["target"]
+	kwargs["connection"].execute(
+		TimelineEntry.__table__.delete().where(TimelineEntry.photo_id == target.id)
+	)
+
+
+@db.event.listens_for(User, "after_delete", named=True)
+def delete_user_timeline(**kwargs):
+	target = kwargs["target"]
+	kwargs["connection"].execute(
+		TimelineEntry.__table__.delete().where(TimelineEntry.user_id == target.id)
+	)
+
+
+def _increase(connection, column, id_value, amount):
+	"""
+	计数器加上amount，直接执行UPDATE，不依赖内存中的对象
+	"""
+	table = column.class_.__table__
+	connection.execute(
+		table.update()
+			.where(table.c.id == id_value)
+			.values({column.key: db.func.coalesce(getattr(table.c, column.key), 0) + amount})
+	)
+
+
+# 监听器，维护收藏数量
+@db.event.listens_for(Collect, "after_insert", named=True)
+def increase_collect_count(**kwargs):
+	target = kwargs["target"]
+	_increase(kwargs["connection"], Photo.collect_count, target.collected_id, 1)
+	_increase(kwargs["connection"], User.collection_count, target.collector_id, 1)
+
+
+@db.event.listens_for(Collect, "after_delete", named=True)
+def decrease_collect_count(**kwargs):
+	target = kwargs["target"]
+	_increase(kwargs["connection"], Photo.collect_count, target.collected_id, -1)
+	_increase(kwargs["connection"], User.collection_count, target.collector_id, -1)
+
+
+# 监听器，维护关注数量，关注自己不计算在内
+@db.event.listens_for(Follow, "after_insert", named=True)
+def increase_follow_count(**kwargs):
+	target = kwargs["target"]
+	if target.follower_id != target.followed_id:
+		_increase(kwargs["connection"], User.following_count, target.follower_id, 1)
+		_increase(kwargs["connection"], User.follower_count, target.followed_id, 1)
+
+
+@db.event.listens_for(Follow, "after_delete", named=True)
+def decrease_follow_count(**kwargs):
+	target = kwargs["target"]
+	if target.follower_id != target.followed_id:
+		_increase(kwargs["connection"], User.following_count, target.follower_id, -1)
+		_increase(kwargs["connection"], User.follower_count, target.followed_id, -1)
+
+
+# 监听器，维护评论数量
+@db.event.listens_for(Comment, "after_insert", named=True)
+def increase_comment_count(**kwargs):
+	_increase(kwargs["connection"], Photo.comment_count, kwargs["target"].photo_id, 1)
+
+
+@db.event.listens_for(Comment, "after_delete", named=True)
+def decrease_comment_count(**kwargs):
+	_increase(kwargs["connection"], Photo.comment_count, kwargs["target"].photo_id, -1)
+
+
+# 监听器，维护未读消息数量，消息队列批量写入时直接修改计数器，见notifications.py
+@db.event.listens_for(Notification, "after_insert", named=True)
+def increase_unread_count(**kwargs):
+	target = kwargs["target"]
+	if not target.is_read:
+		_increase(kwargs["connection"], User.unread_count, target.receiver_id, 1)
+
+
+# 监听器，维护用户的图片数量和标签的图片数量
+@db.event.listens_for(Photo, "after_insert", named=True)
+def increase_photo_count(**kwargs):
+	_increase(kwargs["connection"], User.photo_count, kwargs["target"].author_id, 1)
+
+
+@db.event.listens_for(Photo, "after_delete", named=True)
+def decrease_photo_count(**kwargs):
+	target = kwargs["target"]
+	_increase(kwargs["connection"], User.photo_count, target.author_id, -1)
+	# 删除图片时，tagging中的数据已经被删除，使用内存中的标签集合
+	tag_ids = [tag.id for tag in target.tags if tag.id is not None]
+	if tag_ids:
+		kwargs["connection"].execute(
+			Tag.__table__.update()
+				.where(Tag.__table__.c.id.in_(tag_ids))
+				.values(photo_count=Tag.__table__.c.photo_count - 1)
+		)
+
+
+# 给图片添加或者移除标签时，修改标签的图片数量
+# tagging中的数据在flush时写入，此时Photo.tags的修改记录还在，同一个事务中直接执行UPDATE
+@db.event.listens_for(db.session, "after_flush")
+def update_tag_count(session, flush_context):
+	for target in session.new | session.dirty | session.deleted:
+		if not isinstance(target, Photo):
+			continue
+		history = db.inspect(target).attrs.tags.history
+		for tag in history.added or ():
+			_increase(session.connection(), Tag.photo_count, tag.id, 1)
+		for tag in history.deleted or ():
+			_increase(session.connection(), Tag.photo_count, tag.id, -1)
+
+
+def rebuild_counters():
+	"""
+	根据关联表重新计算所有计数器
+	"""
+	def count(where):
+		return db.select([db.func.count()]).where(where).as_scalar()
+
+	db.session.execute(Photo.__table__.update().values(
+		collect_count=count(Collect.collected_id == Photo.id),
+		comment_count=count(Comment.photo_id == Photo.id),
+	))
+	db.session.execute(User.__table__.update().values(
+		photo_count=count(Photo.author_id == User.id),
+		collection_count=count(Collect.collector_id == User.id),
+		follower_count=count(db.and_(
+			Follow.followed_id == User.id, Follow.follower_id != User.id)),
+		following_count=count(db.and_(
+			Follow.follower_id == User.id, Follow.followed_id != User.id)),
+		unread_count=count(db.and_(
+			Notification.receiver_id == User.id, db.not_(Notification.is_read))),
+	))
+	db.session.execute(Tag.__table__.update().values(
+		photo_count=count(tagging.c.tag_id == Tag.id),
+	))
+	db.session.commit()
+
+
+# 角色的权限发生变化时，清空权限缓存
+@db.event.listens_for(Role.permissions, "append")
+@db.event.listens_for(Role.permissions, "remove")
+def invalidate_permissions(target, value, initiator):
+	Role.invalidate_permissions()
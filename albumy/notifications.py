@@ -1,8 +1,302 @@
 # -*- coding: utf-8 -*-
-from flask import url_for
+"""
+消息提醒
+push_*只把事件放入内存队列，由一个后台线程把事件按批次写入数据库，请求中不再为消息提交事务
+只有一个写入线程，队列先进先出，同一个接收者的消息按产生的顺序写入
+一段时间内重复的事件（相同的类型、用户、对象和接收者）只写入第一次
+同一个对象的同类事件合并到一条未读消息中，只统计不同的用户，消息内容在显示时生成
+超过保留天数的已读消息由定时任务分批删除
+"""
+import atexit
+import queue
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
 
+from flask import current_app, url_for
+from markupsafe import Markup
+
+from albumy.events import publish_unread
 from albumy.extensions import db
-from albumy.models import Notification
+from albumy.models import Notification, NotificationActor, User
+from albumy.utils import logger
+
+
+class NotificationWriter(object):
+	"""
+	消息提醒的写入队列
+	"""
+
+	def __init__(self, app):
+		self.app = app
+		self.queue = queue.Queue()
+		self.thread = None
+		self.lock = threading.Lock()
+		# 最近的消息的键与产生的时间，用于合并重复的消息
+		self.recent = {}
+		self.pruned = time.monotonic()
+
+	def push(self, receiver_id, kind, actor_id, object_id):
+		"""
+		发送消息，相同的事件在ALBUMY_NOTIFICATION_COALESCE秒以内只写入一次
+		:param receiver_id: 接收者id
+		:param kind: 类型，follow、collect或comment
+		:param actor_id: 触发消息的用户id
+		:param object_id: 对象id
+		:return: 是否写入，重复的事件返回False
+		"""
+		if not self._remember((kind, actor_id, object_id, receiver_id)):
+			return False
+		entry = {
+			'receiver_id': receiver_id,
+			'kind': kind,
+			'actor_id': actor_id,
+			'object_id': object_id,
+			# 事件产生的时间，不是写入的时间
+			'timestamp': datetime.utcnow(),
+		}
+		if self.app.config['ALBUMY_NOTIFICATION_SYNC']:
+			self.write([entry])
+			return True
+		self._start()
+		self.queue.put(entry)
+		return True
+
+	def _remember(self, key):
+		now = time.monotonic()
+		window = self.app.config['ALBUMY_NOTIFICATION_COALESCE']
+		with self.lock:
+			last = self.recent.get(key)
+			if last is not None and now - last < window:
+				return False
+			self.recent[key] = now
+			# 定期清理过期的键
+			if now - self.pruned > window:
+				self.recent = dict((k, t) for k, t in self.recent.items() if now - t < window)
+				self.pruned = now
+		return True
+
+	def write(self, entries):
+		"""
+		在当前线程中写入消息：合并到已有的未读消息中的事件逐条UPDATE，
+		只有一个用户的新消息用一条多行INSERT
+		:param entries: push生成的事件列表
+		"""
+		receiver_ids = set(entry['receiver_id'] for entry in entries)
+		# 接收者可能已经注销了账号
+		receivers = set(user_id for (user_id,) in db.session.query(User.id).filter(
+			User.id.in_(receiver_ids)).filter_by(deleting=False))
+
+		# 同一批中同一个对象的同类事件先合并，按第一个事件的顺序
+		groups = {}
+		for entry in entries:
+			if entry['receiver_id'] not in receivers:
+				continue
+			key = (entry['receiver_id'], entry['kind'], entry['object_id'])
+			group = groups.get(key)
+			if group is None:
+				groups[key] = dict(entry, actors=[entry['actor_id']], first_timestamp=entry['timestamp'])
+			else:
+				if entry['actor_id'] not in group['actors']:
+					group['actors'].append(entry['actor_id'])
+				group['actor_id'] = entry['actor_id']
+				group['timestamp'] = entry['timestamp']
+
+		# 合并时间以内还没有阅读的消息，锁定到提交，合并期间不会被其他进程修改
+		existing = {}
+		if groups:
+			cutoff = datetime.utcnow() - timedelta(seconds=self.app.config['ALBUMY_NOTIFICATION_AGGREGATE_WINDOW'])
+			for row in db.session.query(
+					Notification.id, Notification.receiver_id, Notification.kind, Notification.object_id,
+					Notification.actor_id, Notification.actor_count).filter(
+					Notification.receiver_id.in_(set(key[0] for key in groups)),
+					Notification.kind.in_(set(key[1] for key in groups)),
+					Notification.object_id.in_(set(key[2] for key in groups)),
+					Notification.first_timestamp >= cutoff).filter_by(is_read=False).with_for_update():
+				key = (row.receiver_id, row.kind, row.object_id)
+				if key in groups and (key not in existing or existing[key].id < row.id):
+					existing[key] = row
+		# 已经合并了多个用户的消息中的用户
+		counted = {}
+		merged = [row.id for row in existing.values() if (row.actor_count or 1) > 1]
+		if merged:
+			for notification_id, actor_id in db.session.query(
+					NotificationActor.notification_id, NotificationActor.actor_id).filter(
+					NotificationActor.notification_id.in_(merged)):
+				counted.setdefault(notification_id, set()).add(actor_id)
+
+		table = Notification.__table__
+		actor_rows = []
+		rows = []
+		# 每个接收者新增的未读消息数量
+		unread = Counter()
+		for key, group in groups.items():
+			row = existing.get(key)
+			if row is not None:
+				count = row.actor_count or 1
+				known = counted.get(row.id, set()) if count > 1 else {row.actor_id}
+				actors = [actor_id for actor_id in group['actors'] if actor_id not in known]
+				# 选出之后可能已经被阅读了，只更新未读的消息
+				result = db.session.execute(
+					table.update().where(db.and_(table.c.id == row.id, db.not_(table.c.is_read))).values(
+						actor_count=count + len(actors), actor_id=group['actor_id'], timestamp=group['timestamp']))
+				if result.rowcount:
+					if actors:
+						# 第一次合并时写入原来的用户，已经注销的用户只计数
+						if count == 1 and row.actor_id is not None:
+							actors.insert(0, row.actor_id)
+						actor_rows += [{'notification_id': row.id, 'actor_id': actor_id} for actor_id in actors]
+					continue
+			# 选出之后被阅读了，作为新的消息写入
+			rows.append({
+				'receiver_id': group['receiver_id'],
+				'kind': group['kind'],
+				'actor_id': group['actor_id'],
+				'object_id': group['object_id'],
+				'actor_count': len(group['actors']),
+				'is_read': False,
+				'timestamp': group['timestamp'],
+				'first_timestamp': group['first_timestamp'],
+			})
+			if len(group['actors']) > 1:
+				# 同一批中就有多个用户的新消息很少，逐条插入取得id
+				notification_id = db.session.execute(table.insert(), rows.pop()).inserted_primary_key[0]
+				actor_rows += [{'notification_id': notification_id, 'actor_id': actor_id}
+							   for actor_id in group['actors']]
+				unread[group['receiver_id']] += 1
+		if rows:
+			db.session.execute(table.insert(), rows)
+		if actor_rows:
+			db.session.execute(NotificationActor.__table__.insert(), actor_rows)
+		# 多行INSERT不会触发监听器，在同一个事务中增加未读消息数量，合并的事件不改变未读数量
+		unread.update(row['receiver_id'] for row in rows)
+		if unread:
+			users = User.__table__
+			db.session.execute(
+				users.update().where(users.c.id == db.bindparam('_id')).values(
+					unread_count=db.func.coalesce(users.c.unread_count, 0) + db.bindparam('_amount')),
+				[{'_id': user_id, '_amount': amount} for user_id, amount in unread.items()]
+			)
+		db.session.commit()
+		# 推送给在线的接收者
+		if unread:
+			publish_unread(unread)
+
+	def flush(self, timeout=None):
+		"""
+		等待队列中的消息全部写入
+		:param timeout: 最多等待的秒数
+		:return: 是否全部写入
+		"""
+		with self.queue.all_tasks_done:
+			return self.queue.all_tasks_done.wait_for(lambda: not self.queue.unfinished_tasks, timeout)
+
+	def _start(self):
+		"""
+		第一次发送消息时启动写入线程，程序退出前写入剩余的消息
+		"""
+		with self.lock:
+			if self.thread is not None:
+				return
+			self.thread = threading.Thread(target=self._run, daemon=True)
+			self.thread.start()
+		atexit.register(self.flush, 10)
+
+	def _run(self):
+		while True:
+			entries = [self.queue.get()]
+			# 稍等一会儿，把同一时间产生的消息凑成一批
+			time.sleep(self.app.config['ALBUMY_NOTIFICATION_FLUSH_INTERVAL'])
+			batch_size = self.app.config['ALBUMY_NOTIFICATION_BATCH_SIZE']
+			while len(entries) < batch_size:
+				try:
+					entries.append(self.queue.get_nowait())
+				except queue.Empty:
+					break
+			with self.app.app_context():
+				try:
+					self.write(entries)
+				except Exception:
+					logger.exception('写入消息提醒失败，{}条'.format(len(entries)))
+				finally:
+					db.session.remove()
+			for _ in entries:
+				self.queue.task_done()
+
+
+def prune_notifications(days, batch_size):
+	"""
+	分批删除超过保留天数的已读消息，每一批单独提交，未读消息不会删除，不影响未读数量
+	:param days: 保留天数
+	:param batch_size: 每一批删除的数量
+	:return: 生成器，每删除一批返回这一批的数量
+	"""
+	cutoff = datetime.utcnow() - timedelta(days=days)
+	while True:
+		ids = [notification_id for (notification_id,) in db.session.query(Notification.id).filter(
+			Notification.timestamp < cutoff).filter_by(is_read=True).limit(batch_size)]
+		if not ids:
+			return
+		actors = NotificationActor.__table__
+		db.session.execute(actors.delete().where(actors.c.notification_id.in_(ids)))
+		db.session.execute(Notification.__table__.delete().where(Notification.__table__.c.id.in_(ids)))
+		db.session.commit()
+		yield len(ids)
+
+
+class NotificationPruner(object):
+	"""
+	定时删除过期消息的线程，每隔ALBUMY_NOTIFICATION_PRUNE_INTERVAL秒执行一次
+	多个进程中同时执行时，每一批删除的都是当时还存在的消息，不会出错
+	"""
+
+	def __init__(self, app):
+		self.app = app
+		self.thread = None
+		self.lock = threading.Lock()
+
+	def start(self):
+		with self.lock:
+			if self.thread is not None:
+				return
+			self.thread = threading.Thread(target=self._run, daemon=True)
+			self.thread.start()
+
+	def _run(self):
+		while True:
+			with self.app.app_context():
+				try:
+					total = sum(prune_notifications(self.app.config['ALBUMY_NOTIFICATION_RETENTION_DAYS'],
+													self.app.config['ALBUMY_NOTIFICATION_PRUNE_BATCH_SIZE']))
+					if total:
+						logger.info('删除过期消息，{}条'.format(total))
+				except Exception:
+					logger.exception('删除过期消息失败')
+				finally:
+					db.session.remove()
+			time.sleep(self.app.config['ALBUMY_NOTIFICATION_PRUNE_INTERVAL'])
+
+
+def get_notification_pruner():
+	"""
+	当前程序的过期消息删除线程
+	"""
+	pruner = current_app.extensions.get('albumy_notification_pruner')
+	if pruner is None:
+		pruner = current_app.extensions['albumy_notification_pruner'] = NotificationPruner(
+			current_app._get_current_object())
+	return pruner
+
+
+def get_notification_writer():
+	"""
+	当前程序的消息写入队列
+	"""
+	writer = current_app.extensions.get('albumy_notifications')
+	if writer is None:
+		writer = current_app.extensions['albumy_notifications'] = NotificationWriter(current_app._get_current_object())
+	return writer
 
 
 def push_follow_notification(follower, receiver):
@@ -11,31 +305,18 @@ def push_follow_notification(follower, receiver):
 	:param follower: 关注者
 	:param receiver: 接收消息用户对象
 	"""
-	# 两个参数分别是用户首页，和关注者的用户名
-	message = '用户 <a href="%s">%s</a> 关注了你。' % (
-		url_for("user.index", username=follower.username),
-		follower.username,
-	)
-	# 将message发送给receiver
-	notification = Notification(message=message, receiver=receiver)
-	# 存入数据库
-	db.session.add(notification)
-	db.session.commit()
+	# 对象是被关注的用户，同一时间的关注合并为一条
+	get_notification_writer().push(receiver.id, 'follow', follower.id, receiver.id)
 
 
-def push_comment_notification(photo_id, receiver, page=1):
+def push_comment_notification(photo_id, receiver, author):
 	"""
 	有新评论消息提醒
 	:param photo_id: 图片id
 	:param receiver: 接收者
-	:param page: 页码
+	:param author: 评论者
 	"""
-	message = '<a href="%s#comments">图片</a> 有新的评论\回复' % (
-		url_for("main.show_photo", photo_id=photo_id, page=page)
-	)
-	notification = Notification(message=message, receiver=receiver)
-	db.session.add(notification)
-	db.session.commit()
+	get_notification_writer().push(receiver.id, 'comment', author.id, photo_id)
 
 
 def push_collect_notification(collector, photo_id, receiver):
@@ -45,13 +326,37 @@ def push_collect_notification(collector, photo_id, receiver):
 	:param photo_id: 图片id
 	:param receiver: 接收消息对象
 	"""
-	message = '用户 <a href="%s">%s</a> 收藏了你的 <a href="%s">图片</a>' % (
-		# 用户主页和用户名
-		url_for("user.index", username=collector.username),
-		collector.username,
-		# 图片
-		url_for("main.show_photo", photo_id=photo_id),
-	)
-	notification = Notification(message=message, receiver=receiver)
-	db.session.add(notification)
-	db.session.commit()
+	get_notification_writer().push(receiver.id, 'collect', collector.id, photo_id)
+
+
+def render_messages(notifications):
+	"""
+	生成一页消息的内容，一次查询所有的用户名
+	:param notifications: Notification列表
+	:return: 消息id与HTML的字典
+	"""
+	actor_ids = set(notification.actor_id for notification in notifications if notification.actor_id)
+	usernames = dict(db.session.query(User.id, User.username).filter(User.id.in_(actor_ids))) if actor_ids else {}
+	return dict((notification.id, render_message(notification, usernames.get(notification.actor_id)))
+				for notification in notifications)
+
+
+def render_message(notification, username):
+	"""
+	根据消息的类型生成内容
+	:param username: 最后一个触发消息的用户名，用户已经注销时为None
+	"""
+	if notification.kind is None:
+		return Markup(notification.message)
+	if username is None:
+		actor = Markup('已注销的用户')
+	else:
+		actor = Markup('用户 <a href="%s">%s</a>') % (url_for("user.index", username=username), username)
+	if (notification.actor_count or 1) > 1:
+		actor += Markup(' 等 %d 人') % notification.actor_count
+	if notification.kind == 'follow':
+		return actor + Markup(' 关注了你。')
+	photo_url = url_for("main.show_photo", photo_id=notification.object_id)
+	if notification.kind == 'collect':
+		return actor + Markup(' 收藏了你的 <a href="%s">图片</a>') % photo_url
+	return actor + Markup(' 在 <a href="%s#comments">图片</a> 发表了新的评论\\回复') % photo_url
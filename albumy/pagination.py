@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+游标分页（keyset pagination）
+按(timestamp, id)或者(flag, id)这类唯一的排序键翻页，用WHERE代替OFFSET，翻到多深的页面耗时都一样
+只有在模板读取total或pages时才会执行COUNT查询
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+from albumy.extensions import db
+
+# 游标中时间的格式
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class KeysetPagination(object):
+	"""
+	与flask_sqlalchemy的Pagination接口保持一致，可以直接使用render_pagination宏
+	游标通过page参数传递，next_num和prev_num就是下一页和上一页的游标
+	"""
+
+	def __init__(self, query, columns, descending, cursor, per_page):
+		self.query = query
+		self.columns = columns
+		self.descending = descending
+		self.per_page = per_page
+		# 当前页的游标，第一页为1
+		self.page = cursor or 1
+		self._total = None
+
+		keys, direction = decode_cursor(cursor, columns)
+		backward = direction == 'prev'
+		# 向前翻页时，比较和排序的方向都要反过来
+		reverse = descending != backward
+		rows = query
+		if keys is not None:
+			rows = rows.filter(_beyond(columns, keys, reverse))
+		rows = rows.order_by(*[column.desc() if reverse else column.asc() for column in columns]) \
+			.limit(per_page + 1).all()
+		# 多查询一条，用来判断是否还有数据
+		has_more = len(rows) > per_page
+		rows = rows[:per_page]
+		if backward:
+			rows.reverse()
+			self.has_prev = has_more
+			self.has_next = True
+		else:
+			self.has_prev = keys is not None
+			self.has_next = has_more
+		self.items = rows
+
+	@property
+	def next_num(self):
+		"""
+		下一页的游标
+		"""
+		if not self.has_next or not self.items:
+			return None
+		return encode_cursor(self._keys(self.items[-1]), 'next')
+
+	@property
+	def prev_num(self):
+		"""
+		上一页的游标
+		"""
+		if not self.has_prev or not self.items:
+			return None
+		return encode_cursor(self._keys(self.items[0]), 'prev')
+
+	@property
+	def total(self):
+		"""
+		总数，只在访问时执行COUNT查询
+		"""
+		if self._total is None:
+			self._total = self.query.order_by(None).count()
+		return self._total
+
+	@property
+	def pages(self):
+		"""
+		总页数
+		"""
+		if self.per_page == 0:
+			return 0
+		return (self.total + self.per_page - 1) // self.per_page
+
+	def iter_pages(self, *args, **kwargs):
+		"""
+		游标分页无法跳到指定页码，只显示上一页和下一页
+		"""
+		return iter(())
+
+	def _keys(self, item):
+		return [getattr(item, column.key) for column in self.columns]
+
+
+def keyset_paginate(query, columns, cursor=None, per_page=20, descending=True):
+	"""
+	游标分页
+	:param query: 查询对象
+	:param columns: 排序列，最后一列必须唯一，例如(Photo.timestamp, Photo.id)
+	:param cursor: 游标，从request.args的page中获取
+	:param per_page: 每一页数量
+	:param descending: 是否降序
+	:return: KeysetPagination对象
+	"""
+	return KeysetPagination(query, columns, descending, cursor, per_page)
+
+
+def encode_cursor(keys, direction):
+	"""
+	将排序键编码成不透明的游标字符串
+	"""
+	values = [key.strftime(DATETIME_FORMAT) if isinstance(key, datetime) else key for key in keys]
+	data = json.dumps([values, direction], separators=(',', ':'))
+	return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+	"""
+	解析游标，无效的游标（包括旧的数字页码）当作第一页处理
+	:return: (排序键, 方向)
+	"""
+	if not cursor:
+		return None, 'next'
+	try:
+		cursor = str(cursor)
+		data = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii'))
+		values, direction = json.loads(data.decode('utf-8'))
+		if len(values) != len(columns) or direction not in ('next', 'prev'):
+			return None, 'next'
+		keys = []
+		for column, value in zip(columns, values):
+			if isinstance(column.type, db.DateTime) and value is not None:
+				value = datetime.strptime(value, DATETIME_FORMAT)
+			keys.append(value)
+		return keys, direction
+	except (ValueError, TypeError, UnicodeError, binascii.Error):
+		return None, 'next'
+
+
+def _beyond(columns, keys, descending):
+	"""
+	(a, b) < (x, y) 展开成 a < x OR (a = x AND b < y)，兼容不支持行值比较的数据库
+	"""
+	clauses = []
+	for i, column in enumerate(columns):
+		condition = [columns[j] == keys[j] for j in range(i)]
+		condition.append(column < keys[i] if descending else column > keys[i])
+		clauses.append(and_(*condition))
+	return or_(*clauses)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+后台删除文件
+删除图片或用户时只在事务中写入FileDeletion，事务提交后唤醒后台线程分批删除文件
+flask media gc另外清理数据库中没有引用的孤立文件、过期的上传临时文件以及已删除图片的变体
+"""
+import os
+import threading
+import time
+
+from flask import current_app, has_app_context
+
+from albumy.extensions import db
+from albumy.models import FileDeletion, Photo, Blob, User
+from albumy.settings import ALTERNATE_FORMATS
+from albumy.storage import get_storage
+from albumy.utils import logger
+from albumy.variants import get_variant_cache, remove_variants
+
+
+class FileReaper(object):
+	"""
+	FileDeletion的后台消费者
+	提交了删除的事务后被唤醒，另外每隔ALBUMY_REAPER_INTERVAL秒检查一次，处理上次未完成的记录
+	"""
+
+	def __init__(self, app):
+		self.app = app
+		self.event = threading.Event()
+		self.thread = None
+		self.lock = threading.Lock()
+		# 独立的会话，同步模式下在其他会话的after_commit中执行
+		self.session = db.create_scoped_session()
+
+	def wake(self):
+		"""
+		有新的待删除文件
+		"""
+		if self.app.config['ALBUMY_REAPER_SYNC']:
+			self.drain()
+			return
+		self._start()
+		self.event.set()
+
+	def _start(self):
+		with self.lock:
+			if self.thread is not None:
+				return
+			self.thread = threading.Thread(target=self._run, daemon=True)
+			self.thread.start()
+
+	def _run(self):
+		while True:
+			self.event.wait(self.app.config['ALBUMY_REAPER_INTERVAL'])
+			self.event.clear()
+			with self.app.app_context():
+				try:
+					self.drain()
+				except Exception:
+					logger.exception('删除文件失败')
+
+	def drain(self):
+		"""
+		删除所有待删除的文件
+		:return: 删除的文件数量
+		"""
+		total = 0
+		while True:
+			deleted, remaining = self.reap()
+			total += deleted
+			if not deleted or not remaining:
+				return total
+
+	def reap(self, batch_size=None):
+		"""
+		删除一批文件，删除失败的记录增加失败次数，超过ALBUMY_REAPER_MAX_ATTEMPTS次后不再处理
+		:return: (删除的文件数量, 是否还有剩余的记录)
+		"""
+		batch_size = batch_size or self.app.config['ALBUMY_REAPER_BATCH_SIZE']
+		session = self.session
+		try:
+			rows = session.query(FileDeletion.id, FileDeletion.area, FileDeletion.name).filter(
+				FileDeletion.attempts < self.app.config['ALBUMY_REAPER_MAX_ATTEMPTS']
+			).order_by(FileDeletion.id).limit(batch_size).all()
+			areas = {}
+			for row in rows:
+				areas.setdefault(row.area, []).append(row)
+			done = []
+			failed = []
+			for area, items in areas.items():
+				try:
+					get_storage(area).delete_many([item.name for item in items])
+				except Exception:
+					logger.exception('删除文件失败，area = {}'.format(area))
+					failed += [item.id for item in items]
+					continue
+				done += [item.id for item in items]
+				if area == 'uploads':
+					for item in items:
+						remove_variants(item.name)
+			if done:
+				session.query(FileDeletion).filter(FileDeletion.id.in_(done)).delete(synchronize_session=False)
+			if failed:
+				session.query(FileDeletion).filter(FileDeletion.id.in_(failed)).update(
+					{FileDeletion.attempts: FileDeletion.attempts + 1}, synchronize_session=False)
+			session.commit()
+			return len(done), len(rows) == batch_size
+		finally:
+			self.session.remove()
+
+
+def get_file_reaper():
+	"""
+	当前程序的文件删除线程
+	"""
+	reaper = current_app.extensions.get('albumy_reaper')
+	if reaper is None:
+		reaper = current_app.extensions['albumy_reaper'] = FileReaper(current_app._get_current_object())
+	return reaper
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def reap_after_commit(session):
+	"""
+	提交了删除文件的事务后唤醒删除线程
+	"""
+	if session.info.pop('albumy_file_deletions', False) and has_app_context():
+		get_file_reaper().wake()
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def discard_after_rollback(session):
+	session.info.pop('albumy_file_deletions', None)
+
+
+def referenced_files():
+	"""
+	数据库中引用的所有文件名
+	:return: 存储区域与文件名集合的字典
+	"""
+	uploads = set()
+	for names in db.session.query(Photo.filename, Photo.filename_s, Photo.filename_m).yield_per(1000):
+		uploads.update(names)
+		for name in names[1:]:
+			uploads.update(os.path.splitext(name)[0] + ext for mimetype, ext, fmt in ALTERNATE_FORMATS)
+	uploads.update(name for (name,) in db.session.query(Blob.filename))
+	avatars = set()
+	for names in db.session.query(User.avatar_s, User.avatar_m, User.avatar_l, User.avatar_raw).yield_per(1000):
+		avatars.update(names)
+	return {'uploads': uploads, 'avatars': avatars}
+
+
+def collect_garbage(grace, dry_run=False):
+	"""
+	清理文件，修改时间在grace秒以内的文件可能属于还没有提交的上传，不会删除
+	:param dry_run: 只列出，不删除
+	:return: 类别与文件名列表的字典
+	"""
+	result = {'deferred': 0}
+	if not dry_run:
+		result['deferred'] = get_file_reaper().drain()
+	cutoff = time.time() - grace
+	referenced = referenced_files()
+
+	# 存储中没有引用的文件
+	for area, names in referenced.items():
+		storage = get_storage(area)
+		orphans = [name for name, mtime in storage.names() if mtime < cutoff and name not in names]
+		if not dry_run:
+			storage.delete_many(orphans)
+		result[area] = orphans
+
+	# 请求中断时可能残留的上传临时文件
+	upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
+	temporary = []
+	if os.path.isdir(upload_path):
+		for entry in os.scandir(upload_path):
+			if entry.name.startswith('.upload-') and entry.name.endswith('.part') \
+					and entry.stat().st_mtime < cutoff:
+				temporary.append(entry.name)
+				if not dry_run:
+					os.remove(entry.path)
+	result['temporary'] = temporary
+
+	# 原图已经删除的变体
+	stems = set(os.path.splitext(name)[0].replace('/', '_') for name in referenced['uploads'] if name)
+	cache = get_variant_cache()
+	variants = [os.path.basename(path) for path, size, mtime in cache.files()
+				if mtime < cutoff and os.path.basename(path).rsplit('_w', 1)[0] not in stems]
+	if not dry_run:
+		for name in variants:
+			cache.discard(name)
+	result['variants'] = variants
+	return result
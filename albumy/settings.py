@@ -25,6 +25,25 @@ class Operations:
 	CHANGE_EMAIL = 'change-email'
 
 
+class ThumbnailStatus:
+	"""
+	缩略图状态
+	"""
+	# 等待生成
+	PENDING = 'pending'
+	# 已生成
+	READY = 'ready'
+	# 生成失败，继续显示原图
+	FAILED = 'failed'
+
+
+# 缩略图另外保存的格式，按优先顺序：(MIME类型, 后缀, Pillow格式名)
+ALTERNATE_FORMATS = (
+	('image/avif', '.avif', 'AVIF'),
+	('image/webp', '.webp', 'WEBP'),
+)
+
+
 class BaseConfig:
 	"""
 	共有配置
@@ -49,6 +68,82 @@ class BaseConfig:
 	ALBUMY_MANAGE_COMMENT_PER_PAGE = 30
 	# 显示搜索结果数量
 	ALBUMY_SEARCH_RESULT_PER_PAGE = 20
+	# 每个用户时间线最多保留的图片数量
+	ALBUMY_TIMELINE_SIZE = 1000
+	# 平均每写入多少次时间线整理一次接收者的时间线，删除超过ALBUMY_TIMELINE_SIZE的数据，None不整理
+	ALBUMY_TIMELINE_TRIM_EVERY = 20
+	# 热门标签缓存的有效时间，单位秒
+	ALBUMY_TAG_CACHE_TTL = 300
+	# 发现页面图片id数组的有效时间，单位秒
+	ALBUMY_EXPLORE_SAMPLER_TTL = 600
+	# 发现页面默认的偏向，None、recent或者popular
+	ALBUMY_EXPLORE_BIAS = None
+	# 生成缩略图的进程数量
+	ALBUMY_THUMBNAIL_WORKERS = 2
+	# 是否在请求中直接生成缩略图，测试时使用
+	ALBUMY_THUMBNAIL_SYNC = False
+	# 图片和头像的缓存时间，文件名不会重复使用，默认一年
+	ALBUMY_MEDIA_MAX_AGE = 365 * 24 * 3600
+	# 文件发送方式，None由Flask发送，x-sendfile用于Apache/lighttpd，x-accel-redirect用于nginx
+	ALBUMY_MEDIA_OFFLOAD = os.getenv('ALBUMY_MEDIA_OFFLOAD')
+	# x-accel-redirect模式下nginx内部location的前缀，后面是uploads/或avatars/
+	ALBUMY_MEDIA_ACCEL_PREFIX = '/_media/'
+	# 文件存储，local为本地磁盘，s3为S3兼容的对象存储（需要安装boto3），本地目录作为暂存目录
+	# memory为进程内的对象存储，用于测试和开发
+	ALBUMY_STORAGE = os.getenv('ALBUMY_STORAGE', 'local')
+	ALBUMY_S3_BUCKET = os.getenv('ALBUMY_S3_BUCKET', 'albumy')
+	# MinIO等服务的地址，例如http://127.0.0.1:9000，使用AWS S3时为None
+	ALBUMY_S3_ENDPOINT = os.getenv('ALBUMY_S3_ENDPOINT')
+	ALBUMY_S3_REGION = os.getenv('ALBUMY_S3_REGION')
+	ALBUMY_S3_ACCESS_KEY = os.getenv('ALBUMY_S3_ACCESS_KEY')
+	ALBUMY_S3_SECRET_KEY = os.getenv('ALBUMY_S3_SECRET_KEY')
+	# 原图和缩略图并行上传的线程数
+	ALBUMY_S3_UPLOAD_WORKERS = 3
+	# 超过这个大小的文件分块上传
+	ALBUMY_S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+	# 进程内缓存的对象大小的数量，发送缩略图时选择格式不需要每次发送HEAD请求
+	ALBUMY_S3_SIZE_CACHE = 10000
+	# 不存在的对象缓存的秒数，其他进程上传的缩略图最多这么久之后才能读取到
+	ALBUMY_S3_MISSING_TTL = 60
+	# 对象存储中的文件重定向到预签名的地址，否则由程序转发
+	ALBUMY_STORAGE_REDIRECT = True
+	# 预签名地址的有效期
+	ALBUMY_STORAGE_URL_EXPIRES = 3600
+	# 删除的文件在事务提交后由后台线程分批删除，同步模式下在提交时直接删除
+	ALBUMY_REAPER_SYNC = False
+	ALBUMY_REAPER_INTERVAL = 60
+	ALBUMY_REAPER_BATCH_SIZE = 500
+	ALBUMY_REAPER_MAX_ATTEMPTS = 5
+	# flask media gc不删除这个时间以内的文件，避免删除还没有提交的上传
+	ALBUMY_GC_GRACE = 24 * 3600
+	# 删除账号时每一批删除的数据数量，同步模式下在请求中直接删除
+	ALBUMY_ACCOUNT_DELETE_CHUNK = 500
+	ALBUMY_ACCOUNT_DELETE_SYNC = False
+	# 消息提醒由后台线程批量写入，每一批最多的数量和等待凑成一批的时间，同步模式下在请求中直接写入
+	ALBUMY_NOTIFICATION_SYNC = False
+	ALBUMY_NOTIFICATION_BATCH_SIZE = 500
+	ALBUMY_NOTIFICATION_FLUSH_INTERVAL = 0.1
+	# 这个时间以内的重复消息只保留第一条，例如反复收藏、取消收藏同一张图片
+	ALBUMY_NOTIFICATION_COALESCE = 600
+	# 这个时间以内同一个对象的同类未读消息合并为一条，例如“X等12人收藏了你的图片”
+	ALBUMY_NOTIFICATION_AGGREGATE_WINDOW = 24 * 3600
+	# 定期删除超过保留天数的已读消息，每一批删除的数量，间隔为None时不启动定时任务
+	ALBUMY_NOTIFICATION_RETENTION_DAYS = 90
+	ALBUMY_NOTIFICATION_PRUNE_BATCH_SIZE = 1000
+	ALBUMY_NOTIFICATION_PRUNE_INTERVAL = 6 * 3600
+	# 实时消息的SSE连接：心跳间隔、连接的最长时间、断开后重新连接的等待时间（秒）
+	ALBUMY_STREAM_HEARTBEAT = 20
+	ALBUMY_STREAM_TIMEOUT = 3600
+	ALBUMY_STREAM_RETRY = 5
+	# 连接总数和每个用户的连接数上限，超过时客户端改为轮询；每个连接最多等待发送的事件数量
+	ALBUMY_STREAM_MAX_CONNECTIONS = 5000
+	ALBUMY_STREAM_MAX_PER_USER = 5
+	ALBUMY_STREAM_QUEUE_SIZE = 8
+	# 按需生成的图片变体，允许的宽度和格式
+	ALBUMY_VARIANT_WIDTHS = (200, 400, 800, 1200, 1600)
+	ALBUMY_VARIANT_FORMATS = ('jpeg', 'png', 'webp')
+	# 变体缓存的大小上限，默认1G
+	ALBUMY_VARIANT_CACHE_SIZE = 1024 * 1024 * 1024
 	# 邮件前缀
 	ALBUMY_MAIL_SUBJECT_PREFIX = '[Albumy]'
 	# 图片上传路径
@@ -61,9 +156,20 @@ class BaseConfig:
 		ALBUMY_PHOTO_SIZE['small']: '_s',  # 缩略图
 		ALBUMY_PHOTO_SIZE['medium']: '_m',
 	}
+	# 缩略图的编码策略，key为后缀
+	# quality: 质量，progressive: JPEG使用渐进式编码，lossy_png: 没有透明通道的PNG转换成JPEG
+	# formats: 另外保存的格式，Pillow不支持的格式会跳过
+	ALBUMY_ENCODER_POLICY = {
+		'_s': {'quality': 80, 'progressive': True, 'lossy_png': True, 'formats': ('avif', 'webp')},
+		'_m': {'quality': 85, 'progressive': True, 'lossy_png': True, 'formats': ('avif', 'webp')},
+	}
 
 	SECRET_KEY = str(uuid.uuid4().hex)
 	MAX_CONTENT_LENGTH = 3 * 1024 * 1024
+	# 单个上传文件的大小上限
+	ALBUMY_UPLOAD_MAX_FILE_SIZE = 3 * 1024 * 1024
+	# 批量上传时整个请求的大小上限，最多30张图片
+	ALBUMY_BATCH_MAX_CONTENT_LENGTH = 30 * 3 * 1024 * 1024
 
 	BOOTSTRAP_SERVE_LOCAL = True
 
@@ -71,6 +177,8 @@ class BaseConfig:
 
 	# 头像上传路径
 	AVATARS_SAVE_PATH = os.path.join(ALBUMY_UPLOAD_PATH, 'avatars')
+	# 变体缓存路径
+	ALBUMY_VARIANT_CACHE_PATH = os.path.join(ALBUMY_UPLOAD_PATH, 'variants')
 	# 头像大小，对应小头像，中头像，大头像
 	AVATARS_SIZE_TUPLE = (30, 100, 200)
 
@@ -92,6 +200,9 @@ class BaseConfig:
 	DROPZONE_MAX_FILE_SIZE = 3
 	# 单次最大上传为30张图片
 	DROPZONE_MAX_FILES = 30
+	# 多个文件在一个请求中上传到批量上传接口
+	DROPZONE_UPLOAD_MULTIPLE = True
+	DROPZONE_PARALLEL_UPLOADS = 30
 	# 是否需要CSRF验证
 	DROPZONE_ENABLE_CSRF = True
 	# TODO
@@ -118,6 +229,11 @@ class TestingConfig(BaseConfig):
 	TESTING = True
 	WTF_CSRF_ENABLED = False
 	SQLALCHEMY_DATABASE_URI = 'sqlite:///'  # in-memory database
+	ALBUMY_THUMBNAIL_SYNC = True
+	ALBUMY_REAPER_SYNC = True
+	ALBUMY_ACCOUNT_DELETE_SYNC = True
+	ALBUMY_NOTIFICATION_SYNC = True
+	ALBUMY_NOTIFICATION_PRUNE_INTERVAL = None
 
 
 class ProductionConfig(BaseConfig):
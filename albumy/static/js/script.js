@@ -113,22 +113,44 @@ $(function () {
         });
     }
 
-    function update_notifications_count() {
+    function set_notifications_count(count) {
         var $el = $('#notification-badge');
+        if (count === 0) {
+            $el.hide();
+        } else {
+            $el.show();
+            $el.text(count)
+        }
+    }
+
+    function update_notifications_count() {
         $.ajax({
             type: 'GET',
-            url: $el.data('href'),
+            url: $('#notification-badge').data('href'),
             success: function (data) {
-                if (data.count === 0) {
-                    $('#notification-badge').hide();
-                } else {
-                    $el.show();
-                    $el.text(data.count)
-                }
+                set_notifications_count(data.count);
             }
         });
     }
 
+    // receive unread count pushed by the server, fall back to polling if unsupported or refused
+    function listen_notifications() {
+        if (!window.EventSource) {
+            setInterval(update_notifications_count, 30000);
+            return;
+        }
+        var source = new EventSource($('#notification-badge').data('stream'));
+        source.addEventListener('notification', function (e) {
+            set_notifications_count(JSON.parse(e.data).count);
+        });
+        source.onerror = function () {
+            // the browser reconnects on network errors, it only closes on an error status
+            if (source.readyState === EventSource.CLOSED) {
+                setInterval(update_notifications_count, 30000);
+            }
+        };
+    }
+
     function follow(e) {
         var $el = $(e.target);
         var id = $el.data('id');
@@ -222,7 +244,7 @@ $(function () {
     });
 
     if (is_authenticated) {
-        setInterval(update_notifications_count, 30000);
+        listen_notifications();
     }
 
     $("[data-toggle='tooltip']").tooltip({title: moment($(this).data('timestamp')).format('lll')})
@@ -0,0 +1,641 @@
+# -*- coding: utf-8 -*-
+"""
+上传文件的存储
+文件按文件名的哈希值保存在两级子目录中，例如 ab/cd/<uuid>.jpg，避免单个目录中的文件过多
+数据库和URL中仍然只保存文件名，读取时先查找子目录，再查找旧版本平铺在根目录中的文件
+默认保存在本地磁盘，也可以保存在S3兼容的对象存储（AWS S3、MinIO等）中，见get_storage
+测试和开发时可以使用内存中的对象存储（ALBUMY_STORAGE=memory），不需要boto3和MinIO
+"""
+import hashlib
+import io
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from itertools import islice
+
+from flask import current_app
+
+# 分层目录的名称
+SHARD_PATTERN = re.compile(r'^[0-9a-f]{2}$')
+
+try:
+	import boto3
+	from boto3.s3.transfer import TransferConfig
+	from botocore.exceptions import ClientError
+except ImportError:  # 只使用本地存储时不需要安装
+	boto3 = TransferConfig = None
+
+	class ClientError(Exception):
+		"""
+		没有安装boto3时内存中的对象存储使用的异常，参数和response属性与botocore的ClientError相同
+		"""
+
+		def __init__(self, error_response, operation_name):
+			super(ClientError, self).__init__('%s: %s' % (operation_name, error_response['Error']['Code']))
+			self.response = error_response
+			self.operation_name = operation_name
+
+
+def shard_path(filename):
+	"""
+	文件在分层目录中的相对路径
+	原图、缩略图以及其他格式的文件名前缀相同，保存在同一个目录中
+	:param filename: 文件名，已经包含目录时直接返回
+	"""
+	if '/' in filename:
+		return filename
+	# uuid或者用户名部分，不包括_s、_m等后缀
+	stem = re.split(r'[._]', filename, 1)[0]
+	digest = hashlib.md5(stem.encode('utf-8')).hexdigest()
+	return os.path.join(digest[:2], digest[2:4], filename)
+
+
+def media_path(directory, filename, create=False):
+	"""
+	写入文件时使用的路径
+	:param directory: 上传目录或者头像目录
+	:param create: 是否创建子目录
+	"""
+	path = os.path.join(directory, shard_path(filename))
+	if create:
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+	return path
+
+
+def locate_media(directory, filename):
+	"""
+	读取文件时使用的路径，兼容还没有迁移的旧文件
+	:return: 存在的文件路径，不存在时返回None
+	"""
+	path = os.path.join(directory, shard_path(filename))
+	if os.path.isfile(path):
+		return path
+	legacy = os.path.join(directory, filename)
+	if os.path.isfile(legacy):
+		return legacy
+	# 检查期间文件可能刚刚被迁移
+	return path if os.path.isfile(path) else None
+
+
+def remove_media(directory, filename):
+	"""
+	删除文件，文件不存在时忽略
+	"""
+	path = locate_media(directory, filename)
+	if path is not None:
+		os.remove(path)
+
+
+def shard_file(directory, filename):
+	"""
+	把根目录中的文件移动到分层目录中
+	:return: 是否移动了文件
+	"""
+	source = os.path.join(directory, filename)
+	if not os.path.isfile(source):
+		return False
+	target = media_path(directory, filename, create=True)
+	if os.path.exists(target):
+		# 文件名相同的文件内容相同，上次迁移中断时可能已经复制过去
+		os.remove(source)
+	else:
+		os.replace(source, target)
+	return True
+
+
+def migrate_directory(directory, batch_size=1000):
+	"""
+	把旧版本平铺在根目录中的文件分批移动到分层目录中
+	每一批重新扫描根目录，中断后再次执行会从剩下的文件继续
+	:return: 生成器，每一批移动的文件数量
+	"""
+	while True:
+		with os.scandir(directory) as entries:
+			# 跳过子目录和上传中的临时文件
+			batch = list(islice((entry.name for entry in entries
+								 if entry.is_file() and not entry.name.startswith('.')), batch_size))
+		if not batch:
+			return
+		yield sum(shard_file(directory, filename) for filename in batch)
+
+
+def walk_media(directory):
+	"""
+	目录中的所有文件，包括根目录中还没有迁移的文件，不包括其他子目录（头像、变体缓存等）和临时文件
+	:return: 生成器，(文件名, 修改时间)
+	"""
+	if not os.path.isdir(directory):
+		return
+	with os.scandir(directory) as entries:
+		shards = []
+		for entry in entries:
+			if entry.is_file() and not entry.name.startswith('.'):
+				yield entry.name, entry.stat().st_mtime
+			elif entry.is_dir() and SHARD_PATTERN.match(entry.name):
+				shards.append(entry.path)
+	for shard in shards:
+		for subdirectory in os.scandir(shard):
+			if not subdirectory.is_dir():
+				continue
+			for entry in os.scandir(subdirectory.path):
+				if entry.is_file() and not entry.name.startswith('.'):
+					yield entry.name, entry.stat().st_mtime
+
+
+def read_chunks(f, chunk_size):
+	"""
+	分块读取打开的文件，读取完成后关闭
+	"""
+	try:
+		for chunk in iter(lambda: f.read(chunk_size), b''):
+			yield chunk
+	finally:
+		f.close()
+
+
+def is_missing(error):
+	"""
+	对象存储的异常是否表示对象不存在
+	"""
+	return error.response['Error']['Code'] in ('NoSuchKey', '404')
+
+
+class LocalStorage(object):
+	"""
+	本地磁盘存储，所有web节点需要共享同一个目录
+	"""
+
+	def __init__(self, directory):
+		self.directory = directory
+
+	def path(self, name):
+		"""
+		本地文件路径，文件不存在时返回None
+		"""
+		return locate_media(self.directory, name)
+
+	def fetch(self, name):
+		"""
+		本地文件路径，与path相同
+		"""
+		return self.path(name)
+
+	@contextmanager
+	def local_copy(self, name):
+		"""
+		在with语句中使用的本地文件路径，与path相同
+		"""
+		yield self.path(name)
+
+	def put(self, name, source):
+		"""
+		保存文件
+		:param name: 文件名
+		:param source: 本地文件路径，保存后不再保留
+		"""
+		target = media_path(self.directory, name, create=True)
+		if os.path.abspath(source) != os.path.abspath(target):
+			os.replace(source, target)
+
+	def put_many(self, items):
+		"""
+		保存多个文件
+		:param items: (文件名, 本地文件路径)的列表
+		"""
+		for name, source in items:
+			self.put(name, source)
+
+	def get(self, name):
+		"""
+		读取文件的全部内容，文件不存在时抛出FileNotFoundError
+		"""
+		path = self.path(name)
+		if path is None:
+			raise FileNotFoundError(name)
+		with open(path, 'rb') as f:
+			return f.read()
+
+	def stream(self, name, chunk_size=64 * 1024):
+		"""
+		分块读取文件，文件不存在时立即抛出FileNotFoundError
+		:return: (文件大小, 生成器)
+		"""
+		path = self.path(name)
+		if path is None:
+			raise FileNotFoundError(name)
+		f = open(path, 'rb')
+		return os.fstat(f.fileno()).st_size, read_chunks(f, chunk_size)
+
+	def size(self, name):
+		"""
+		文件大小，文件不存在时返回None
+		"""
+		path = self.path(name)
+		return os.path.getsize(path) if path is not None else None
+
+	def exists(self, name):
+		return self.path(name) is not None
+
+	def delete(self, name):
+		remove_media(self.directory, name)
+
+	def delete_many(self, names):
+		"""
+		删除多个文件
+		"""
+		for name in names:
+			self.delete(name)
+
+	def names(self):
+		"""
+		存储中的所有文件
+		:return: 生成器，(文件名, 修改时间)
+		"""
+		return walk_media(self.directory)
+
+	def url(self, name, expires=None):
+		"""
+		本地文件由程序发送，没有单独的URL
+		"""
+		return None
+
+
+class SizeCache(object):
+	"""
+	对象大小的进程内缓存，避免每个请求都向对象存储发送HEAD请求
+	同一个文件名的内容不会改变，存在的对象一直缓存到按最近使用淘汰
+	不存在的对象只缓存一小段时间，缩略图等文件可能稍后才上传
+	其他进程删除的对象仍然会被当作存在，读取时返回404
+	"""
+
+	def __init__(self, max_entries, missing_ttl):
+		self.max_entries = max_entries
+		self.missing_ttl = missing_ttl
+		# 文件名与(大小, 过期时间)，大小为None表示不存在
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, name):
+		"""
+		:return: (是否命中, 大小)
+		"""
+		with self.lock:
+			entry = self.entries.get(name)
+			if entry is None:
+				return False, None
+			size, expires = entry
+			if expires is not None and expires < time.monotonic():
+				del self.entries[name]
+				return False, None
+			self.entries.move_to_end(name)
+			return True, size
+
+	def set(self, name, size):
+		expires = time.monotonic() + self.missing_ttl if size is None else None
+		with self.lock:
+			self.entries[name] = (size, expires)
+			self.entries.move_to_end(name)
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+
+	def discard(self, name):
+		with self.lock:
+			self.entries.pop(name, None)
+
+
+class S3Storage(object):
+	"""
+	S3兼容的对象存储
+	新文件先写入本地的暂存目录，缩略图生成之后再上传，上传完成后删除本地文件
+	暂存目录中的文件优先从本地读取
+	"""
+
+	def __init__(self, directory, bucket, prefix, client=None, endpoint_url=None, region=None, access_key=None,
+				 secret_key=None, workers=3, multipart_threshold=8 * 1024 * 1024, max_age=None, cache_size=10000,
+				 missing_ttl=60):
+		"""
+		:param directory: 本地暂存目录
+		:param prefix: 对象名的前缀，例如uploads
+		:param client: boto3的S3客户端或者MemoryS3Client，默认由boto3创建
+		:param endpoint_url: MinIO等服务的地址，使用AWS S3时为None
+		:param workers: 并行上传的线程数
+		:param multipart_threshold: 超过这个大小的文件分块上传
+		:param max_age: 对象的Cache-Control
+		:param cache_size: 进程内缓存的对象大小的数量
+		:param missing_ttl: 不存在的对象缓存的秒数
+		"""
+		if client is None:
+			if boto3 is None:
+				raise RuntimeError('S3 storage requires boto3, run "pip install boto3".')
+			client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region,
+								  aws_access_key_id=access_key, aws_secret_access_key=secret_key)
+		self.directory = directory
+		self.bucket = bucket
+		self.prefix = prefix
+		self.client = client
+		self.transfer = None
+		if TransferConfig is not None:
+			self.transfer = TransferConfig(multipart_threshold=multipart_threshold,
+										   multipart_chunksize=multipart_threshold)
+		self.executor = ThreadPoolExecutor(workers)
+		self.max_age = max_age
+		self.sizes = SizeCache(cache_size, missing_ttl)
+
+	def key(self, name):
+		"""
+		对象名，与本地目录相同使用分层的前缀，分散对象存储的分区
+		"""
+		return '%s/%s' % (self.prefix, shard_path(name).replace(os.sep, '/'))
+
+	def path(self, name):
+		"""
+		暂存目录中的文件路径，不存在时返回None
+		"""
+		return locate_media(self.directory, name)
+
+	def _download(self, name, target):
+		"""
+		下载到本地文件
+		:return: 对象是否存在
+		"""
+		try:
+			self.client.download_file(self.bucket, self.key(name), target)
+		except ClientError as e:
+			if is_missing(e):
+				return False
+			raise
+		return True
+
+	def fetch(self, name):
+		"""
+		本地文件路径，只在对象存储中时下载到暂存目录，下载的文件由调用者上传或删除
+		"""
+		path = self.path(name)
+		if path is not None:
+			return path
+		path = media_path(self.directory, name, create=True)
+		# 先下载到临时文件再重命名，其他请求不会读取到不完整的文件
+		fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+		os.close(fd)
+		try:
+			if not self._download(name, temp):
+				return None
+			os.replace(temp, path)
+		finally:
+			if os.path.exists(temp):
+				os.remove(temp)
+		return path
+
+	@contextmanager
+	def local_copy(self, name):
+		"""
+		在with语句中使用的本地文件路径，不存在时为None
+		只在对象存储中时下载到暂存目录中的临时文件，退出with语句时删除
+		"""
+		path = self.path(name)
+		if path is not None:
+			yield path
+			return
+		os.makedirs(self.directory, exist_ok=True)
+		# 以.开头的文件不会被当作存储中的文件，见walk_media
+		fd, temp = tempfile.mkstemp(dir=self.directory, prefix='.', suffix=os.path.splitext(name)[1])
+		os.close(fd)
+		try:
+			yield temp if self._download(name, temp) else None
+		finally:
+			os.remove(temp)
+
+	def put(self, name, source):
+		extra = {'ContentType': mimetypes.guess_type(name)[0] or 'application/octet-stream'}
+		if self.max_age is not None:
+			extra['CacheControl'] = 'public, max-age=%d, immutable' % self.max_age
+		size = os.path.getsize(source)
+		# 超过multipart_threshold时upload_file自动分块上传
+		self.client.upload_file(source, self.bucket, self.key(name), ExtraArgs=extra, Config=self.transfer)
+		self.sizes.set(name, size)
+		os.remove(source)
+
+	def put_many(self, items):
+		"""
+		并行上传多个文件，例如原图和两个缩略图
+		"""
+		futures = [self.executor.submit(self.put, name, source) for name, source in items]
+		for future in futures:
+			future.result()
+
+	def _get_object(self, name):
+		try:
+			return self.client.get_object(Bucket=self.bucket, Key=self.key(name))
+		except ClientError as e:
+			if is_missing(e):
+				self.sizes.set(name, None)
+				raise FileNotFoundError(name)
+			raise
+
+	def get(self, name):
+		path = self.path(name)
+		if path is not None:
+			with open(path, 'rb') as f:
+				return f.read()
+		return self._get_object(name)['Body'].read()
+
+	def stream(self, name, chunk_size=64 * 1024):
+		"""
+		分块读取文件，不存在时立即抛出FileNotFoundError，不需要先发送HEAD请求
+		:return: (文件大小, 生成器)
+		"""
+		path = self.path(name)
+		if path is not None:
+			f = open(path, 'rb')
+			return os.fstat(f.fileno()).st_size, read_chunks(f, chunk_size)
+		response = self._get_object(name)
+		return response['ContentLength'], read_chunks(response['Body'], chunk_size)
+
+	def size(self, name):
+		"""
+		文件大小，不存在时返回None，结果缓存在进程内
+		"""
+		path = self.path(name)
+		if path is not None:
+			return os.path.getsize(path)
+		hit, size = self.sizes.get(name)
+		if hit:
+			return size
+		try:
+			size = self.client.head_object(Bucket=self.bucket, Key=self.key(name))['ContentLength']
+		except ClientError as e:
+			if not is_missing(e):
+				raise
+			size = None
+		self.sizes.set(name, size)
+		return size
+
+	def exists(self, name):
+		return self.size(name) is not None
+
+	def delete(self, name):
+		remove_media(self.directory, name)
+		self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+		self.sizes.discard(name)
+
+	def delete_many(self, names):
+		"""
+		批量删除，每个请求最多1000个对象
+		"""
+		names = list(names)
+		for name in names:
+			remove_media(self.directory, name)
+			self.sizes.discard(name)
+		for i in range(0, len(names), 1000):
+			self.client.delete_objects(Bucket=self.bucket, Delete={
+				'Objects': [{'Key': self.key(name)} for name in names[i:i + 1000]], 'Quiet': True})
+
+	def names(self):
+		"""
+		对象存储和暂存目录中的所有文件
+		:return: 生成器，(文件名, 修改时间)
+		"""
+		for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefix + '/'):
+			for item in page.get('Contents', ()):
+				yield item['Key'].rsplit('/', 1)[-1], item['LastModified'].timestamp()
+		for item in walk_media(self.directory):
+			yield item
+
+	def url(self, name, expires=3600):
+		"""
+		预签名的下载地址
+		"""
+		return self.client.generate_presigned_url(
+			'get_object', Params={'Bucket': self.bucket, 'Key': self.key(name)}, ExpiresIn=expires)
+
+
+class MemoryBody(io.BytesIO):
+	"""
+	get_object返回的Body
+	"""
+
+	def iter_chunks(self, chunk_size=1024):
+		return iter(lambda: self.read(chunk_size), b'')
+
+
+class MemoryPaginator(object):
+	"""
+	list_objects_v2的分页，所有对象在一页中
+	"""
+
+	def __init__(self, client):
+		self.client = client
+
+	def paginate(self, Bucket, Prefix=''):
+		with self.client.lock:
+			contents = [{'Key': key, 'Size': len(data), 'LastModified': modified}
+						for (bucket, key), (data, extra, modified) in sorted(self.client.objects.items())
+						if bucket == Bucket and key.startswith(Prefix)]
+		yield {'Contents': contents, 'KeyCount': len(contents)}
+
+
+class MemoryS3Client(object):
+	"""
+	保存在内存中的对象存储，实现S3Storage用到的boto3客户端的方法，代替MinIO用于测试和开发
+	对象在进程退出后丢失，多个进程之间不共享
+	"""
+
+	def __init__(self):
+		# (bucket, key)与(内容, ExtraArgs, 修改时间)
+		self.objects = {}
+		self.lock = threading.Lock()
+
+	def _get(self, bucket, key, operation):
+		with self.lock:
+			item = self.objects.get((bucket, key))
+		if item is None:
+			code = '404' if operation in ('HeadObject', 'DownloadFile') else 'NoSuchKey'
+			raise ClientError({'Error': {'Code': code, 'Message': 'Not Found'}}, operation)
+		return item
+
+	def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Callback=None, Config=None):
+		with open(Filename, 'rb') as f:
+			data = f.read()
+		with self.lock:
+			self.objects[(Bucket, Key)] = (data, dict(ExtraArgs or {}), datetime.now(timezone.utc))
+
+	def download_file(self, Bucket, Key, Filename, ExtraArgs=None, Callback=None, Config=None):
+		data = self._get(Bucket, Key, 'DownloadFile')[0]
+		with open(Filename, 'wb') as f:
+			f.write(data)
+
+	def get_object(self, Bucket, Key):
+		data, extra, modified = self._get(Bucket, Key, 'GetObject')
+		return {'Body': MemoryBody(data), 'ContentLength': len(data), 'LastModified': modified,
+				'ContentType': extra.get('ContentType')}
+
+	def head_object(self, Bucket, Key):
+		data, extra, modified = self._get(Bucket, Key, 'HeadObject')
+		return {'ContentLength': len(data), 'LastModified': modified, 'ContentType': extra.get('ContentType')}
+
+	def delete_object(self, Bucket, Key):
+		with self.lock:
+			self.objects.pop((Bucket, Key), None)
+		return {}
+
+	def delete_objects(self, Bucket, Delete):
+		with self.lock:
+			for item in Delete['Objects']:
+				self.objects.pop((Bucket, item['Key']), None)
+		return {}
+
+	def get_paginator(self, operation_name):
+		if operation_name != 'list_objects_v2':
+			raise NotImplementedError(operation_name)
+		return MemoryPaginator(self)
+
+	def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600):
+		"""
+		内存中的对象没有下载地址，返回None时由程序转发
+		"""
+		return None
+
+
+# 存储区域与本地目录的配置项
+STORAGE_AREAS = {'uploads': 'ALBUMY_UPLOAD_PATH', 'avatars': 'AVATARS_SAVE_PATH'}
+
+
+def get_storage(area):
+	"""
+	当前程序的存储
+	:param area: uploads为图片，avatars为头像
+	"""
+	storages = current_app.extensions.setdefault('albumy_storage', {})
+	storage = storages.get(area)
+	if storage is None:
+		config = current_app.config
+		directory = config[STORAGE_AREAS[area]]
+		if config['ALBUMY_STORAGE'] in ('s3', 'memory'):
+			client = None
+			if config['ALBUMY_STORAGE'] == 'memory':
+				# 图片和头像使用同一个内存中的对象存储，与S3相同按前缀区分
+				client = current_app.extensions.setdefault('albumy_memory_s3', MemoryS3Client())
+			storage = S3Storage(
+				directory, config['ALBUMY_S3_BUCKET'], area,
+				client=client,
+				endpoint_url=config['ALBUMY_S3_ENDPOINT'],
+				region=config['ALBUMY_S3_REGION'],
+				access_key=config['ALBUMY_S3_ACCESS_KEY'],
+				secret_key=config['ALBUMY_S3_SECRET_KEY'],
+				workers=config['ALBUMY_S3_UPLOAD_WORKERS'],
+				multipart_threshold=config['ALBUMY_S3_MULTIPART_THRESHOLD'],
+				max_age=config['ALBUMY_MEDIA_MAX_AGE'],
+				cache_size=config['ALBUMY_S3_SIZE_CACHE'],
+				missing_ttl=config['ALBUMY_S3_MISSING_TTL'],
+			)
+		else:
+			storage = LocalStorage(directory)
+		storages[area] = storage
+	return storage
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+后台生成缩略图
+上传图片时只保存原图，缩略图在进程池中生成，不占用请求的时间
+Photo.thumbnail_status为pending的图片就是队列中的任务，程序异常退出后使用flask thumbnails生成
+使用对象存储时，原图先保存在本地，缩略图生成之后与原图一起并行上传
+"""
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from flask import current_app
+
+from albumy.extensions import db
+from albumy.models import Photo
+from albumy.settings import ThumbnailStatus, ALTERNATE_FORMATS
+from albumy.storage import get_storage
+from albumy.utils import resize_images, thumbnail_files, logger
+
+
+class ThumbnailQueue(object):
+	"""
+	缩略图任务队列
+	分发线程从内存队列中取出任务，交给进程池处理，完成后在回调中更新数据库
+	"""
+
+	def __init__(self, app):
+		self.app = app
+		self.queue = queue.Queue()
+		self.executor = None
+		self.thread = None
+		# 已经在队列中或者正在处理的原图文件名，避免重复处理
+		self.processing = set()
+		self.lock = threading.Lock()
+
+	def submit(self, photo):
+		"""
+		生成图片的缩略图
+		:param photo: 已经提交到数据库的Photo对象
+		"""
+		if self.app.config['ALBUMY_THUMBNAIL_SYNC']:
+			self.generate(photo.filename)
+			return
+		self._start()
+		self._put(photo.filename)
+
+	def generate(self, filename):
+		"""
+		在当前线程中生成缩略图
+		:param filename: 原图文件名
+		"""
+		try:
+			# 重新生成失败的缩略图时，原图可能已经上传到对象存储中
+			get_storage('uploads').fetch(filename)
+			filenames = resize_images(self.app.config['ALBUMY_UPLOAD_PATH'], filename,
+									  self.app.config['ALBUMY_PHOTO_SUFFIX'], self.app.config['ALBUMY_ENCODER_POLICY'])
+		except Exception:
+			logger.exception('生成缩略图失败，filename = {}'.format(filename))
+			filenames = None
+		self._apply(filename, filenames)
+
+	def _put(self, filename):
+		with self.lock:
+			if filename in self.processing:
+				return
+			self.processing.add(filename)
+		self.queue.put(filename)
+
+	def _start(self):
+		"""
+		第一次提交任务时启动进程池和分发线程
+		不在这里恢复上次未完成的任务，多个进程会重复处理同一批图片，由flask thumbnails统一处理
+		"""
+		with self.lock:
+			if self.thread is not None:
+				return
+			self.executor = ProcessPoolExecutor(self.app.config['ALBUMY_THUMBNAIL_WORKERS'])
+			self.thread = threading.Thread(target=self._dispatch, daemon=True)
+			self.thread.start()
+
+	def _dispatch(self):
+		while True:
+			filename = self.queue.get()
+			future = self.executor.submit(resize_images, self.app.config['ALBUMY_UPLOAD_PATH'], filename,
+										  self.app.config['ALBUMY_PHOTO_SUFFIX'], self.app.config['ALBUMY_ENCODER_POLICY'])
+			future.add_done_callback(partial(self._done, filename))
+
+	def _done(self, filename, future):
+		"""
+		进程池中的任务完成后调用，在独立的线程中执行，需要自己的程序上下文
+		"""
+		try:
+			filenames = future.result()
+		except Exception:
+			logger.exception('生成缩略图失败，filename = {}'.format(filename))
+			filenames = None
+		# 先移出处理中的集合，更新数据库期间提交的相同文件会重新处理，不会遗漏
+		with self.lock:
+			self.processing.discard(filename)
+		with self.app.app_context():
+			try:
+				self._apply(filename, filenames)
+			finally:
+				db.session.remove()
+
+	def _apply(self, filename, filenames):
+		"""
+		将生成的缩略图写入数据库
+		:param filenames: resize_images的返回值，失败时为None
+		"""
+		# 重复上传的图片共用同一个原图，一起更新
+		photos = Photo.query.filter_by(filename=filename).all()
+		if not photos:
+			# 生成期间图片被删除了，删除刚刚生成的缩略图
+			for name in (filenames or {}).values():
+				if name != filename:
+					for path in thumbnail_files(self.app.config['ALBUMY_UPLOAD_PATH'], name):
+						os.remove(path)
+			return
+		self._store(filename, filenames)
+		sizes = self.app.config['ALBUMY_PHOTO_SIZE']
+		for photo in photos:
+			if filenames is None:
+				photo.thumbnail_status = ThumbnailStatus.FAILED
+			else:
+				photo.filename_s = filenames[sizes['small']]
+				photo.filename_m = filenames[sizes['medium']]
+				photo.thumbnail_status = ThumbnailStatus.READY
+		db.session.commit()
+
+	def _store(self, filename, filenames):
+		"""
+		把原图、缩略图以及其他格式的文件放入存储，对象存储会并行上传
+		"""
+		storage = get_storage('uploads')
+		names = set((filenames or {}).values())
+		names.add(filename)
+		for name in list(names):
+			names.update(os.path.splitext(name)[0] + ext for mimetype, ext, fmt in ALTERNATE_FORMATS)
+		items = []
+		for name in names:
+			path = storage.path(name)
+			if path is not None:
+				items.append((name, path))
+		storage.put_many(items)
+
+
+def get_thumbnail_queue():
+	"""
+	当前程序的缩略图队列
+	"""
+	thumbnails = current_app.extensions.get('albumy_thumbnails')
+	if thumbnails is None:
+		thumbnails = current_app.extensions['albumy_thumbnails'] = ThumbnailQueue(current_app._get_current_object())
+	return thumbnails
+
+
+def process_pending(failed=False):
+	"""
+	在当前进程中生成所有等待中的缩略图
+	:param failed: 是否同时重新生成失败的缩略图
+	:return: 处理的原图数量
+	"""
+	statuses = [ThumbnailStatus.PENDING]
+	if failed:
+		statuses.append(ThumbnailStatus.FAILED)
+	thumbnails = ThumbnailQueue(current_app._get_current_object())
+	filenames = db.session.query(Photo.filename).filter(Photo.thumbnail_status.in_(statuses)).distinct().all()
+	for (filename,) in filenames:
+		thumbnails.generate(filename)
+	return len(filenames)
@@ -2,6 +2,7 @@
 import os
 import uuid
 import logging
+from contextlib import contextmanager
 from logging.handlers import RotatingFileHandler
 from datetime import datetime
 
@@ -18,7 +19,8 @@ from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 
 from albumy.extensions import db
 from albumy.models import User
-from albumy.settings import Operations
+from albumy.settings import Operations, ALTERNATE_FORMATS
+from albumy.storage import media_path, locate_media
 
 
 def generate_token(user, operation, expire_in=None, **kwargs):
@@ -95,33 +97,102 @@ def rename_image(old_filename):
 	return new_filename
 
 
-def resize_image(image, filename, base_width):
+def resize_images(upload_path, filename, sizes, policy=None):
 	"""
-	使用PIL库重新设置图片的尺寸大小
-	:param image: 图片
-	:param filename: 文件名
-	:param base_width: 需要调整的基准值
-	:return: 返回新的文件名
+	使用PIL库生成多个尺寸的图片，原图只解码一次
+	JPEG图片使用draft模式，解码时直接缩小到1/2、1/4或者1/8，只要不小于最大的目标尺寸
+	从大到小依次生成，小图由上一个尺寸的结果缩小得到，不再从原图缩小
+	不依赖current_app，可以在进程池中执行
+	:param upload_path: 上传路径
+	:param filename: 原图文件名
+	:param sizes: 基准宽度与后缀的字典，即settings.py中的ALBUMY_PHOTO_SUFFIX
+	:param policy: 后缀与编码策略的字典，即settings.py中的ALBUMY_ENCODER_POLICY
+	:return: 基准宽度与新文件名的字典，不需要调整时为原图文件名
 	"""
-	filename, ext = os.path.splitext(filename)
-	img = Image.open(image)
-	# 如何要求，不用调整
-	if img.size[0] <= base_width:
-		return filename + ext
-	# 宽的百分比
-	w_percent = (base_width / float(img.size[0]))
-	# 调整高度
-	h_size = int((float(img.size[1]) * float(w_percent)))
-	# 重设图片大小
-	img = img.resize((base_width, h_size), PIL.Image.ANTIALIAS)
+	name, ext = os.path.splitext(filename)
+	img = Image.open(locate_media(upload_path, filename) or media_path(upload_path, filename))
+	width, height = img.size
+	# 如果比基准值小，不用调整
+	filenames = {base_width: filename for base_width in sizes if width <= base_width}
+	widths = sorted((base_width for base_width in sizes if width > base_width), reverse=True)
+	if not widths:
+		return filenames
+	if img.format == 'JPEG':
+		# 解码尺寸不会小于请求的尺寸
+		img.draft(img.mode, (widths[0], int(height * widths[0] / float(width))))
+	# 解码一次，后面每个尺寸都使用解码后的数据
+	img.load()
+	for base_width in widths:
+		# 宽的百分比，使用原图的比例，避免逐级缩小时累积误差
+		w_percent = (base_width / float(width))
+		# 调整高度
+		h_size = int((float(height) * float(w_percent)))
+		# 重设图片大小
+		img = img.resize((base_width, h_size), PIL.Image.ANTIALIAS)
+		# 给图片添加后缀，即_s 或者 _m，按编码策略保存
+		suffix = sizes[base_width]
+		filenames[base_width] = save_image(img, upload_path, name + suffix, ext, (policy or {}).get(suffix, {}))
+	return filenames
 
-	# 给图片添加后缀
-	# 在settings.py中，有两个属性，ALBUMY_PHOTO_SIZE 和 ALBUMY_PHOTO_SUFFIX
-	# 根据base_width值的大小，可以得到后缀，即_s 或者 _m
-	filename += current_app.config['ALBUMY_PHOTO_SUFFIX'][base_width] + ext
-	# 保存到对应路径，并压缩
-	img.save(os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], filename), optimize=True, quality=85)
-	return filename
+
+def thumbnail_files(upload_path, filename):
+	"""
+	缩略图以及另外保存的其他格式的文件
+	:return: 存在的文件路径列表
+	"""
+	name = os.path.splitext(filename)[0]
+	paths = [locate_media(upload_path, filename)]
+	for mimetype, ext, fmt in ALTERNATE_FORMATS:
+		path = locate_media(upload_path, name + ext)
+		if path not in paths:
+			paths.append(path)
+	return [path for path in paths if path is not None]
+
+
+def has_alpha(img):
+	"""
+	图片是否有透明通道
+	"""
+	return img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+
+
+def encoder_available(fmt):
+	"""
+	当前的Pillow是否可以保存该格式，例如AVIF需要插件
+	"""
+	Image.init()
+	return fmt.upper() in Image.SAVE
+
+
+def save_image(img, upload_path, name, ext, options):
+	"""
+	按编码策略保存图片
+	:param name: 不带后缀的文件名
+	:param ext: 原图的后缀
+	:param options: 编码策略，见settings.py中的ALBUMY_ENCODER_POLICY
+	:return: 文件名
+	"""
+	quality = options.get('quality', 85)
+	fmt = Image.registered_extensions().get(ext.lower())
+	if fmt == 'PNG' and options.get('lossy_png') and not has_alpha(img):
+		# 没有透明通道的PNG转换成JPEG，截图等图片可以小很多
+		fmt, ext = 'JPEG', '.jpg'
+	if fmt == 'JPEG':
+		if img.mode not in ('RGB', 'L'):
+			img = img.convert('RGB')
+		img.save(media_path(upload_path, name + ext, create=True), fmt, optimize=True, quality=quality,
+				 progressive=options.get('progressive', False))
+	else:
+		img.save(media_path(upload_path, name + ext, create=True), optimize=True, quality=quality)
+
+	# 另外保存的格式，请求时根据Accept选择
+	for mimetype, alt_ext, alt_fmt in ALTERNATE_FORMATS:
+		if alt_fmt.lower() in options.get('formats', ()) and encoder_available(alt_fmt):
+			alt = img
+			if img.mode not in ('RGB', 'RGBA'):
+				alt = img.convert('RGBA' if has_alpha(img) else 'RGB')
+			alt.save(media_path(upload_path, name + alt_ext, create=True), alt_fmt, quality=quality)
+	return name + ext
 
 
 def is_safe_url(target):
@@ -162,6 +233,42 @@ def flash_errors(form):
 			))
 
 
+@contextmanager
+def count_queries():
+	"""
+	记录代码块中执行的SQL语句，用于检查N+1查询
+		with count_queries() as statements:
+			...
+		print(len(statements))
+	"""
+	statements = []
+
+	def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+		statements.append(statement)
+
+	engine = db.get_engine()
+	db.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+	try:
+		yield statements
+	finally:
+		db.event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@contextmanager
+def assert_max_queries(limit):
+	"""
+	代码块中执行的SQL语句超过limit条时抛出AssertionError，在测试中防止查询数量回退
+		with assert_max_queries(6):
+			client.get('/photo/1')
+	:param limit: SQL语句数量的上限
+	"""
+	with count_queries() as statements:
+		yield statements
+	if len(statements) > limit:
+		raise AssertionError('执行了{}条SQL语句，上限为{}：\n{}'.format(
+			len(statements), limit, '\n'.join(statements)))
+
+
 def _log():
 	# 创建logger，如果参数为空则返回root logger
 	logger = logging.getLogger("Albumy")
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+按需生成的图片变体，例如 /uploads/xxx.jpg?w=200&fmt=webp
+只允许配置中的宽度和格式，第一次请求时生成，保存在有大小上限的磁盘缓存中，按最近使用时间淘汰
+同一个变体的并发请求只会生成一次：进程内用线程锁，进程之间用文件锁
+"""
+import hashlib
+import io
+import os
+import tempfile
+import threading
+
+from PIL import Image, features
+from flask import current_app, request, abort, safe_join, Response
+
+from albumy.media import media_etag, send_media, cache_headers
+from albumy.storage import get_storage
+
+try:
+	import fcntl
+except ImportError:  # windows，只在进程内合并请求
+	fcntl = None
+
+# 格式与文件后缀
+FORMAT_EXTENSIONS = {'jpeg': '.jpg', 'png': '.png', 'webp': '.webp'}
+# 没有指定格式时，按原图后缀使用的格式
+EXTENSION_FORMATS = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.png': 'png', '.webp': 'webp'}
+# 文件锁的数量，不同的变体按哈希值共用锁文件，锁文件数量固定
+LOCK_STRIPES = 256
+
+
+def format_supported(fmt):
+	"""
+	当前的Pillow是否支持该格式
+	"""
+	if fmt not in FORMAT_EXTENSIONS:
+		return False
+	return fmt != 'webp' or features.check('webp')
+
+
+def render_variant(source, target, width, fmt):
+	"""
+	生成一个变体
+	:param source: 原图路径或者文件对象
+	:param target: 变体路径
+	:param width: 宽度，None或者原图更窄时不缩放
+	:param fmt: 格式，jpeg、png或者webp
+	"""
+	img = Image.open(source)
+	if width is not None and img.size[0] > width:
+		height = int(img.size[1] * width / float(img.size[0]))
+		if img.format == 'JPEG':
+			img.draft(img.mode, (width, height))
+		img = img.resize((width, height), Image.ANTIALIAS)
+	if fmt == 'jpeg' and img.mode not in ('RGB', 'L'):
+		img = img.convert('RGB')
+	elif fmt == 'webp' and img.mode not in ('RGB', 'RGBA'):
+		img = img.convert('RGBA' if 'A' in img.mode or 'transparency' in img.info else 'RGB')
+	elif fmt == 'png' and img.mode == 'CMYK':
+		img = img.convert('RGB')
+	img.save(target, fmt.upper(), quality=85)
+
+
+class VariantCache(object):
+	"""
+	有大小上限的变体磁盘缓存
+	命中时更新文件的修改时间，超过上限时删除修改时间最早的文件，直到低于上限的90%
+	"""
+
+	def __init__(self, path, max_size):
+		self.path = path
+		self.max_size = max_size
+		# 缓存的总大小，第一次写入时统计
+		self.size = None
+		self.lock = threading.Lock()
+		# 正在生成的变体，每个变体一个线程锁
+		self.rendering = {}
+		os.makedirs(os.path.join(self.path, 'locks'), exist_ok=True)
+
+	def get(self, name, render):
+		"""
+		获取变体文件，不存在时调用render生成
+		:param name: 变体文件名
+		:param render: render(target)，生成变体并写入target
+		:return: 变体文件的路径
+		"""
+		path = os.path.join(self.path, name)
+		if self._touch(path):
+			return path
+		with self.lock:
+			lock = self.rendering.setdefault(name, threading.Lock())
+		try:
+			with lock:
+				# 等待期间可能已经由其他线程生成了
+				if self._touch(path):
+					return path
+				stripe = int(hashlib.sha1(name.encode('utf-8')).hexdigest(), 16) % LOCK_STRIPES
+				with open(os.path.join(self.path, 'locks', '%02x.lock' % stripe), 'w') as lockfile:
+					if fcntl is not None:
+						fcntl.flock(lockfile, fcntl.LOCK_EX)
+					# 等待期间可能已经由其他进程生成了
+					if self._touch(path):
+						return path
+					self._render(path, render)
+		finally:
+			with self.lock:
+				self.rendering.pop(name, None)
+		return path
+
+	def _touch(self, path):
+		"""
+		文件存在时更新修改时间，作为最近使用时间
+		"""
+		try:
+			os.utime(path)
+			return True
+		except OSError:
+			return False
+
+	def _render(self, path, render):
+		# 先写入临时文件，再重命名，其他进程不会读取到不完整的文件
+		fd, temp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+		os.close(fd)
+		try:
+			render(temp)
+			os.replace(temp, path)
+		except Exception:
+			os.remove(temp)
+			raise
+		self._add(os.path.getsize(path))
+
+	def _add(self, size):
+		with self.lock:
+			if self.size is None:
+				self.size = sum(size for name, size, mtime in self.files())
+			else:
+				self.size += size
+			if self.size > self.max_size:
+				self.evict()
+
+	def files(self):
+		"""
+		缓存中的所有变体文件
+		:return: (路径, 大小, 修改时间)的列表
+		"""
+		files = []
+		for entry in os.scandir(self.path):
+			if entry.is_file() and not entry.name.endswith('.tmp'):
+				stat = entry.stat()
+				files.append((entry.path, stat.st_size, stat.st_mtime))
+		return files
+
+	def discard(self, name):
+		"""
+		删除一个变体，文件不存在时忽略
+		"""
+		path = os.path.join(self.path, name)
+		try:
+			size = os.path.getsize(path)
+			os.remove(path)
+		except OSError:
+			return
+		with self.lock:
+			if self.size is not None:
+				self.size -= size
+
+	def evict(self):
+		"""
+		按最近使用时间淘汰，其他进程写入的文件也会统计进来
+		"""
+		files = sorted(self.files(), key=lambda item: item[2])
+		total = sum(size for path, size, mtime in files)
+		for path, size, mtime in files:
+			if total <= self.max_size * 0.9:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				continue
+			total -= size
+		self.size = total
+
+
+def get_variant_cache():
+	"""
+	当前程序的变体缓存
+	"""
+	cache = current_app.extensions.get('albumy_variants')
+	if cache is None:
+		cache = current_app.extensions['albumy_variants'] = VariantCache(
+			current_app.config['ALBUMY_VARIANT_CACHE_PATH'], current_app.config['ALBUMY_VARIANT_CACHE_SIZE'])
+	return cache
+
+
+def variant_name(filename, width, fmt):
+	"""
+	变体的文件名，原图在子目录中时把/替换掉
+	"""
+	name = os.path.splitext(filename)[0].replace('/', '_')
+	return '%s_w%s%s' % (name, width or '', FORMAT_EXTENSIONS[fmt])
+
+
+def remove_variants(filename):
+	"""
+	删除原图在当前节点缓存中的所有变体
+	:param filename: 原图文件名
+	"""
+	cache = get_variant_cache()
+	for width in (None,) + tuple(current_app.config['ALBUMY_VARIANT_WIDTHS']):
+		for fmt in FORMAT_EXTENSIONS:
+			cache.discard(variant_name(filename, width, fmt))
+
+
+def send_variant(filename, width, fmt):
+	"""
+	发送图片的变体，不存在时生成
+	:param filename: 原图文件名
+	:param width: 宽度，必须在ALBUMY_VARIANT_WIDTHS中，None表示不缩放
+	:param fmt: 格式，必须在ALBUMY_VARIANT_FORMATS中，None表示与原图相同
+	"""
+	if fmt is None:
+		fmt = EXTENSION_FORMATS.get(os.path.splitext(filename)[1].lower())
+	if width is not None and width not in current_app.config['ALBUMY_VARIANT_WIDTHS']:
+		abort(404)
+	if fmt not in current_app.config['ALBUMY_VARIANT_FORMATS'] or not format_supported(fmt):
+		abort(404)
+
+	etag = media_etag('%s?w=%s&fmt=%s' % (filename, width or '', fmt))
+	if etag in request.if_none_match:
+		return cache_headers(Response(status=304), etag)
+
+	storage = get_storage('uploads')
+	safe_join(storage.directory, filename)
+	cache = get_variant_cache()
+	name = variant_name(filename, width, fmt)
+	# 缓存命中时不访问原图；对象存储中的原图，生成变体时才读取到内存中，不存在时返回404
+	try:
+		cache.get(name, lambda target: render_variant(
+			storage.path(filename) or io.BytesIO(storage.get(filename)), target, width, fmt))
+	except FileNotFoundError:
+		abort(404)
+	return send_media(cache.path, name, 'variants', etag)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+当前登录用户（viewer）与页面中图片、用户的关系
+一页图片或用户只需要每种关系执行一次IN (...)查询，保存在request中，只在本次请求内有效
+User.is_collecting/is_following/is_followed_by会优先从这里读取
+"""
+from flask import request
+from flask_login import current_user
+
+from albumy.extensions import db
+from albumy.models import Collect, Follow
+
+
+class ViewerState(object):
+	"""
+	登录用户的收藏和关注关系
+	"""
+
+	def __init__(self, user_id):
+		self.user_id = user_id
+		# 已经查询过的图片id，以及其中被收藏的图片id
+		self.photo_ids = set()
+		self.collected_ids = set()
+		# 已经查询过的用户id，以及其中关注的、被其关注的用户id
+		self.user_ids = set()
+		self.following_ids = set()
+		self.follower_ids = set()
+
+	def load_photos(self, photos):
+		"""
+		一次查询这一页图片中哪些被收藏了
+		:param photos: Photo对象列表
+		"""
+		ids = set(photo.id for photo in photos if photo.id is not None) - self.photo_ids
+		if not ids:
+			return
+		self.collected_ids.update(
+			collected_id for (collected_id,) in db.session.query(Collect.collected_id).filter(
+				Collect.collector_id == self.user_id, Collect.collected_id.in_(ids)
+			)
+		)
+		self.photo_ids.update(ids)
+
+	def load_users(self, users):
+		"""
+		一次查询这一页用户中哪些是关注的，哪些关注了自己
+		:param users: User对象列表
+		"""
+		ids = set(user.id for user in users if user.id is not None) - self.user_ids
+		if not ids:
+			return
+		self.following_ids.update(
+			followed_id for (followed_id,) in db.session.query(Follow.followed_id).filter(
+				Follow.follower_id == self.user_id, Follow.followed_id.in_(ids)
+			)
+		)
+		self.follower_ids.update(
+			follower_id for (follower_id,) in db.session.query(Follow.follower_id).filter(
+				Follow.followed_id == self.user_id, Follow.follower_id.in_(ids)
+			)
+		)
+		self.user_ids.update(ids)
+
+	def is_collecting(self, photo_id):
+		"""
+		:return: True/False，没有查询过返回None
+		"""
+		if photo_id not in self.photo_ids:
+			return None
+		return photo_id in self.collected_ids
+
+	def is_following(self, user_id):
+		if user_id not in self.user_ids:
+			return None
+		return user_id in self.following_ids
+
+	def is_followed_by(self, user_id):
+		if user_id not in self.user_ids:
+			return None
+		return user_id in self.follower_ids
+
+	def set_collecting(self, photo_id, collecting):
+		"""
+		收藏或者取消收藏后更新
+		"""
+		self.photo_ids.add(photo_id)
+		if collecting:
+			self.collected_ids.add(photo_id)
+		else:
+			self.collected_ids.discard(photo_id)
+
+	def set_following(self, user_id, following):
+		"""
+		关注或者取消关注后更新，只有在查询过该用户时才记录，否则无法知道对方是否关注了自己
+		"""
+		if user_id not in self.user_ids:
+			return
+		if following:
+			self.following_ids.add(user_id)
+		else:
+			self.following_ids.discard(user_id)
+
+
+def get_viewer_state():
+	"""
+	获取本次请求的ViewerState，未登录时返回None
+	"""
+	if not current_user.is_authenticated:
+		return None
+	state = getattr(request, 'viewer_state', None)
+	if state is None or state.user_id != current_user.id:
+		state = request.viewer_state = ViewerState(current_user.id)
+	return state
+
+
+def load_photos(photos):
+	"""
+	预先查询一页图片的收藏状态
+	"""
+	state = get_viewer_state()
+	if state is not None:
+		state.load_photos(photos)
+
+
+def load_users(users):
+	"""
+	预先查询一页用户的关注状态
+	"""
+	state = get_viewer_state()
+	if state is not None:
+		state.load_users(users)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+from flask import url_for
+
+from albumy import create_app
+from albumy.extensions import db
+from albumy.models import Role, User
+
+
+class BaseTestCase(unittest.TestCase):
+	"""
+	测试的基类，每个测试使用新的内存数据库和临时的上传目录
+	"""
+
+	def setUp(self):
+		app = create_app('testing')
+		self.directory = tempfile.mkdtemp()
+		app.config['ALBUMY_UPLOAD_PATH'] = self.directory
+		app.config['AVATARS_SAVE_PATH'] = os.path.join(self.directory, 'avatars')
+		app.config['ALBUMY_VARIANT_CACHE_PATH'] = os.path.join(self.directory, 'variants')
+		os.makedirs(app.config['AVATARS_SAVE_PATH'])
+		self.app = app
+		self.context = app.test_request_context()
+		self.context.push()
+		self.client = app.test_client()
+		self.runner = app.test_cli_runner()
+
+		db.create_all()
+		Role.init_role()
+		self.admin = self.create_user('admin', app.config['ALBUMY_ADMIN_EMAIL'])
+		self.user = self.create_user('normal', 'normal@helloflask.com')
+
+	def tearDown(self):
+		db.session.remove()
+		db.drop_all()
+		self.context.pop()
+		shutil.rmtree(self.directory, ignore_errors=True)
+
+	def create_user(self, username, email, password='123456'):
+		user = User(name=username, username=username, email=email, confirmed=True)
+		user.set_password(password)
+		db.session.add(user)
+		db.session.commit()
+		return user
+
+	def login(self, email=None, password='123456'):
+		if email is None:
+			email = self.user.email
+		return self.client.post(url_for('auth.login'), data=dict(email=email, password=password),
+								follow_redirects=True)
+
+	def logout(self):
+		return self.client.get(url_for('auth.logout'), follow_redirects=True)
+
+	def image(self, size=(800, 600), fmt='JPEG', color=(200, 10, 10)):
+		"""
+		生成一张测试用的图片
+		:return: 图片内容
+		"""
+		buffer = io.BytesIO()
+		Image.new('RGB', size, color).save(buffer, fmt)
+		return buffer.getvalue()
+
+	def upload(self, data, filename='test.jpg'):
+		return self.client.post(url_for('main.upload'), data={'file': (io.BytesIO(data), filename)},
+								content_type='multipart/form-data')
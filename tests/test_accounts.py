@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+from flask import url_for
+
+from albumy.accounts import delete_user_data
+from albumy.extensions import db
+from albumy.models import Photo, Tag, User, Follow, Collect, Comment, TimelineEntry, Notification, \
+	rebuild_counters
+from albumy.notifications import get_notification_writer
+from albumy.storage import get_storage
+from tests.base import BaseTestCase
+
+
+class DeletingAccountTestCase(BaseTestCase):
+	"""
+	账号在后台删除完成之前就不再显示
+	"""
+
+	def setUp(self):
+		super(DeletingAccountTestCase, self).setUp()
+		self.login()
+		self.upload(self.image())
+		self.photo = Photo.query.one()
+		self.client.post(url_for('main.new_tag', photo_id=self.photo.id), data=dict(tag='deleting'))
+		self.tag = Tag.query.filter_by(name='deleting').one()
+		self.logout()
+
+		self.other = self.create_user('other', 'other@helloflask.com')
+		self.admin.follow(self.user)
+		self.user.follow(self.admin)
+		self.admin.collect(self.photo)
+		self.other.follow(self.admin)
+		self.other.collect(self.photo)
+		self.photo_url = url_for('main.show_photo', photo_id=self.photo.id)
+		self.profile_url = url_for('user.index', username=self.user.username)
+
+	def assert_visible(self, visible):
+		self.login(self.admin.email)
+		for url in (url_for('main.index'), url_for('main.explore'), url_for('main.show_tag', tag_id=self.tag.id),
+					url_for('user.show_collections', username=self.admin.username)):
+			data = self.client.get(url).get_data(as_text=True)
+			self.assertEqual(self.photo_url in data, visible, url)
+		for url in (url_for('user.show_followers', username=self.admin.username),
+					url_for('user.show_following', username=self.admin.username),
+					url_for('main.show_collectors', photo_id=self.photo.id)):
+			data = self.client.get(url).get_data(as_text=True)
+			self.assertEqual(self.profile_url in data, visible, url)
+		for url in (self.photo_url, url_for('ajax.get_profile', user_id=self.user.id),
+					url_for('user.show_collections', username=self.user.username),
+					url_for('user.show_followers', username=self.user.username),
+					url_for('user.show_following', username=self.user.username)):
+			self.assertEqual(self.client.get(url).status_code, 200 if visible else 404, url)
+
+	def test_hide_deleting_account(self):
+		self.user.collect(self.photo)
+		self.assert_visible(True)
+		self.user.deleting = True
+		db.session.commit()
+		self.logout()
+		self.assert_visible(False)
+		# 其他用户的数据不受影响
+		data = self.client.get(url_for('user.show_followers', username=self.admin.username)).get_data(as_text=True)
+		self.assertIn(url_for('user.index', username=self.other.username), data)
+
+
+class DeleteUserDataTestCase(BaseTestCase):
+
+	def setUp(self):
+		super(DeleteUserDataTestCase, self).setUp()
+		self.other = self.create_user('other', 'other@helloflask.com')
+		self.login(self.admin.email)
+		self.upload(self.image(color=(0, 0, 200)))
+		self.logout()
+		self.login()
+		for color in ((10, 0, 0), (20, 0, 0), (30, 0, 0)):
+			self.upload(self.image(color=color))
+		photos = Photo.query.filter_by(author_id=self.user.id).all()
+		for photo in photos:
+			self.client.post(url_for('main.new_tag', photo_id=photo.id), data=dict(tag='sky sea'))
+		admin_photo = Photo.query.filter_by(author_id=self.admin.id).one()
+		self.client.post(url_for('main.new_comment', photo_id=admin_photo.id), data=dict(body='nice'))
+		self.logout()
+
+		writer = get_notification_writer()
+		for user in (self.admin, self.other):
+			user.follow(self.user)
+			self.user.follow(user)
+			for photo in photos:
+				user.collect(photo)
+			writer.push(user.id, 'follow', self.user.id, user.id)
+			writer.push(self.user.id, 'follow', user.id, self.user.id)
+		self.user.collect(admin_photo)
+		# 其他用户在这个用户的图片下评论，这个用户在其他用户的评论下回复
+		comment = Comment(body='comment', author=self.admin, photo=photos[0])
+		db.session.add(comment)
+		db.session.add(Comment(body='reply', author=self.user, photo=photos[0], replied=comment))
+		db.session.add(Comment(body='reply', author=self.other, photo=admin_photo,
+							   replied=Comment.query.filter_by(author_id=self.user.id).first()))
+		db.session.commit()
+		self.files = [name for photo in photos for name in (photo.filename, photo.filename_s, photo.filename_m)]
+		self.user_id = self.user.id
+		self.user.deleting = True
+		db.session.commit()
+
+	def counters(self):
+		db.session.expire_all()
+		return (
+			sorted(db.session.query(User.id, User.photo_count, User.collection_count, User.follower_count,
+									User.following_count, User.unread_count)),
+			sorted(db.session.query(Photo.id, Photo.collect_count, Photo.comment_count)),
+			sorted(db.session.query(Tag.id, Tag.photo_count)),
+		)
+
+	def assert_deleted(self):
+		user_id = self.user_id
+		self.assertIsNone(User.query.get(user_id))
+		self.assertEqual(Photo.query.filter_by(author_id=user_id).count(), 0)
+		self.assertEqual(Follow.query.filter(db.or_(Follow.follower_id == user_id,
+													Follow.followed_id == user_id)).count(), 0)
+		self.assertEqual(Collect.query.filter_by(collector_id=user_id).count(), 0)
+		self.assertEqual(Comment.query.filter_by(author_id=user_id).count(), 0)
+		self.assertEqual(TimelineEntry.query.filter_by(user_id=user_id).count(), 0)
+		self.assertEqual(Notification.query.filter(db.or_(Notification.receiver_id == user_id,
+														  Notification.actor_id == user_id)).count(), 0)
+		storage = get_storage('uploads')
+		for name in self.files:
+			self.assertFalse(storage.exists(name), name)
+		counters = self.counters()
+		rebuild_counters()
+		self.assertEqual(counters, self.counters())
+
+	def test_delete_user_data(self):
+		delete_user_data(self.user_id, chunk_size=1)
+		self.assert_deleted()
+
+	def test_concurrent_deletion(self):
+		# 选出一批关注之后、减少计数器之前，其他进程删除了同一批数据并且已经减少了计数器
+		table = Follow.__table__
+		users = User.__table__
+		deleted = []
+
+		def delete_before_update(conn, cursor, statement, parameters, context, executemany):
+			if not deleted and statement.startswith('UPDATE user') and 'follow' in statement:
+				follower_id, followed_id = conn.execute(db.select([table.c.follower_id, table.c.followed_id]).where(
+					db.or_(table.c.follower_id == self.user_id, table.c.followed_id == self.user_id)).limit(1)).first()
+				deleted.append((follower_id, followed_id))
+				conn.execute(table.delete().where(db.and_(table.c.follower_id == follower_id,
+														  table.c.followed_id == followed_id)))
+				conn.execute(users.update().where(users.c.id == follower_id).values(
+					following_count=users.c.following_count - 1))
+				conn.execute(users.update().where(users.c.id == followed_id).values(
+					follower_count=users.c.follower_count - 1))
+
+		db.event.listen(db.engine, 'before_cursor_execute', delete_before_update)
+		try:
+			delete_user_data(self.user_id, chunk_size=1)
+		finally:
+			db.event.remove(db.engine, 'before_cursor_execute', delete_before_update)
+		self.assertEqual(len(deleted), 1)
+		self.assert_deleted()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+from array import array
+
+from flask import url_for
+
+from albumy.caches import ExploreSampler, TagCache, get_explore_sampler, get_tag_cache
+from albumy.extensions import db
+from albumy.models import Photo, Tag
+from albumy.utils import count_queries
+from tests.base import BaseTestCase
+
+
+class ExploreSamplerTestCase(BaseTestCase):
+
+	def setUp(self):
+		super(ExploreSamplerTestCase, self).setUp()
+		photos = [Photo(filename='%d.jpg' % i, filename_s='%d.jpg' % i, filename_m='%d.jpg' % i, author=self.user)
+				  for i in range(5)]
+		db.session.add_all(photos)
+		db.session.commit()
+		self.ids = [photo.id for photo in photos]
+		self.sampler = ExploreSampler(600)
+		self.sampler.refresh()
+
+	def test_add_out_of_order(self):
+		# 加载之后其他进程上传了图片，id小于数组中最大的id
+		missing = self.ids[2]
+		self.sampler.ids = array('q', [photo_id for photo_id in self.ids if photo_id != missing])
+		self.sampler.weights = array('d', [1.0, 2.0, 3.0, 4.0])
+		self.sampler.add(missing)
+		self.assertEqual(list(self.sampler.ids), self.ids)
+		self.assertEqual(list(self.sampler.weights), [1.0, 2.0, 3.0, 4.0, 5.0])
+		self.assertEqual(sorted(self.sampler.sample(10)), self.ids)
+		self.assertEqual(sorted(self.sampler.sample(10, 'popular')), self.ids)
+
+	def test_remove(self):
+		self.sampler.remove(self.ids[0])
+		# 不在数组中的id不影响可以抽取的数量
+		self.sampler.remove(self.ids[-1] + 100)
+		self.assertEqual(sorted(self.sampler.sample(10)), self.ids[1:])
+		self.sampler.add(self.ids[0])
+		self.assertEqual(sorted(self.sampler.sample(10)), self.ids)
+
+	def test_popular(self):
+		photo = Photo.query.get(self.ids[1])
+		photo.collect_count = 1000
+		db.session.commit()
+		self.sampler.refresh()
+		# 按收藏数加权，收藏多的图片几乎总是被抽到
+		hits = sum(self.sampler.sample(1, 'popular') == [self.ids[1]] for _ in range(200))
+		self.assertGreater(hits, 150)
+
+	def test_explore(self):
+		self.login()
+		response = self.client.get(url_for('main.explore'))
+		self.assertEqual(response.get_data(as_text=True).count('photo-card'), 5)
+		get_explore_sampler().remove(self.ids[0])
+		response = self.client.get(url_for('main.explore'))
+		self.assertEqual(response.get_data(as_text=True).count('photo-card'), 4)
+		for bias in ('recent', 'popular', 'unknown'):
+			response = self.client.get(url_for('main.explore', bias=bias))
+			self.assertEqual(response.status_code, 200)
+			self.assertNotIn(url_for('main.show_photo', photo_id=self.ids[0]) + '"', response.get_data(as_text=True))
+
+
+class TagCacheTestCase(BaseTestCase):
+
+	def setUp(self):
+		super(TagCacheTestCase, self).setUp()
+		self.photo = Photo(filename='1.jpg', filename_s='1.jpg', filename_m='1.jpg', author=self.user)
+		self.other = Photo(filename='2.jpg', filename_s='2.jpg', filename_m='2.jpg', author=self.user)
+		self.cat = Tag(name='cat')
+		self.dog = Tag(name='dog')
+		self.photo.tags = [self.cat, self.dog]
+		self.other.tags = [self.cat]
+		db.session.add_all([self.photo, self.other])
+		db.session.commit()
+
+	def test_top(self):
+		cache = TagCache(600)
+		self.assertEqual([(tag.name, tag.photo_count) for tag in cache.top()], [('cat', 2), ('dog', 1)])
+		self.assertEqual([tag.name for tag in cache.top(1)], ['cat'])
+		# 在ttl之内不再查询
+		with count_queries() as statements:
+			cache.top()
+		self.assertEqual(statements, [])
+
+	def test_add_remove(self):
+		cache = TagCache(600)
+		cache.refresh()
+		cache.add(self.dog)
+		cache.add(self.dog)
+		self.assertEqual([(tag.name, tag.photo_count) for tag in cache.top()], [('dog', 3), ('cat', 2)])
+		cache.remove(self.cat)
+		cache.remove(self.cat)
+		self.assertEqual([tag.name for tag in cache.top()], ['dog'])
+		cache.delete(self.dog.id)
+		self.assertEqual(cache.top(), [])
+
+	def test_refresh_after_ttl(self):
+		cache = TagCache(0)
+		cache.refresh()
+		cache.delete(self.cat.id)
+		# 过期之后从Tag.photo_count重新加载，修正增量更新的偏差
+		cache.loaded_at -= 1
+		self.assertEqual([tag.name for tag in cache.top()], ['cat', 'dog'])
+
+	def test_views(self):
+		self.login()
+		get_tag_cache().refresh()
+		self.client.post(url_for('main.new_tag', photo_id=self.other.id), data=dict(tag='dog bird'),
+						 follow_redirects=True)
+		self.assertEqual([(tag.name, tag.photo_count) for tag in get_tag_cache().top()],
+						 [('cat', 2), ('dog', 2), ('bird', 1)])
+		bird = Tag.query.filter_by(name='bird').first()
+		self.client.post(url_for('main.delete_tag', photo_id=self.other.id, tag_id=bird.id), follow_redirects=True)
+		self.assertEqual([tag.name for tag in get_tag_cache().top()], ['cat', 'dog'])
+		response = self.client.get(url_for('main.index'))
+		data = response.get_data(as_text=True)
+		self.assertIn('cat', data)
+		self.assertNotIn('bird', data)
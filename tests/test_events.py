@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from flask import url_for
+
+from albumy.events import Subscription, get_event_broker, publish_unread, unread_event
+from albumy.notifications import get_notification_writer
+from tests.base import BaseTestCase
+
+
+class EventBrokerTestCase(BaseTestCase):
+
+	def setUp(self):
+		super(EventBrokerTestCase, self).setUp()
+		self.broker = get_event_broker()
+
+	def test_limits(self):
+		self.app.config['ALBUMY_STREAM_MAX_PER_USER'] = 2
+		self.app.config['ALBUMY_STREAM_MAX_CONNECTIONS'] = 3
+		first = self.broker.subscribe(self.user.id)
+		self.assertIsNotNone(self.broker.subscribe(self.user.id))
+		# 每个用户的连接数上限
+		self.assertIsNone(self.broker.subscribe(self.user.id))
+		self.assertIsNotNone(self.broker.subscribe(self.admin.id))
+		# 连接总数上限，被拒绝的用户不留下记录
+		self.assertIsNone(self.broker.subscribe(3))
+		self.assertEqual(self.broker.subscribed([self.user.id, self.admin.id, 3]), [self.user.id, self.admin.id])
+		self.broker.unsubscribe(first)
+		self.broker.unsubscribe(first)
+		self.assertEqual(self.broker.count, 2)
+		self.assertIsNotNone(self.broker.subscribe(3))
+
+	def test_queue_keeps_latest(self):
+		subscription = Subscription(self.user.id, 2)
+		for count in range(5):
+			subscription.put(unread_event(count))
+		self.assertEqual(subscription.get(0), unread_event(3))
+		self.assertEqual(subscription.get(0), unread_event(4))
+		self.assertIsNone(subscription.get(0))
+
+	def test_publish_unread(self):
+		subscription = self.broker.subscribe(self.user.id)
+		get_notification_writer().push(self.user.id, 'follow', self.admin.id, self.user.id)
+		self.assertEqual(subscription.get(0), 'event: notification\ndata: {"count": 1}\n\n')
+		# 没有连接的用户不查询也不推送
+		publish_unread([self.admin.id])
+		self.assertIsNone(subscription.get(0))
+
+
+class NotificationStreamTestCase(BaseTestCase):
+
+	def setUp(self):
+		super(NotificationStreamTestCase, self).setUp()
+		# 发送第一个事件后立即结束
+		self.app.config['ALBUMY_STREAM_TIMEOUT'] = 0
+		self.broker = get_event_broker()
+
+	def test_stream(self):
+		get_notification_writer().push(self.user.id, 'follow', self.admin.id, self.user.id)
+		self.login()
+		response = self.client.get(url_for('ajax.notifications_stream'))
+		self.assertEqual(response.mimetype, 'text/event-stream')
+		self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+		self.assertEqual(response.headers['X-Accel-Buffering'], 'no')
+		self.assertEqual(response.get_data(as_text=True), 'retry: %d\n\n%s' % (
+			self.app.config['ALBUMY_STREAM_RETRY'] * 1000, unread_event(1)))
+		# 连接关闭时取消订阅
+		response.close()
+		self.assertEqual(self.broker.count, 0)
+
+	def test_rejected(self):
+		self.assertEqual(self.client.get(url_for('ajax.notifications_stream')).status_code, 403)
+		self.login()
+		self.app.config['ALBUMY_STREAM_MAX_PER_USER'] = 1
+		self.broker.subscribe(self.user.id)
+		self.assertEqual(self.client.get(url_for('ajax.notifications_stream')).status_code, 503)
+		self.assertEqual(self.broker.count, 1)
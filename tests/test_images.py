@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from PIL import Image, JpegImagePlugin
+from flask import url_for
+
+from albumy.media import media_etag
+from albumy.storage import locate_media, media_path
+from albumy.utils import encoder_available, resize_images, save_image
+from tests.base import BaseTestCase
+
+
+class ResizeImagesTestCase(BaseTestCase):
+
+	sizes = {400: '_s', 800: '_m'}
+
+	def save(self, filename, size, fmt='JPEG'):
+		with open(media_path(self.directory, filename, create=True), 'wb') as f:
+			f.write(self.image(size, fmt))
+
+	def sizes_of(self, filenames):
+		result = {}
+		for base_width, filename in filenames.items():
+			with Image.open(locate_media(self.directory, filename)) as img:
+				result[base_width] = img.size
+		return result
+
+	def test_sizes(self):
+		self.save('a.jpg', (2000, 1000))
+		filenames = resize_images(self.directory, 'a.jpg', self.sizes)
+		self.assertEqual(filenames, {400: 'a_s.jpg', 800: 'a_m.jpg'})
+		self.assertEqual(self.sizes_of(filenames), {400: (400, 200), 800: (800, 400)})
+
+	def test_decode_once(self):
+		self.save('a.jpg', (4000, 2000))
+		draft = JpegImagePlugin.JpegImageFile.draft
+		with mock.patch.object(JpegImagePlugin.JpegImageFile, 'draft', autospec=True, side_effect=draft) as draft_mock, \
+				mock.patch.object(Image, '_getdecoder', wraps=Image._getdecoder) as decoder_mock:
+			filenames = resize_images(self.directory, 'a.jpg', self.sizes)
+		# 按最大的目标尺寸请求draft解码，原图只解码一次
+		draft_mock.assert_called_once_with(mock.ANY, 'RGB', (800, 400))
+		self.assertEqual(decoder_mock.call_count, 1)
+		self.assertEqual(self.sizes_of(filenames), {400: (400, 200), 800: (800, 400)})
+
+	def test_png(self):
+		self.save('b.png', (1000, 500), 'PNG')
+		filenames = resize_images(self.directory, 'b.png', self.sizes)
+		self.assertEqual(self.sizes_of(filenames), {400: (400, 200), 800: (800, 400)})
+
+	def test_small(self):
+		# 比基准值小的尺寸直接使用原图
+		self.save('c.jpg', (600, 300))
+		filenames = resize_images(self.directory, 'c.jpg', self.sizes)
+		self.assertEqual(filenames, {400: 'c_s.jpg', 800: 'c.jpg'})
+		self.assertEqual(self.sizes_of(filenames), {400: (400, 200), 800: (600, 300)})
+		self.save('d.jpg', (300, 150))
+		self.assertEqual(resize_images(self.directory, 'd.jpg', self.sizes), {400: 'd.jpg', 800: 'd.jpg'})
+		self.assertIsNone(locate_media(self.directory, 'd_s.jpg'))
+
+
+class EncoderPolicyTestCase(BaseTestCase):
+
+	policy = {'quality': 80, 'progressive': True, 'lossy_png': True, 'formats': ('avif', 'webp')}
+
+	def test_lossy_png(self):
+		# 没有透明通道的PNG保存为JPEG
+		self.assertEqual(save_image(Image.new('RGB', (40, 20)), self.directory, 'a_s', '.png', self.policy), 'a_s.jpg')
+		with Image.open(locate_media(self.directory, 'a_s.jpg')) as img:
+			self.assertEqual(img.format, 'JPEG')
+			self.assertTrue(img.info.get('progressive'))
+		self.assertEqual(save_image(Image.new('RGBA', (40, 20)), self.directory, 'b_s', '.png', self.policy), 'b_s.png')
+		self.assertEqual(save_image(Image.new('RGB', (40, 20)), self.directory, 'c_s', '.png', {}), 'c_s.png')
+		self.assertIsNone(locate_media(self.directory, 'c_s.webp'))
+
+	def test_formats(self):
+		save_image(Image.new('RGBA', (40, 20)), self.directory, 'a_s', '.png', self.policy)
+		with Image.open(locate_media(self.directory, 'a_s.webp')) as img:
+			self.assertEqual((img.format, img.mode), ('WEBP', 'RGBA'))
+		# Pillow不支持的格式跳过
+		self.assertEqual(locate_media(self.directory, 'a_s.avif') is not None, encoder_available('AVIF'))
+
+	def test_resize_with_policy(self):
+		with open(media_path(self.directory, 'a.png', create=True), 'wb') as f:
+			f.write(self.image((1000, 500), 'PNG'))
+		filenames = resize_images(self.directory, 'a.png', {400: '_s'}, {'_s': self.policy})
+		self.assertEqual(filenames, {400: 'a_s.jpg'})
+		self.assertIsNotNone(locate_media(self.directory, 'a_s.webp'))
+
+
+class NegotiationTestCase(BaseTestCase):
+
+	def setUp(self):
+		super(NegotiationTestCase, self).setUp()
+		img = Image.new('RGB', (400, 300), (200, 10, 10))
+		save_image(img, self.directory, 'a_s', '.jpg', {'formats': ('webp',)})
+		with open(locate_media(self.directory, 'a_s.webp'), 'rb') as f:
+			self.webp = f.read()
+		with open(locate_media(self.directory, 'a_s.jpg'), 'rb') as f:
+			self.jpeg = f.read()
+
+	def get(self, filename='a_s.jpg', **headers):
+		return self.client.get(url_for('main.get_image', filename=filename), headers=headers)
+
+	def test_accept(self):
+		response = self.get(Accept='image/webp,*/*')
+		self.assertEqual(response.mimetype, 'image/webp')
+		self.assertEqual(response.data, self.webp)
+		self.assertIn('Accept', response.vary)
+		self.assertEqual(response.get_etag(), (media_etag('a_s.webp'), False))
+		# */*不算支持webp
+		response = self.get(Accept='*/*')
+		self.assertEqual(response.data, self.jpeg)
+		self.assertIn('Accept', response.vary)
+		response = self.get(Accept='image/webp;q=0,*/*')
+		self.assertEqual(response.data, self.jpeg)
+
+	def test_smallest(self):
+		# 选择文件最小的格式
+		with open(locate_media(self.directory, 'a_s.webp'), 'wb') as f:
+			f.write(b'x' * (len(self.jpeg) + 1))
+		response = self.get(Accept='image/webp,*/*')
+		self.assertEqual(response.data, self.jpeg)
+
+	def test_not_modified(self):
+		for filename in ('a_s.webp', 'a_s.jpg'):
+			response = self.get(Accept='image/webp,*/*', **{'If-None-Match': '"%s"' % media_etag(filename)})
+			self.assertEqual(response.status_code, 304)
+			self.assertEqual(response.get_etag(), (media_etag(filename), False))
+
+	def test_original(self):
+		# 原图不协商格式
+		with open(media_path(self.directory, 'a.jpg', create=True), 'wb') as f:
+			f.write(self.jpeg)
+		with open(media_path(self.directory, 'a.webp', create=True), 'wb') as f:
+			f.write(b'x')
+		response = self.get('a.jpg', Accept='image/webp,*/*')
+		self.assertEqual(response.data, self.jpeg)
+		self.assertNotIn('Accept', response.vary)
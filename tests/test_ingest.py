@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import os
+
+from flask import url_for
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+from albumy.ingest import IngestFile, sniff_image
+from albumy.models import Blob, Photo
+from tests.base import BaseTestCase
+
+
+def temp_files(directory):
+	"""
+	上传目录中没有删除的临时文件
+	"""
+	return [name for name in os.listdir(directory) if name.startswith('.upload-')]
+
+
+class IngestFileTestCase(BaseTestCase):
+
+	def test_sniff(self):
+		self.assertEqual(sniff_image(self.image(fmt='JPEG')[:12]), 'jpeg')
+		self.assertEqual(sniff_image(self.image(fmt='PNG')[:12]), 'png')
+		self.assertEqual(sniff_image(self.image(fmt='GIF')[:12]), 'gif')
+		self.assertEqual(sniff_image(self.image(fmt='WEBP')[:12]), 'webp')
+		self.assertIsNone(sniff_image(b'<html><body>'))
+
+	def test_write(self):
+		data = self.image()
+		stream = IngestFile(self.directory, len(data))
+		# 分成小块写入，文件头跨越多块
+		for i in range(0, len(data), 5):
+			stream.write(data[i:i + 5])
+		self.assertEqual(stream.kind, 'jpeg')
+		self.assertEqual(stream.hexdigest(), hashlib.sha256(data).hexdigest())
+		target = os.path.join(self.directory, 'saved.jpg')
+		stream.save(target)
+		stream.close()
+		with open(target, 'rb') as f:
+			self.assertEqual(f.read(), data)
+		self.assertEqual(temp_files(self.directory), [])
+
+	def test_reject(self):
+		stream = IngestFile(self.directory, 1024)
+		with self.assertRaises(UnsupportedMediaType):
+			stream.write(b'#!/bin/sh\nrm -rf /\n')
+		self.assertEqual(temp_files(self.directory), [])
+
+		stream = IngestFile(self.directory, 1024)
+		with self.assertRaises(RequestEntityTooLarge):
+			stream.write(self.image(fmt='PNG')[:16] + b'\0' * 1024)
+		self.assertEqual(temp_files(self.directory), [])
+
+	def test_not_strict(self):
+		stream = IngestFile(self.directory, 1024, strict=False)
+		self.assertEqual(stream.write(b'not an image'), 12)
+		self.assertEqual(stream.write(b'more'), 4)
+		self.assertTrue(stream.error)
+		self.assertEqual(stream.seek(0), 0)
+		self.assertEqual(temp_files(self.directory), [])
+
+
+class IngestRequestTestCase(BaseTestCase):
+
+	def setUp(self):
+		super(IngestRequestTestCase, self).setUp()
+		self.login()
+
+	def test_upload(self):
+		data = self.image()
+		self.assertEqual(self.upload(data).status_code, 200)
+		photo = Photo.query.one()
+		blob = Blob.query.one()
+		self.assertEqual(blob.hash, hashlib.sha256(data).hexdigest())
+		self.assertEqual(blob.filename, photo.filename)
+		self.assertEqual(temp_files(self.directory), [])
+
+	def test_not_image(self):
+		response = self.upload(b'<?php system($_GET["c"]); ?>', 'shell.jpg')
+		self.assertEqual(response.status_code, 415)
+		self.assertEqual(Photo.query.count(), 0)
+		self.assertEqual(temp_files(self.directory), [])
+
+	def test_too_large(self):
+		self.app.config['ALBUMY_UPLOAD_MAX_FILE_SIZE'] = 1024
+		response = self.upload(self.image((400, 400), 'PNG') + b'\0' * 1024)
+		self.assertEqual(response.status_code, 413)
+		self.assertEqual(Photo.query.count(), 0)
+		self.assertEqual(temp_files(self.directory), [])
+
+	def test_batch(self):
+		# 批量上传时无效的文件不影响其他文件
+		response = self.client.post(url_for('main.upload_batch'), data={
+			'file[0]': (io.BytesIO(b'not an image'), 'x.jpg'),
+			'file[1]': (io.BytesIO(self.image()), 'y.jpg'),
+		}, content_type='multipart/form-data')
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual([result['ok'] for result in response.get_json()['results']], [False, True])
+		self.assertEqual(Photo.query.count(), 1)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import time
+from unittest import mock
+
+from PIL import Image
+from flask import url_for
+
+from albumy.media import media_etag
+from albumy.storage import media_path
+from albumy.variants import VariantCache, render_variant
+from tests.base import BaseTestCase
+
+
+class SendMediaTestCase(BaseTestCase):
+
+	def setUp(self):
+		super(SendMediaTestCase, self).setUp()
+		self.content = self.image((300, 200))
+		with open(media_path(self.directory, 'abc.jpg', create=True), 'wb') as f:
+			f.write(self.content)
+
+	def test_send(self):
+		response = self.client.get(url_for('main.get_image', filename='abc.jpg'))
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.data, self.content)
+		self.assertEqual(response.mimetype, 'image/jpeg')
+		self.assertEqual(response.get_etag(), (media_etag('abc.jpg'), False))
+		self.assertEqual(response.headers['Cache-Control'], 'public, max-age=%d, immutable' %
+						 self.app.config['ALBUMY_MEDIA_MAX_AGE'])
+		self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+
+	def test_not_modified(self):
+		etag = '"%s"' % media_etag('abc.jpg')
+		response = self.client.get(url_for('main.get_image', filename='abc.jpg'), headers={'If-None-Match': etag})
+		self.assertEqual(response.status_code, 304)
+		self.assertEqual(response.data, b'')
+		self.assertIn('immutable', response.headers['Cache-Control'])
+		# ETag只由文件名计算，不需要访问磁盘
+		response = self.client.get(url_for('main.get_image', filename='gone.jpg'),
+								   headers={'If-None-Match': '"%s"' % media_etag('gone.jpg')})
+		self.assertEqual(response.status_code, 304)
+		response = self.client.get(url_for('main.get_image', filename='abc.jpg'), headers={'If-None-Match': '"other"'})
+		self.assertEqual(response.status_code, 200)
+
+	def test_range(self):
+		response = self.client.get(url_for('main.get_image', filename='abc.jpg'), headers={'Range': 'bytes=0-9'})
+		self.assertEqual(response.status_code, 206)
+		self.assertEqual(response.data, self.content[:10])
+		self.assertEqual(response.headers['Content-Range'], 'bytes 0-9/%d' % len(self.content))
+		response = self.client.get(url_for('main.get_image', filename='abc.jpg'),
+								   headers={'Range': 'bytes=%d-' % (len(self.content) + 10)})
+		self.assertEqual(response.status_code, 416)
+
+	def test_not_found(self):
+		self.assertEqual(self.client.get(url_for('main.get_image', filename='gone.jpg')).status_code, 404)
+		# 文件名跳出目录
+		self.assertEqual(self.client.get('/uploads/..%2F..%2Fetc%2Fpasswd').status_code, 404)
+		with open(os.path.join(self.directory, 'secret.txt'), 'wb') as f:
+			f.write(b'secret')
+		self.assertEqual(self.client.get('/avatars/..%2Fsecret.txt').status_code, 404)
+
+	def test_avatar(self):
+		with open(media_path(self.app.config['AVATARS_SAVE_PATH'], 'a_m.png', create=True), 'wb') as f:
+			f.write(b'avatar')
+		response = self.client.get(url_for('main.get_avatar', filename='a_m.png'))
+		self.assertEqual(response.data, b'avatar')
+		self.assertEqual(response.get_etag(), (media_etag('a_m.png'), False))
+		response = self.client.get(url_for('main.get_avatar', filename='a_m.png'),
+								   headers={'If-None-Match': '"%s"' % media_etag('a_m.png')})
+		self.assertEqual(response.status_code, 304)
+
+	def test_offload(self):
+		self.app.config['ALBUMY_MEDIA_OFFLOAD'] = 'x-accel-redirect'
+		response = self.client.get(url_for('main.get_image', filename='abc.jpg'))
+		self.assertEqual(response.data, b'')
+		self.assertTrue(response.headers['X-Accel-Redirect'].startswith('/_media/uploads/'))
+		self.assertTrue(response.headers['X-Accel-Redirect'].endswith('/abc.jpg'))
+		self.assertEqual(response.get_etag(), (media_etag('abc.jpg'), False))
+
+
+class VariantTestCase(BaseTestCase):
+
+	def setUp(self):
+		super(VariantTestCase, self).setUp()
+		with open(media_path(self.directory, 'abc.jpg', create=True), 'wb') as f:
+			f.write(self.image((1000, 500)))
+
+	def get(self, filename='abc.jpg', **kwargs):
+		headers = kwargs.pop('headers', None)
+		return self.client.get(url_for('main.get_image', filename=filename, **kwargs), headers=headers)
+
+	def test_variant(self):
+		response = self.get(w=200, fmt='webp')
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.mimetype, 'image/webp')
+		with Image.open(io.BytesIO(response.data)) as img:
+			self.assertEqual((img.format, img.size), ('WEBP', (200, 100)))
+		self.assertIn('immutable', response.headers['Cache-Control'])
+		response = self.get(w=400)
+		with Image.open(io.BytesIO(response.data)) as img:
+			self.assertEqual((img.format, img.size), ('JPEG', (400, 200)))
+
+	def test_allow_list(self):
+		# 只允许配置中的宽度和格式
+		self.assertEqual(self.get(w=201).status_code, 404)
+		self.assertEqual(self.get(fmt='gif').status_code, 404)
+		self.assertEqual(self.get(w=200, fmt='bmp').status_code, 404)
+		self.assertEqual(self.get(filename='gone.jpg', w=200).status_code, 404)
+		self.assertEqual(self.client.get('/uploads/..%2F..%2Fetc%2Fpasswd?w=200&fmt=png').status_code, 404)
+		self.assertEqual(os.listdir(self.app.config['ALBUMY_VARIANT_CACHE_PATH']), ['locks'])
+
+	def test_cached(self):
+		with mock.patch('albumy.variants.render_variant', side_effect=render_variant) as render:
+			first = self.get(w=200, fmt='png')
+			second = self.get(w=200, fmt='png')
+		self.assertEqual(render.call_count, 1)
+		self.assertEqual(first.data, second.data)
+		response = self.get(w=200, fmt='png', headers={'If-None-Match': first.headers['ETag']})
+		self.assertEqual(response.status_code, 304)
+		self.assertNotEqual(self.get(w=400, fmt='png').headers['ETag'], first.headers['ETag'])
+
+
+class VariantCacheTestCase(BaseTestCase):
+
+	def render(self, size):
+		def write(target):
+			with open(target, 'wb') as f:
+				f.write(b'x' * size)
+		return write
+
+	def test_evict(self):
+		cache = VariantCache(os.path.join(self.directory, 'cache'), 250)
+		paths = [cache.get('%d.png' % i, self.render(100)) for i in range(2)]
+		# 命中时更新最近使用时间
+		past = time.time() - 100
+		os.utime(paths[0], (past, past))
+		os.utime(paths[1], (past + 10, past + 10))
+		self.assertEqual(cache.get('0.png', self.render(1000)), paths[0])
+		with open(paths[0], 'rb') as f:
+			self.assertEqual(f.read(), b'x' * 100)
+		# 超过上限时淘汰最久没有使用的1.png
+		cache.get('2.png', self.render(100))
+		self.assertEqual(sorted(os.path.basename(path) for path, size, mtime in cache.files()), ['0.png', '2.png'])
+		self.assertEqual(cache.size, 200)
+		cache.discard('2.png')
+		cache.discard('2.png')
+		self.assertEqual(cache.size, 100)
+
+	def test_render_failure(self):
+		cache = VariantCache(os.path.join(self.directory, 'cache'), 250)
+
+		def fail(target):
+			raise IOError('broken')
+
+		with self.assertRaises(IOError):
+			cache.get('0.png', fail)
+		# 不留下临时文件
+		self.assertEqual(cache.files(), [])
+		self.assertEqual(os.listdir(cache.path), ['locks'])
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+from unittest import mock
+
+from flask import url_for
+
+from albumy.extensions import db
+from albumy.models import Notification, NotificationActor, Photo, User, rebuild_counters
+from albumy.notifications import get_notification_writer
+from albumy.utils import count_queries
+from tests.base import BaseTestCase
+
+
+class NotificationTestCase(BaseTestCase):
+
+	def setUp(self):
+		super(NotificationTestCase, self).setUp()
+		self.other = self.create_user('other', 'other@helloflask.com')
+		self.writer = get_notification_writer()
+		# 不合并重复的事件，模拟超过ALBUMY_NOTIFICATION_COALESCE之后再次发生
+		self.app.config['ALBUMY_NOTIFICATION_COALESCE'] = 0
+
+	def notifications(self):
+		return Notification.query.filter_by(receiver_id=self.admin.id, kind='comment').order_by(Notification.id).all()
+
+	def test_count_distinct_actors(self):
+		for actor in (self.user, self.user, self.user):
+			self.writer.push(self.admin.id, 'comment', actor.id, 1)
+		notification, = self.notifications()
+		self.assertEqual(notification.actor_count, 1)
+
+		self.writer.push(self.admin.id, 'comment', self.other.id, 1)
+		self.writer.push(self.admin.id, 'comment', self.user.id, 1)
+		self.writer.push(self.admin.id, 'comment', self.other.id, 1)
+		db.session.expire_all()
+		notification, = self.notifications()
+		self.assertEqual(notification.actor_count, 2)
+		self.assertEqual(notification.actor_id, self.other.id)
+		self.assertEqual(sorted(actor.actor_id for actor in notification.actors), sorted([self.user.id, self.other.id]))
+		self.assertEqual(User.query.get(self.admin.id).unread_count, 1)
+
+	def test_same_batch(self):
+		self.writer.write([dict(receiver_id=self.admin.id, kind='comment', actor_id=actor.id, object_id=2,
+								timestamp=datetime.utcnow()) for actor in (self.user, self.other, self.user)])
+		notifications = Notification.query.filter_by(receiver_id=self.admin.id, object_id=2).all()
+		self.assertEqual([notification.actor_count for notification in notifications], [2])
+		self.assertEqual(NotificationActor.query.filter_by(notification_id=notifications[0].id).count(), 2)
+
+	def test_read_notification_is_not_reused(self):
+		self.writer.push(self.admin.id, 'comment', self.user.id, 1)
+		first, = self.notifications()
+		# 选出未读消息之后、更新之前被阅读
+		table = Notification.__table__
+		selected = []
+
+		def read_after_select(conn, cursor, statement, parameters, context, executemany):
+			if not selected and statement.startswith('SELECT') and 'notification.first_timestamp' in statement:
+				selected.append(statement)
+				conn.execute(table.update().where(table.c.id == first.id).values(is_read=True))
+
+		db.event.listen(db.engine, 'after_cursor_execute', read_after_select)
+		try:
+			self.writer.push(self.admin.id, 'comment', self.other.id, 1)
+		finally:
+			db.event.remove(db.engine, 'after_cursor_execute', read_after_select)
+		self.assertEqual(len(selected), 1)
+		db.session.expire_all()
+		first, second = self.notifications()
+		self.assertTrue(first.is_read)
+		self.assertEqual(first.actor_count, 1)
+		self.assertFalse(second.is_read)
+		self.assertEqual(second.actor_id, self.other.id)
+
+	def unread_count(self):
+		return db.session.query(User.unread_count).filter_by(id=self.admin.id).scalar()
+
+	def test_read_all_keeps_new_notifications(self):
+		self.writer.push(self.admin.id, 'comment', self.user.id, 1)
+		self.writer.push(self.admin.id, 'follow', self.user.id, self.admin.id)
+		self.assertEqual(self.unread_count(), 2)
+		self.login(self.admin.email)
+		# 修改所有消息为已读之后、提交之前写入了新的消息
+		table = Notification.__table__
+		inserted = []
+
+		def insert_after_update(conn, cursor, statement, parameters, context, executemany):
+			if not inserted and statement.startswith('UPDATE notification'):
+				inserted.append(statement)
+				conn.execute(table.insert().values(kind='collect', actor_id=self.other.id, object_id=1,
+												   receiver_id=self.admin.id, is_read=False))
+				conn.execute(User.__table__.update().where(User.__table__.c.id == self.admin.id).values(
+					unread_count=User.__table__.c.unread_count + 1))
+
+		db.event.listen(db.engine, 'after_cursor_execute', insert_after_update)
+		try:
+			self.client.post(url_for('main.read_all_notification'))
+		finally:
+			db.event.remove(db.engine, 'after_cursor_execute', insert_after_update)
+		self.assertEqual(len(inserted), 1)
+		self.assertEqual(self.unread_count(), 1)
+
+	def test_read_notification_twice(self):
+		self.writer.push(self.admin.id, 'comment', self.user.id, 1)
+		self.writer.push(self.admin.id, 'comment', self.other.id, 2)
+		notification = self.notifications()[0]
+		self.login(self.admin.email)
+		for i in range(2):
+			self.client.post(url_for('main.read_notification', notification_id=notification.id))
+		self.assertEqual(self.unread_count(), 1)
+
+
+class NotificationWriterTestCase(BaseTestCase):
+
+	def setUp(self):
+		super(NotificationWriterTestCase, self).setUp()
+		self.writer = get_notification_writer()
+
+	def count(self, **kwargs):
+		return Notification.query.filter_by(receiver_id=self.admin.id, **kwargs).count()
+
+	def test_coalesce(self):
+		# 合并时间以内重复的事件只写入一次
+		self.assertTrue(self.writer.push(self.admin.id, 'collect', self.user.id, 1))
+		self.assertFalse(self.writer.push(self.admin.id, 'collect', self.user.id, 1))
+		self.assertTrue(self.writer.push(self.admin.id, 'collect', self.user.id, 2))
+		self.assertTrue(self.writer.push(self.admin.id, 'follow', self.user.id, 1))
+		self.assertEqual(self.count(), 3)
+		self.app.config['ALBUMY_NOTIFICATION_COALESCE'] = 0
+		self.assertTrue(self.writer.push(self.admin.id, 'collect', self.user.id, 1))
+		# 超过合并时间后再次写入，合并到同一条未读消息中
+		self.assertEqual(self.count(), 3)
+
+	def test_background_batch(self):
+		self.app.config['ALBUMY_NOTIFICATION_SYNC'] = False
+		self.app.config['ALBUMY_NOTIFICATION_FLUSH_INTERVAL'] = 0.2
+		# 视图中不为消息提交事务
+		with mock.patch.object(self.writer, 'write', wraps=self.writer.write) as write:
+			for photo_id in range(1, 4):
+				self.writer.push(self.admin.id, 'collect', self.user.id, photo_id)
+			self.assertEqual(self.count(), 0)
+			self.assertTrue(self.writer.flush(5))
+		# 同一时间产生的消息写入同一批
+		self.assertEqual([len(call[0][0]) for call in write.call_args_list], [3])
+		db.session.expire_all()
+		self.assertEqual(self.count(kind='collect'), 3)
+		self.assertEqual(User.query.get(self.admin.id).unread_count, 3)
+
+	def test_deleting_receiver(self):
+		self.admin.deleting = True
+		db.session.commit()
+		self.writer.push(self.admin.id, 'follow', self.user.id, self.admin.id)
+		self.assertEqual(self.count(), 0)
+
+	def test_views(self):
+		self.login()
+		photo = Photo(filename='1.jpg', filename_s='1.jpg', filename_m='1.jpg', author=self.admin)
+		db.session.add(photo)
+		db.session.commit()
+		self.client.post(url_for('user.follow', username=self.admin.username))
+		self.client.post(url_for('main.collect', photo_id=photo.id))
+		self.client.post(url_for('main.new_comment', photo_id=photo.id), data=dict(body='nice'))
+		self.assertEqual(sorted(kind for (kind,) in db.session.query(Notification.kind).filter_by(
+			receiver_id=self.admin.id)), ['collect', 'comment', 'follow'])
+
+
+class UnreadCounterTestCase(BaseTestCase):
+
+	def unread_count(self):
+		return db.session.query(User.unread_count).filter_by(id=self.user.id).scalar()
+
+	def test_listener(self):
+		db.session.add_all([Notification(message='hello', receiver=self.user),
+							Notification(message='read', receiver=self.user, is_read=True)])
+		db.session.commit()
+		self.assertEqual(self.unread_count(), 1)
+		get_notification_writer().push(self.user.id, 'follow', self.admin.id, self.user.id)
+		self.assertEqual(self.unread_count(), 2)
+
+	def test_count_without_query(self):
+		get_notification_writer().push(self.user.id, 'follow', self.admin.id, self.user.id)
+		self.login()
+		db.session.remove()
+		# 读取User的计数器，不统计消息表
+		with count_queries() as statements:
+			response = self.client.get(url_for('ajax.notifications_count'))
+			index = self.client.get(url_for('main.index')).get_data(as_text=True)
+		self.assertEqual(response.get_json(), {'count': 1})
+		self.assertFalse([statement for statement in statements if 'FROM notification' in statement])
+		self.assertIn('data-stream="%s">1</span>' % url_for('ajax.notifications_stream'), index)
+		self.logout()
+		self.assertEqual(self.client.get(url_for('ajax.notifications_count')).status_code, 403)
+
+	def test_rebuild(self):
+		db.session.add(Notification(message='hello', receiver=self.user))
+		db.session.commit()
+		self.user.unread_count = 5
+		db.session.commit()
+		rebuild_counters()
+		self.assertEqual(self.unread_count(), 1)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+from flask import url_for
+
+from albumy.extensions import db
+from albumy.models import Photo
+from albumy.pagination import keyset_paginate, encode_cursor
+from tests.base import BaseTestCase
+
+
+class KeysetPaginationTestCase(BaseTestCase):
+
+	def setUp(self):
+		super(KeysetPaginationTestCase, self).setUp()
+		# 一半的图片时间相同，只能靠id区分
+		now = datetime.utcnow().replace(microsecond=0)
+		photos = [Photo(filename='%d.jpg' % i, filename_s='%d.jpg' % i, filename_m='%d.jpg' % i, author=self.user,
+						timestamp=now if i % 2 else now.replace(second=i))
+				  for i in range(7)]
+		db.session.add_all(photos)
+		db.session.commit()
+		self.ordered = [photo.id for photo in sorted(photos, key=lambda photo: (photo.timestamp, photo.id),
+													 reverse=True)]
+		self.columns = (Photo.timestamp, Photo.id)
+
+	def paginate(self, cursor=None):
+		return keyset_paginate(Photo.query, self.columns, cursor, per_page=3)
+
+	def test_next_and_prev(self):
+		pages = []
+		pagination = self.paginate()
+		self.assertFalse(pagination.has_prev)
+		while True:
+			pages.append([photo.id for photo in pagination.items])
+			if not pagination.has_next:
+				break
+			pagination = self.paginate(pagination.next_num)
+		self.assertEqual(sum(pages, []), self.ordered)
+		self.assertEqual([len(page) for page in pages], [3, 3, 1])
+
+		# 从最后一页往前翻，与往后翻的每一页相同
+		for page in reversed(pages[:-1]):
+			self.assertTrue(pagination.has_prev)
+			pagination = self.paginate(pagination.prev_num)
+			self.assertEqual([photo.id for photo in pagination.items], page)
+			self.assertTrue(pagination.has_next)
+		self.assertFalse(pagination.has_prev)
+		self.assertIsNone(pagination.prev_num)
+
+	def test_invalid_cursor(self):
+		# 无效的游标以及旧的页码都当作第一页
+		for cursor in ('2', 'not-a-cursor', encode_cursor([1], 'next'), encode_cursor([None, 1], 'sideways')):
+			self.assertEqual([photo.id for photo in self.paginate(cursor).items], self.ordered[:3])
+
+	def test_total(self):
+		self.assertEqual(self.paginate().total, 7)
+		self.assertEqual(self.paginate().pages, 3)
+
+	def test_view(self):
+		self.app.config['ALBUMY_PHOTO_PER_PAGE'] = 3
+		self.login()
+		cursor = self.paginate().next_num
+		data = self.client.get(url_for('user.index', username=self.user.username, page=cursor)).get_data(as_text=True)
+		for photo_id in self.ordered[3:6]:
+			self.assertIn(url_for('main.show_photo', photo_id=photo_id), data)
+		self.assertNotIn(url_for('main.show_photo', photo_id=self.ordered[0]), data)
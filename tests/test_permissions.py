@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from albumy.extensions import db
+from albumy.models import Permission, Role
+from albumy.utils import count_queries
+from tests.base import BaseTestCase
+
+
+class PermissionCacheTestCase(BaseTestCase):
+
+	def test_can(self):
+		self.assertTrue(self.user.can('UPLOAD'))
+		self.assertFalse(self.user.can('MODERATE'))
+		self.assertTrue(self.admin.can('ADMINISTER'))
+		self.assertFalse(self.user.can('UNKNOWN'))
+
+	def test_cached(self):
+		self.user.can('UPLOAD')
+		db.session.refresh(self.admin)
+		with count_queries() as statements:
+			self.assertTrue(self.admin.can('MODERATE'))
+			self.assertTrue(self.user.can('COLLECT'))
+		self.assertEqual(statements, [])
+
+	def test_invalidate(self):
+		self.assertFalse(self.user.can('MODERATE'))
+		role = Role.query.filter_by(name='User').first()
+		# 修改角色权限后缓存被清空，重新查询得到新的权限
+		role.permissions.append(Permission.query.filter_by(name='MODERATE').first())
+		db.session.commit()
+		self.assertTrue(self.user.can('MODERATE'))
+		role.permissions.remove(Permission.query.filter_by(name='UPLOAD').first())
+		db.session.commit()
+		self.assertFalse(self.user.can('UPLOAD'))
+
+	def test_init_role(self):
+		self.assertTrue(self.user.can('UPLOAD'))
+		Role.init_role()
+		self.assertTrue(self.user.can('UPLOAD'))
+		self.assertTrue(self.admin.can('ADMINISTER'))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from flask import url_for
+
+from albumy.extensions import db
+from albumy.models import Comment, Photo, Tag
+from albumy.notifications import get_notification_writer
+from albumy.utils import assert_max_queries
+from tests.base import BaseTestCase
+
+
+class QueryCountTestCase(BaseTestCase):
+	"""
+	页面的SQL语句数量不随列表中的数据增加，防止N+1查询回退
+	"""
+
+	def setUp(self):
+		super(QueryCountTestCase, self).setUp()
+		self.login()
+		for i in range(5):
+			self.upload(self.image(color=(i * 40, 0, 0)))
+		photos = Photo.query.all()
+		self.photo = photos[0]
+		self.tag = Tag(name='sky')
+		db.session.add(self.tag)
+		for photo in photos:
+			photo.tags.append(self.tag)
+		db.session.commit()
+		self.logout()
+
+		writer = get_notification_writer()
+		self.admin.follow(self.user)
+		for i in range(5):
+			other = self.create_user('other%d' % i, 'other%d@helloflask.com' % i)
+			other.follow(self.user)
+			self.user.follow(other)
+			for photo in photos:
+				other.collect(photo)
+			# 每个顶层评论下有两层回复
+			comment = Comment(body='comment', author=other, photo=self.photo)
+			reply = Comment(body='second floor', author=self.user, photo=self.photo, replied=comment)
+			db.session.add_all([comment, reply, Comment(body='second floor', author=other, photo=self.photo, replied=reply)])
+			db.session.commit()
+			writer.push(self.admin.id, 'comment', other.id, self.photo.id)
+			writer.push(self.admin.id, 'follow', other.id, self.admin.id)
+		self.login(self.admin.email)
+
+	def get(self, url, limit):
+		# 测试中请求共用同一个会话，清空后才能统计到每次请求实际执行的查询
+		db.session.remove()
+		with assert_max_queries(limit):
+			response = self.client.get(url)
+		self.assertEqual(response.status_code, 200)
+		return response.get_data(as_text=True)
+
+	def test_show_photo(self):
+		self.get(url_for('main.show_photo', photo_id=self.photo.id), 9)
+
+	def test_show_photo_threaded(self):
+		data = self.get(url_for('main.show_photo', photo_id=self.photo.id, view='thread'), 9)
+		self.assertEqual(data.count('second floor'), 10)
+
+	def test_timeline(self):
+		self.get(url_for('main.index'), 4)
+
+	def test_explore(self):
+		self.get(url_for('main.explore'), 3)
+
+	def test_show_tag(self):
+		self.get(url_for('main.show_tag', tag_id=self.tag.id), 3)
+
+	def test_show_collectors(self):
+		self.get(url_for('main.show_collectors', photo_id=self.photo.id), 5)
+
+	def test_user_pages(self):
+		self.get(url_for('user.index', username=self.user.username), 6)
+		self.get(url_for('user.show_followers', username=self.user.username), 5)
+		self.get(url_for('user.show_following', username=self.user.username), 6)
+		self.get(url_for('user.show_collections', username='other0'), 6)
+
+	def test_notifications(self):
+		self.get(url_for('main.show_notifications'), 3)
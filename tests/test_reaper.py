@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+from unittest import mock
+
+from flask import url_for
+
+from albumy.extensions import db
+from albumy.models import FileDeletion, Photo
+from albumy.reaper import collect_garbage, get_file_reaper
+from albumy.storage import locate_media, media_path
+from tests.base import BaseTestCase
+
+
+class FileReaperTestCase(BaseTestCase):
+
+	def setUp(self):
+		super(FileReaperTestCase, self).setUp()
+		self.login()
+
+	def upload_photo(self, color=(200, 10, 10)):
+		self.upload(self.image((1000, 800), color=color))
+		return Photo.query.order_by(Photo.id.desc()).first()
+
+	def exists(self, photo):
+		return [locate_media(self.directory, name) is not None
+				for name in (photo.filename, photo.filename_s, photo.filename_m)]
+
+	def test_delete_after_commit(self):
+		photo = self.upload_photo()
+		self.client.get(url_for('main.get_image', filename=photo.filename, w=200))
+		self.assertEqual(len(os.listdir(self.app.config['ALBUMY_VARIANT_CACHE_PATH'])), 2)
+		self.assertEqual(self.exists(photo), [True, True, True])
+		db.session.delete(photo)
+		db.session.flush()
+		# 提交之前不删除文件
+		self.assertEqual(self.exists(photo), [True, True, True])
+		self.assertEqual(FileDeletion.query.count(), 3 + 2 * 2)
+		db.session.commit()
+		self.assertEqual(self.exists(photo), [False, False, False])
+		self.assertEqual(FileDeletion.query.count(), 0)
+		# 变体也一起删除
+		self.assertEqual(os.listdir(self.app.config['ALBUMY_VARIANT_CACHE_PATH']), ['locks'])
+
+	def test_keep_on_rollback(self):
+		photo = self.upload_photo()
+		db.session.delete(photo)
+		db.session.flush()
+		db.session.rollback()
+		self.assertEqual(self.exists(photo), [True, True, True])
+		self.assertEqual(FileDeletion.query.count(), 0)
+		self.assertNotIn('albumy_file_deletions', db.session.info)
+
+	def test_shared_blob(self):
+		first = self.upload_photo()
+		second = self.upload_photo()
+		self.assertEqual(first.filename, second.filename)
+		db.session.delete(first)
+		db.session.commit()
+		self.assertEqual(self.exists(second), [True, True, True])
+		db.session.delete(second)
+		db.session.commit()
+		self.assertEqual(self.exists(second), [False, False, False])
+
+	def test_failure(self):
+		photo = self.upload_photo()
+		db.session.delete(photo)
+		# 不在提交后立即删除，由测试调用reap
+		with mock.patch.object(get_file_reaper(), 'wake'):
+			db.session.commit()
+		reaper = get_file_reaper()
+		with mock.patch('albumy.storage.LocalStorage.delete_many', side_effect=OSError('busy')):
+			for attempt in range(self.app.config['ALBUMY_REAPER_MAX_ATTEMPTS']):
+				self.assertEqual(reaper.reap(), (0, False))
+		self.assertEqual(set(attempts for (attempts,) in db.session.query(FileDeletion.attempts)),
+						 {self.app.config['ALBUMY_REAPER_MAX_ATTEMPTS']})
+		# 失败次数达到上限后不再处理
+		self.assertEqual(reaper.drain(), 0)
+		self.assertEqual(self.exists(photo), [True, True, True])
+
+	def test_batches(self):
+		photo = self.upload_photo()
+		db.session.delete(photo)
+		with mock.patch.object(get_file_reaper(), 'wake'):
+			db.session.commit()
+		reaper = get_file_reaper()
+		self.assertEqual(reaper.reap(2), (2, True))
+		self.assertEqual(FileDeletion.query.count(), 5)
+		self.assertEqual(reaper.drain(), 5)
+		self.assertEqual(self.exists(photo), [False, False, False])
+
+
+class CollectGarbageTestCase(BaseTestCase):
+
+	def write(self, directory, filename, age):
+		path = media_path(directory, filename, create=True)
+		with open(path, 'wb') as f:
+			f.write(b'x')
+		past = time.time() - age
+		os.utime(path, (past, past))
+		return path
+
+	def test_collect(self):
+		self.login()
+		self.upload(self.image((1000, 800)))
+		photo = Photo.query.one()
+		orphan = self.write(self.directory, 'orphan.jpg', 100)
+		recent = self.write(self.directory, 'recent.jpg', 1)
+		part = os.path.join(self.directory, '.upload-abc.part')
+		with open(part, 'wb') as f:
+			f.write(b'x')
+		os.utime(part, (time.time() - 100, time.time() - 100))
+
+		result = collect_garbage(50, dry_run=True)
+		self.assertEqual(result['uploads'], ['orphan.jpg'])
+		self.assertEqual(result['temporary'], ['.upload-abc.part'])
+		self.assertTrue(os.path.exists(orphan))
+
+		result = self.runner.invoke(args=['media', 'gc', '--grace', '50'])
+		self.assertIn('Done.', result.output)
+		self.assertFalse(os.path.exists(orphan))
+		self.assertFalse(os.path.exists(part))
+		# 宽限期内的文件可能属于还没有提交的上传
+		self.assertTrue(os.path.exists(recent))
+		self.assertIsNotNone(locate_media(self.directory, photo.filename))
+		self.assertIsNotNone(locate_media(self.directory, photo.filename_s))
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import tempfile
+
+from flask import url_for
+
+from albumy.extensions import db
+from albumy.models import Photo, User
+from albumy.storage import MemoryS3Client, S3Storage, get_storage, locate_media, media_path, \
+	migrate_directory, shard_path
+from tests.base import BaseTestCase
+
+
+class S3StorageTestCase(BaseTestCase):
+	"""
+	使用内存中的对象存储测试S3Storage
+	"""
+
+	def setUp(self):
+		super(S3StorageTestCase, self).setUp()
+		self.storage = S3Storage(os.path.join(self.directory, 'staging'), 'albumy', 'uploads',
+								 client=MemoryS3Client())
+
+	def stage(self, content):
+		fd, path = tempfile.mkstemp(dir=self.directory)
+		with os.fdopen(fd, 'wb') as f:
+			f.write(content)
+		return path
+
+	def test_round_trip(self):
+		source = self.stage(b'photo')
+		self.storage.put('abc.jpg', source)
+		self.assertFalse(os.path.exists(source))
+		self.assertIsNone(self.storage.path('abc.jpg'))
+		self.assertEqual(self.storage.get('abc.jpg'), b'photo')
+		size, chunks = self.storage.stream('abc.jpg', chunk_size=2)
+		self.assertEqual(size, 5)
+		self.assertEqual(b''.join(chunks), b'photo')
+		self.assertEqual(self.storage.size('abc.jpg'), 5)
+		self.assertIn('abc.jpg', [name for name, mtime in self.storage.names()])
+
+		path = self.storage.fetch('abc.jpg')
+		with open(path, 'rb') as f:
+			self.assertEqual(f.read(), b'photo')
+		os.remove(path)
+
+		self.storage.delete('abc.jpg')
+		self.assertIsNone(self.storage.size('abc.jpg'))
+		self.assertIsNone(self.storage.fetch('abc.jpg'))
+		with self.assertRaises(FileNotFoundError):
+			self.storage.get('abc.jpg')
+		with self.assertRaises(FileNotFoundError):
+			self.storage.stream('abc.jpg')
+
+	def test_put_many_and_delete_many(self):
+		items = [('a%d.jpg' % i, self.stage(b'x' * i)) for i in range(1, 4)]
+		self.storage.put_many(items)
+		self.assertEqual([self.storage.size(name) for name, path in items], [1, 2, 3])
+		self.storage.delete_many(name for name, path in items)
+		self.assertEqual(list(self.storage.names()), [])
+
+	def test_local_copy_is_removed(self):
+		self.storage.put('raw.png', self.stage(b'avatar'))
+		with self.storage.local_copy('raw.png') as path:
+			with open(path, 'rb') as f:
+				self.assertEqual(f.read(), b'avatar')
+		self.assertFalse(os.path.exists(path))
+		with self.storage.local_copy('missing.png') as path:
+			self.assertIsNone(path)
+		self.assertEqual(os.listdir(self.storage.directory), [])
+
+	def test_size_is_cached(self):
+		self.storage.put('abc.jpg', self.stage(b'photo'))
+		calls = []
+		head_object = self.storage.client.head_object
+
+		def counted(**kwargs):
+			calls.append(kwargs['Key'])
+			return head_object(**kwargs)
+
+		self.storage.client.head_object = counted
+		for _ in range(3):
+			self.assertEqual(self.storage.size('abc.jpg'), 5)
+			self.assertIsNone(self.storage.size('abc.webp'))
+		self.assertEqual(len(calls), 1)
+
+
+class MemoryStorageTestCase(BaseTestCase):
+	"""
+	ALBUMY_STORAGE=memory时上传、读取和删除图片与头像
+	"""
+
+	def setUp(self):
+		super(MemoryStorageTestCase, self).setUp()
+		self.app.config['ALBUMY_STORAGE'] = 'memory'
+		self.app.extensions.pop('albumy_storage', None)
+		self.login()
+
+	def test_upload_get_delete(self):
+		self.assertEqual(self.upload(self.image()).status_code, 200)
+		photo = Photo.query.order_by(Photo.id.desc()).first()
+		storage = get_storage('uploads')
+		# 缩略图生成之后原图和缩略图都上传到了对象存储，暂存目录中没有文件
+		for filename in (photo.filename, photo.filename_s, photo.filename_m):
+			self.assertIsNone(storage.path(filename))
+			self.assertIsNotNone(storage.size(filename))
+
+		response = self.client.get(url_for('main.get_image', filename=photo.filename))
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.data, storage.get(photo.filename))
+		response = self.client.get(url_for('main.get_image', filename=photo.filename_s))
+		self.assertEqual(response.status_code, 200)
+		response = self.client.get(url_for('main.get_image', filename=photo.filename, w=200, fmt='png'))
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(self.client.get(url_for('main.get_image', filename='missing.jpg')).status_code, 404)
+		self.assertEqual(self.client.get(url_for('main.get_image', filename='missing.jpg', w=200)).status_code,
+						 404)
+
+		self.client.post(url_for('main.delete_photo', photo_id=photo.id))
+		self.assertIsNone(storage.size(photo.filename))
+		self.assertIsNone(storage.size(photo.filename_s))
+
+	def test_crop_avatar(self):
+		response = self.client.post(url_for('user.upload_avatar'),
+									data={'image': (io.BytesIO(self.image((300, 300), 'PNG')), 'avatar.png')},
+									content_type='multipart/form-data')
+		self.assertEqual(response.status_code, 302)
+		storage = get_storage('avatars')
+		user = User.query.get(self.user.id)
+		self.assertIsNone(storage.path(user.avatar_raw))
+		self.assertIsNotNone(storage.size(user.avatar_raw))
+
+		response = self.client.post(url_for('user.crop_avatar'), data=dict(x=0, y=0, w=100, h=100))
+		self.assertEqual(response.status_code, 302)
+		db.session.expire_all()
+		user = User.query.get(self.user.id)
+		self.assertIsNotNone(storage.size(user.avatar_l))
+		# 下载的原图在裁剪后删除
+		self.assertEqual([name for name, mtime in storage.names() if name == user.avatar_raw], [user.avatar_raw])
+		self.assertEqual([name for name in os.listdir(storage.directory) if name.startswith('.')], [])
+		response = self.client.get(url_for('main.get_avatar', filename=user.avatar_l))
+		self.assertEqual(response.status_code, 200)
+
+
+class ShardedStorageTestCase(BaseTestCase):
+
+	def flat(self, directory, filename, content=b'flat'):
+		with open(os.path.join(directory, filename), 'wb') as f:
+			f.write(content)
+
+	def test_shard_path(self):
+		directory = os.path.dirname(shard_path('abc.jpg'))
+		# 原图、缩略图和其他格式的文件在同一个目录中
+		for filename in ('abc_s.jpg', 'abc_m.webp', 'abc.avif'):
+			self.assertEqual(os.path.dirname(shard_path(filename)), directory)
+		self.assertNotEqual(os.path.dirname(shard_path('abd.jpg')), directory)
+		self.assertEqual(len(directory.split(os.sep)), 2)
+		self.assertEqual(shard_path('ab/cd/abc.jpg'), 'ab/cd/abc.jpg')
+
+	def test_locate_legacy(self):
+		self.assertIsNone(locate_media(self.directory, 'abc.jpg'))
+		self.flat(self.directory, 'abc.jpg')
+		self.assertEqual(locate_media(self.directory, 'abc.jpg'), os.path.join(self.directory, 'abc.jpg'))
+		with open(media_path(self.directory, 'abc.jpg', create=True), 'wb') as f:
+			f.write(b'sharded')
+		self.assertEqual(locate_media(self.directory, 'abc.jpg'), media_path(self.directory, 'abc.jpg'))
+
+	def test_migrate_resume(self):
+		names = ['%d.jpg' % i for i in range(5)]
+		for name in names:
+			self.flat(self.directory, name, name.encode())
+		self.flat(self.directory, '.upload-x.part')
+		self.flat(self.app.config['AVATARS_SAVE_PATH'], 'a_m.png')
+		# 上次迁移在第一批之后中断，其中一个文件已经复制过去但没有删除
+		self.assertEqual(next(migrate_directory(self.directory, 2)), 2)
+		with open(media_path(self.directory, '4.jpg', create=True), 'wb') as f:
+			f.write(b'4.jpg')
+		# 迁移期间仍然可以读取
+		self.assertEqual(self.client.get(url_for('main.get_image', filename='3.jpg')).data, b'3.jpg')
+
+		result = self.runner.invoke(args=['media', 'migrate', '--batch-size', '2'])
+		self.assertIn('Done.', result.output)
+		self.assertEqual(sorted(os.listdir(self.directory))[0], '.upload-x.part')
+		for name in names:
+			self.assertFalse(os.path.exists(os.path.join(self.directory, name)))
+			self.assertEqual(self.client.get(url_for('main.get_image', filename=name)).data, name.encode())
+		self.assertFalse(os.path.exists(os.path.join(self.app.config['AVATARS_SAVE_PATH'], 'a_m.png')))
+		self.assertTrue(os.path.isfile(media_path(self.app.config['AVATARS_SAVE_PATH'], 'a_m.png')))
+		# 再次执行没有需要移动的文件
+		self.assertEqual(list(migrate_directory(self.directory)), [])
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from flask import url_for
+
+from albumy.extensions import db
+from albumy.models import Photo, Tag
+from tests.base import BaseTestCase
+
+
+class TagCountTestCase(BaseTestCase):
+
+	def setUp(self):
+		super(TagCountTestCase, self).setUp()
+		self.login()
+		for color in ((10, 0, 0), (20, 0, 0)):
+			self.upload(self.image(color=color))
+		self.first, self.second = Photo.query.order_by(Photo.id).all()
+		self.tag = Tag(name='sky')
+		db.session.add(self.tag)
+		db.session.commit()
+
+	def photo_count(self):
+		return db.session.query(Tag.photo_count).filter_by(id=self.tag.id).scalar()
+
+	def test_add_and_remove(self):
+		self.client.post(url_for('main.new_tag', photo_id=self.first.id), data=dict(tag='sky'))
+		self.client.post(url_for('main.new_tag', photo_id=self.second.id), data=dict(tag='sky'))
+		self.assertEqual(self.photo_count(), 2)
+		self.client.post(url_for('main.delete_tag', photo_id=self.first.id, tag_id=self.tag.id))
+		self.assertEqual(self.photo_count(), 1)
+		self.client.post(url_for('main.delete_photo', photo_id=self.second.id))
+		self.assertEqual(self.photo_count(), 0)
+
+	def test_concurrent_update(self):
+		tag = Tag.query.get(self.tag.id)
+		self.assertEqual(tag.photo_count, 0)
+		# 其他进程在读取之后修改了数量，内存中的值已经过期
+		db.session.execute(Tag.__table__.update().values(photo_count=Tag.__table__.c.photo_count + 5))
+		self.first.tags.append(tag)
+		db.session.commit()
+		self.assertEqual(self.photo_count(), 6)
+		self.first.tags.remove(tag)
+		db.session.commit()
+		self.assertEqual(self.photo_count(), 5)
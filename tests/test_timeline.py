@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+
+from albumy.extensions import db
+from albumy.models import Photo, TimelineEntry
+from tests.base import BaseTestCase
+
+
+class TimelineTestCase(BaseTestCase):
+
+	def setUp(self):
+		super(TimelineTestCase, self).setUp()
+		self.app.config['ALBUMY_TIMELINE_SIZE'] = 3
+		self.app.config['ALBUMY_TIMELINE_TRIM_EVERY'] = 1
+		self.other = self.create_user('other', 'other@helloflask.com')
+		self.admin.follow(self.user)
+		self.other.follow(self.user)
+		self.start = datetime.utcnow()
+
+	def photos(self, count, same_time=False):
+		photos = []
+		for i in range(count):
+			photo = Photo(filename='%d.jpg' % i, filename_s='%d.jpg' % i, filename_m='%d.jpg' % i, author=self.user,
+						  timestamp=self.start if same_time else self.start + timedelta(seconds=len(photos)))
+			photos.append(photo)
+		db.session.add_all(photos)
+		db.session.commit()
+		return photos
+
+	def timeline(self, user):
+		return [entry.photo_id for entry in
+				TimelineEntry.query.filter_by(user_id=user.id).order_by(TimelineEntry.timestamp.desc(),
+																		 TimelineEntry.photo_id.desc())]
+
+	def test_push_trims_receivers(self):
+		photos = self.photos(5)
+		for photo in photos:
+			TimelineEntry.push(photo)
+		newest = [photo.id for photo in reversed(photos)][:3]
+		for user in (self.user, self.admin, self.other):
+			self.assertEqual(self.timeline(user), newest)
+
+	def test_push_many_trims_receivers(self):
+		photos = self.photos(5)
+		TimelineEntry.push_many(self.user.id, photos)
+		newest = [photo.id for photo in reversed(photos)][:3]
+		for user in (self.user, self.admin, self.other):
+			self.assertEqual(self.timeline(user), newest)
+
+	def test_trim_disabled(self):
+		self.app.config['ALBUMY_TIMELINE_TRIM_EVERY'] = None
+		TimelineEntry.push_many(self.user.id, self.photos(5))
+		self.assertEqual(len(self.timeline(self.admin)), 5)
+
+	def test_trim_same_timestamp(self):
+		# 批量上传的图片使用相同的上传时间
+		photos = self.photos(5, same_time=True)
+		TimelineEntry.push_many(self.user.id, photos)
+		newest = sorted((photo.id for photo in photos), reverse=True)[:3]
+		for user in (self.user, self.admin, self.other):
+			self.assertEqual(self.timeline(user), newest)
+
+	def test_push_and_backfill_overlap(self):
+		photos = self.photos(2)
+		# 关注时回填和上传图片同时写入了同一条数据
+		TimelineEntry.backfill(self.admin.id, self.user.id)
+		TimelineEntry.push(photos[1])
+		TimelineEntry.push_many(self.user.id, photos)
+		TimelineEntry.backfill(self.other.id, self.user.id)
+		for user in (self.admin, self.other):
+			self.assertEqual(self.timeline(user), [photos[1].id, photos[0].id])
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+
+from flask import url_for
+
+from albumy.extensions import db
+from albumy.models import Blob, Photo, TimelineEntry
+from albumy.settings import ThumbnailStatus
+from albumy.storage import get_storage
+from albumy.utils import count_queries
+from tests.base import BaseTestCase
+
+
+class UploadTestCase(BaseTestCase):
+
+	def setUp(self):
+		super(UploadTestCase, self).setUp()
+		self.login()
+
+	def test_duplicate_upload(self):
+		data = self.image()
+		self.assertEqual(self.upload(data).status_code, 200)
+		self.assertEqual(self.upload(data).status_code, 200)
+		first, second = Photo.query.order_by(Photo.id).all()
+		self.assertEqual(first.filename, second.filename)
+		self.assertEqual(second.filename_s, first.filename_s)
+		self.assertEqual(Blob.query.one().refcount, 2)
+
+	def test_blob_without_photo(self):
+		data = self.image()
+		self.upload(data)
+		# 例如批量删除账号时，Blob还在但是没有图片使用这个文件
+		db.session.execute(TimelineEntry.__table__.delete())
+		db.session.execute(Photo.__table__.delete())
+		db.session.commit()
+		self.assertEqual(self.upload(data).status_code, 200)
+		photo = Photo.query.one()
+		self.assertEqual(photo.filename, Blob.query.one().filename)
+		self.assertEqual(photo.thumbnail_status, ThumbnailStatus.READY)
+		self.assertNotEqual(photo.filename_s, photo.filename)
+
+	def test_batch_upload_ids(self):
+		images = [self.image(color=(i * 50, 0, 0)) for i in range(4)]
+		data = dict(('file[%d]' % i, (io.BytesIO(image), '%d.jpg' % i)) for i, image in enumerate(images))
+		data['file[4]'] = (io.BytesIO(b'not an image'), 'x.jpg')
+		response = self.client.post(url_for('main.upload_batch'), data=data, content_type='multipart/form-data')
+		results = response.get_json()['results']
+		self.assertEqual([result['ok'] for result in results], [True, True, True, True, False])
+		for image, result in zip(images, results):
+			photo = Photo.query.get(result['id'])
+			self.assertEqual(Blob.query.filter_by(filename=photo.filename).one().hash,
+							 hashlib.sha256(image).hexdigest())
+			self.assertEqual(result['url'], url_for('main.show_photo', photo_id=photo.id))
+
+	def batch(self, images):
+		data = dict(('file[%d]' % i, (io.BytesIO(image), '%d.jpg' % i)) for i, image in enumerate(images))
+		return self.client.post(url_for('main.upload_batch'), data=data, content_type='multipart/form-data')
+
+	def test_batch_upload_single_insert(self):
+		image = self.image()
+		self.upload(image)
+		images = [image, image] + [self.image(color=(i * 50, 0, 0)) for i in range(3)]
+		with count_queries() as statements:
+			results = self.batch(images).get_json()['results']
+		self.assertEqual(len([statement for statement in statements if statement.startswith('INSERT INTO photo')]), 1)
+		self.assertEqual(len(set(result['id'] for result in results)), 5)
+		first = Photo.query.order_by(Photo.id).first()
+		self.assertEqual([Photo.query.get(result['id']).filename for result in results[:2]], [first.filename] * 2)
+		self.assertEqual(Blob.query.filter_by(filename=first.filename).one().refcount, 3)
+
+	def concurrent_blob(self, data):
+		"""
+		查询Blob没有找到之后，另一个请求写入了相同的图片
+		:return: 另一个请求保存的文件名
+		"""
+		blobs = Blob.__table__
+		inserted = []
+
+		def insert_after_select(conn, cursor, statement, parameters, context, executemany):
+			if not inserted and statement.startswith('SELECT blob.'):
+				cursor.fetchall()
+				inserted.append('other.jpg')
+				conn.execute(blobs.insert().values(hash=hashlib.sha256(data).hexdigest(), filename='other.jpg',
+												   refcount=0))
+
+		db.event.listen(db.engine, 'after_cursor_execute', insert_after_select)
+		return inserted, lambda: db.event.remove(db.engine, 'after_cursor_execute', insert_after_select)
+
+	def assert_reused(self, photo_ids):
+		for photo_id in photo_ids:
+			photo = Photo.query.get(photo_id)
+			self.assertEqual(photo.filename, 'other.jpg')
+		blob = Blob.query.one()
+		self.assertEqual(blob.filename, 'other.jpg')
+		self.assertEqual(blob.refcount, len(photo_ids))
+		# 刚刚保存的文件已经删除
+		self.assertEqual([name for name in get_storage('uploads').names() if name != 'other.jpg'], [])
+
+	def test_concurrent_duplicate_upload(self):
+		data = self.image()
+		inserted, remove = self.concurrent_blob(data)
+		try:
+			self.assertEqual(self.upload(data).status_code, 200)
+		finally:
+			remove()
+		self.assertEqual(inserted, ['other.jpg'])
+		self.assert_reused([Photo.query.one().id])
+
+	def test_concurrent_duplicate_batch_upload(self):
+		data = self.image()
+		inserted, remove = self.concurrent_blob(data)
+		try:
+			response = self.batch([data, data])
+		finally:
+			remove()
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(inserted, ['other.jpg'])
+		self.assert_reused([result['id'] for result in response.get_json()['results']])
+
+	def test_batch_upload_rejected(self):
+		response = self.client.post(url_for('main.upload_batch'), data={
+			'file[0]': (io.BytesIO(b'not an image'), 'x.jpg'),
+			'file[1]': (io.BytesIO(b'not an image either'), 'y.jpg'),
+		}, content_type='multipart/form-data')
+		self.assertEqual(response.status_code, 400)
+		data = response.get_json()
+		self.assertTrue(data['error'])
+		self.assertEqual([result['ok'] for result in data['results']], [False, False])
+		self.assertEqual(Photo.query.count(), 0)
+		# 部分失败时返回200，由页面中的回调标记失败的文件
+		self.assertIn('successmultiple', self.client.get(url_for('main.upload')).get_data(as_text=True))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from flask_login import login_user
+
+from albumy.extensions import db
+from albumy.models import Photo
+from albumy.utils import count_queries
+from albumy.viewer import load_photos, load_users
+from tests.base import BaseTestCase
+
+
+class ViewerStateTestCase(BaseTestCase):
+
+	def setUp(self):
+		super(ViewerStateTestCase, self).setUp()
+		self.other = self.create_user('other', 'other@helloflask.com')
+		self.photos = [Photo(filename='%d.jpg' % i, filename_s='%d.jpg' % i, filename_m='%d.jpg' % i,
+							 author=self.other) for i in range(4)]
+		db.session.add_all(self.photos)
+		db.session.commit()
+		self.user.collect(self.photos[0])
+		self.user.collect(self.photos[2])
+		self.user.follow(self.other)
+		self.admin.follow(self.user)
+		login_user(self.user)
+		# commit之后对象已过期，先加载属性，以免计入查询次数
+		for obj in self.photos + [self.user, self.admin, self.other]:
+			db.session.refresh(obj)
+
+	def test_load_photos(self):
+		with count_queries() as statements:
+			load_photos(self.photos)
+		self.assertEqual(len(statements), 1)
+		with count_queries() as statements:
+			collecting = [self.user.is_collecting(photo) for photo in self.photos]
+		self.assertEqual(statements, [])
+		self.assertEqual(collecting, [True, False, True, False])
+		# 收藏之后更新，不需要再次查询
+		self.user.collect(self.photos[1])
+		with count_queries() as statements:
+			self.assertTrue(self.user.is_collecting(self.photos[1]))
+		self.assertEqual(statements, [])
+
+	def test_load_users(self):
+		users = [self.admin, self.other]
+		with count_queries() as statements:
+			load_users(users)
+		self.assertEqual(len(statements), 2)
+		with count_queries() as statements:
+			following = [self.user.is_following(user) for user in users]
+			followed_by = [self.user.is_followed_by(user) for user in users]
+			# 另一个方向从同一份结果中读取
+			self.assertTrue(self.admin.is_following(self.user))
+			self.assertFalse(self.other.is_following(self.user))
+		self.assertEqual(statements, [])
+		self.assertEqual(following, [False, True])
+		self.assertEqual(followed_by, [True, False])
+		self.user.unfollow(self.other)
+		with count_queries() as statements:
+			self.assertFalse(self.user.is_following(self.other))
+		self.assertEqual(statements, [])
+
+	def test_not_loaded(self):
+		# 没有预先查询的图片仍然单独查询
+		with count_queries() as statements:
+			self.assertTrue(self.user.is_collecting(self.photos[0]))
+		self.assertEqual(len(statements), 1)